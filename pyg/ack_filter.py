@@ -0,0 +1,102 @@
+import queue
+import threading
+from typing import Optional, Tuple
+
+TCP_PROTOCOL = 6
+TCP_FLAG_ACK = 0x10
+
+""" TCP options that don't stop an ACK from being replaced: EOL, NOP and timestamps """
+REPLACEABLE_OPTIONS = (0, 1, 8)
+
+def pure_ack(packet: bytes) -> Optional[Tuple[bytes, int]]:
+    """ Check if an IPv4 packet is a pure TCP ACK
+
+    Args:
+        packet (bytes): IP packet
+
+    Returns:
+        Tuple[bytes, int]: Flow key and ack number, or None if the packet
+        is not a pure ACK
+    """
+    if len(packet) < 40 or packet[0] >> 4 != 4 or packet[9] != TCP_PROTOCOL:
+        return None
+    # Fragmented datagrams carry no complete TCP header
+    if int.from_bytes(packet[6:8], 'big') & 0x3FFF:
+        return None
+    ip_len = (packet[0] & 0x0F) * 4
+    # IP options may leave less than a TCP header in a short packet
+    if ip_len < 20 or len(packet) < ip_len + 20:
+        return None
+    tcp_len = (packet[ip_len + 12] >> 4) * 4
+    if (tcp_len < 20 or packet[ip_len + 13] != TCP_FLAG_ACK
+            or int.from_bytes(packet[2:4], 'big') != ip_len + tcp_len
+            or len(packet) < ip_len + tcp_len):
+        return None
+    # SACK and other options carry information a newer ACK may not repeat
+    offset = ip_len + 20
+    end = ip_len + tcp_len
+    while offset < end:
+        kind = packet[offset]
+        if kind not in REPLACEABLE_OPTIONS:
+            return None
+        if kind == 0:
+            break
+        if kind == 1:
+            offset += 1
+        elif offset + 1 < end and packet[offset + 1] >= 2:
+            offset += packet[offset + 1]
+        else:
+            return None
+    flow = packet[12:20] + packet[ip_len:ip_len + 4]
+    return (flow, int.from_bytes(packet[ip_len + 8:ip_len + 12], 'big'))
+
+class _QueuedAck(object):
+    """ Queue slot of a pure ACK, its packet can be replaced while queued """
+    __slots__ = ("packet", "flow", "ack")
+
+    def __init__(self, packet, flow, ack):
+        self.packet = packet
+        self.flow = flow
+        self.ack = ack
+
+class AckFilter(object):
+    """
+    Keeps at most one pure ACK per TCP flow in a queue. A newer cumulative
+    ACK replaces the queued one in place, so it keeps its position in the queue.
+    Duplicate ACKs and window updates (same ack number) are always queued.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = {}
+        self.filtered = 0
+
+    def put(self, out_queue: queue.Queue, packet: bytes):
+        """
+        Put a packet in the queue, or let it replace a queued ACK of the same flow.
+        """
+        ack_info = pure_ack(packet)
+        if ack_info is None:
+            out_queue.put(packet)
+            return
+        (flow, ack) = ack_info
+        with self.lock:
+            slot = self.queued.get(flow)
+            if slot is not None and 0 < (ack - slot.ack) & 0xFFFFFFFF < 0x80000000:
+                slot.packet, slot.ack = (packet, ack)
+                self.filtered += 1
+                return
+            slot = _QueuedAck(packet, flow, ack)
+            self.queued[flow] = slot
+        out_queue.put(slot)
+
+    def unwrap(self, item) -> bytes:
+        """
+        Get the packet of an item taken off the queue. Must be called on
+        every item so that ACK slots are released.
+        """
+        if not isinstance(item, _QueuedAck):
+            return item
+        with self.lock:
+            if self.queued.get(item.flow) is item:
+                del self.queued[item.flow]
+            return item.packet
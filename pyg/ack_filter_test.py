@@ -0,0 +1,90 @@
+import queue
+import struct
+import unittest
+
+from ack_filter import AckFilter, TCP_FLAG_ACK, pure_ack
+
+def tcp_packet(ack: int, flags: int = TCP_FLAG_ACK, payload: bytes = b"", tcp_options: bytes = b"",
+               ip_options: bytes = b"", sport: int = 40000, dport: int = 80, fragment: int = 0) -> bytes:
+    """ IPv4 TCP packet, checksums left 0 """
+    tcp = struct.pack("!HHIIBBHHH", sport, dport, 1, ack, (5 + len(tcp_options) // 4) << 4, flags,
+                      65535, 0, 0) + tcp_options
+    ip_len = 20 + len(ip_options)
+    ip = struct.pack("!BBHHHBBH4s4s", 0x40 | ip_len // 4, 0, ip_len + len(tcp) + len(payload), 0,
+                     fragment, 64, 6, 0, bytes([10, 0, 0, 1]), bytes([10, 0, 0, 2]))
+    return ip + ip_options + tcp + payload
+
+class PureAckTest(unittest.TestCase):
+    def test_pure_ack(self):
+        (flow, ack) = pure_ack(tcp_packet(1000))
+        self.assertEqual(ack, 1000)
+        self.assertEqual(flow, bytes([10, 0, 0, 1, 10, 0, 0, 2]) + struct.pack("!HH", 40000, 80))
+
+    def test_flows_differ_by_port(self):
+        self.assertNotEqual(pure_ack(tcp_packet(1))[0], pure_ack(tcp_packet(1, sport=40001))[0])
+
+    def test_not_pure(self):
+        self.assertIsNone(pure_ack(tcp_packet(1000, payload=b"data")))
+        self.assertIsNone(pure_ack(tcp_packet(1000, flags=TCP_FLAG_ACK | 0x02)))  # SYN/ACK
+        self.assertIsNone(pure_ack(tcp_packet(1000, flags=TCP_FLAG_ACK | 0x01)))  # FIN
+        self.assertIsNone(pure_ack(tcp_packet(1000, fragment=0x2000)))  # More fragments
+        self.assertIsNone(pure_ack(b"\x60" + bytes(59)))  # IPv6
+
+    def test_options(self):
+        timestamps = b"\x01\x01\x08\x0a" + bytes(8)
+        sack = b"\x01\x01\x05\x0a" + bytes(8)
+        self.assertIsNotNone(pure_ack(tcp_packet(1000, tcp_options=timestamps)))
+        self.assertIsNone(pure_ack(tcp_packet(1000, tcp_options=sack)))
+
+    def test_ip_options_shift_the_tcp_header(self):
+        self.assertEqual(pure_ack(tcp_packet(1000, ip_options=bytes(8)))[1], 1000)
+
+    def test_short_packet_with_ip_options(self):
+        # IHL 15, the TCP header would start past the end of the packet
+        packet = bytearray(tcp_packet(1000))
+        packet[0] = 0x4F
+        self.assertIsNone(pure_ack(bytes(packet)))
+
+class AckFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = AckFilter()
+        self.queue = queue.Queue()
+
+    def drain(self) -> list:
+        packets = []
+        while not self.queue.empty():
+            packets.append(self.filter.unwrap(self.queue.get_nowait()))
+        return packets
+
+    def test_newer_ack_replaces_queued_one_in_place(self):
+        data = tcp_packet(5, payload=b"data")
+        self.filter.put(self.queue, tcp_packet(100))
+        self.filter.put(self.queue, data)
+        self.filter.put(self.queue, tcp_packet(200))
+        self.assertEqual(self.drain(), [tcp_packet(200), data])
+        self.assertEqual(self.filter.filtered, 1)
+
+    def test_duplicate_and_older_acks_are_queued(self):
+        for ack in (100, 100, 50):
+            self.filter.put(self.queue, tcp_packet(ack))
+        self.assertEqual(self.drain(), [tcp_packet(100), tcp_packet(100), tcp_packet(50)])
+
+    def test_ack_number_wraps_around(self):
+        self.filter.put(self.queue, tcp_packet(0xFFFFFFF0))
+        self.filter.put(self.queue, tcp_packet(0x10))
+        self.assertEqual(self.drain(), [tcp_packet(0x10)])
+
+    def test_unwrap_releases_the_slot(self):
+        self.filter.put(self.queue, tcp_packet(100))
+        self.drain()
+        self.filter.put(self.queue, tcp_packet(200))
+        self.assertEqual(self.drain(), [tcp_packet(200)])
+        self.assertEqual(self.filter.queued, {})
+
+    def test_flows_are_separate(self):
+        self.filter.put(self.queue, tcp_packet(100))
+        self.filter.put(self.queue, tcp_packet(200, sport=40001))
+        self.assertEqual(len(self.drain()), 2)
+
+if __name__ == "__main__":
+    unittest.main()
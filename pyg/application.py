@@ -1,24 +1,42 @@
 from typing import Tuple
-import board
+import ipaddress
 import queue
-from digitalio import DigitalInOut
 from rf24 import RF24
-import spidev
+from rf24_emulator import Ether, EmulatedRadio
+from rf24_profiler import SPIProfiler
+import cpy_spidev
+import socket
 import subprocess
 import threading
 import time
 from tun_interface import Tun
+from ack_filter import AckFilter
+import metrics
+import tracing
+import capture
+from control_protocol import UdpControlClient
 import logging
 from process import Process
+from pyg_control_system import LookupController
 import pycurl
 import struct
 from io import BytesIO
+try:
+    import board
+    from digitalio import DigitalInOut
+    import spidev
+except ImportError:
+    """ Not on a Pi, only RADIO_BACKEND = "emulator" works """
+    board = None
 
 do_run = threading.Event()
 
 tun_in_queue = queue.Queue()
 tun_out_queue = queue.Queue()
 
+""" Replaces pure TCP ACKs still in tun_in_queue with newer ones """
+ack_filter = AckFilter()
+
 
 process = Process()
 water_height = 0.0
@@ -36,8 +54,8 @@ SPI_BUS, CSN_PIN, CE_PIN = (None, None, None)
 
 """ Constants for CE & CSN pins for the two SPI buses """
 
-CE_BUS_0 = board.D22
-CE_BUS_1 = board.D24
+CE_BUS_0 = board.D22 if board is not None else None
+CE_BUS_1 = board.D24 if board is not None else None
 CSN_BUS_0 = 0
 CSN_BUS_1 = 10
 
@@ -45,6 +63,19 @@ CSN_BUS_1 = 10
 
 SPI_DEV = 0
 
+""" 
+    Radio backend: "spidev" for the nRF24L01+ on the SPI buses, or
+    "emulator" for radios of rf24_emulator, whose air is shared with the
+    other nodes over UDP
+"""
+RADIO_BACKEND = "spidev"
+EMULATOR_LOSS = 0.0 # Probability that a packet or its ACK is lost
+EMULATOR_LATENCY = 0.0 # s, each way
+EMULATOR_COLLISIONS = True
+EMULATOR_HOST = "127.0.0.1"
+EMULATOR_HOSTS = {} # Node id (0 for the base) -> host, if not EMULATOR_HOST
+EMULATOR_PORT = 7600 # The base binds this port, mobile n the port + n
+
 """ Radio Parameters """
 
 POWER_LEVEL = -12 #DBM
@@ -56,7 +87,71 @@ CRC_LENGTH = 2 #Bytes
 """ Fragments size """
 FRAG_SIZE = 30
 
-LAST_PACKET_ID = 0xFFFF
+""" 
+    Fragment ids count from 1. The last fragment of a packet has
+    LAST_FRAGMENT set on its id, so the loss of any fragment, the one
+    before the last included, shows as a gap in the ids
+"""
+LAST_FRAGMENT = 0x8000
+
+""" 
+    Aggregation of small packets into one frame. An aggregate starts with a
+    tag that is not a valid IP version, followed by length-prefixed packets.
+"""
+AGGREGATION = True
+AGGREGATE_TAG = 0xA0
+AGGREGATE_MAX_PACKET = 80 # Bytes, larger packets are sent on their own
+AGGREGATE_MAX_SIZE = 10 * FRAG_SIZE # Bytes
+AGGREGATION_WAIT = 0.001 # s, max wait for more small packets
+
+""" Let a newer pure TCP ACK replace a queued one of the same flow """
+ACK_FILTER = True
+
+""" Link-management frames are single fragments with this reserved id """
+LINK_FRAME_ID = 0x0000
+LINK_POLL = 1 # Base -> mobile: the mobile may transmit its uplink burst
+LINK_DONE = 2 # Mobile -> base: the uplink burst is over
+LINK_TOKEN = 3 # Half-duplex: the receiver may transmit, the argument is the token generation
+LINK_CLOCK = 4 # Tracing: clock sync, see tracing.py
+
+""" 
+    Half-duplex mode, one radio per node. The node holding the token
+    transmits a burst, then passes the token and listens.
+    The base reclaims a token that got lost on the way.
+    Point-to-point only, star mode has its own scheduling.
+"""
+HALF_DUPLEX = False
+TOKEN_BURST = 0.02 # s, time the holder may start new packets
+TOKEN_IDLE_HOLD = 0.01 # s, wait for traffic before passing an unused token
+TOKEN_TIMEOUT = 0.1 # s, the base reclaims the token after hearing nothing for this long
+
+""" 
+    RX pipes, one per traffic class. The class of a fragment is given by the
+    pipe it arrives on, so the receiver demultiplexes in hardware.
+    Pipe 0 is left to the auto-ack of the TX radio.
+"""
+PIPE_LINK = 1 # Link-management frames
+PIPE_CONTROL = 2 # Control loop traffic to/from the control server
+PIPE_BULK = 3 # Everything else
+RX_PIPES = (PIPE_LINK, PIPE_CONTROL, PIPE_BULK)
+
+""" Static payload length per pipe, only used when dynamic payloads are disabled """
+PIPE_PAYLOAD_LENGTH = {
+    PIPE_LINK: 32,
+    PIPE_CONTROL: FRAG_SIZE + 2,
+    PIPE_BULK: FRAG_SIZE + 2,
+}
+
+""" 
+    Star topology, one base serving several mobiles.
+    Mobile n transmits to pipe n of the base and gets the IP BASE_IP + n.
+    The base polls the mobiles in turn so that uplinks never collide.
+"""
+STAR_MODE = False
+STAR_MAX_NODES = 5 # Pipe 0 is needed for auto-ack, leaving pipes 1-5
+UPLINK_SLOT = 0.05 # s, time a polled mobile may start new uplink packets
+UPLINK_GUARD = 0.05 # s, extra wait for the last packet of a burst
+POLL_IDLE_PERIOD = 0.1 # s, wait for downlink traffic after an idle round
 
 TUN_IF_NAME = "LongG"
 
@@ -66,18 +161,310 @@ TUN_IF_MASK = "255.255.255.0"
 
 CONTROL_SERVER_IP = "CONTROL SERVER IP HERE"
 CONTROL_SERVER_PORT = "CONTROL SERVER PORT HERE"
+CONTROL_SERVER_UDP_PORT = 8081
+
+""" Transport of the sampler: "http", or "udp" for the binary control protocol """
+CONTROL_TRANSPORT = "http"
+
+""" 
+    Degraded mode: the mobile controls locally with a lookup table
+    (pyg_control_system.build_lookup_table) while the control server
+    doesn't answer, or answers slower than DEGRADED_RTT
+"""
+LOOKUP_TABLE = None # Path of the table file, None disables degraded mode
+DEGRADED_RTT = 2.0 # s
+DEGRADED_SAMPLES = 12 # Samples controlled locally before asking the server again
+
+""" Packed control server address, set in setup() """
+control_server_addr = None
+
+""" Role and (star mode) node id of this node, set in setup() """
+node_role = None
+node_id = 1
+
+""" TX address of every pipe on the peer, set in setup() """
+tx_addresses = {}
+""" Address the TX radio is currently transmitting to """
+tx_address = None
+
+""" Star mode uplink scheduling """
+uplink_grant = threading.Event() # Mobile: set when polled by the base
+uplink_done = threading.Event() # Base: set when the polled mobile is done
+polled_node = None
+uplink_count = 0
+
+""" Half-duplex: set while this node holds the token """
+token = threading.Event()
+""" 
+    Half-duplex: generation of the token this node last held. A token is
+    passed on as the next generation, so a token frame retransmitted after
+    its ACK was lost carries a generation the peer already has, and is dropped.
+"""
+token_generation = 0
+
+""" 
+    Opt-in tracing of packets through the pipeline, see tracing.py.
+    The trace id takes tracing.TRACE_ID_SIZE bytes of every fragment,
+    so both nodes must agree on it. Clocks are only synced point-to-point,
+    star mode traces stay in the clock of each node.
+"""
+TRACING = False
+TRACE_FILE = "trace_node{}.json" # Formatted with the node id, 0 for the base
+CLOCK_SYNC_PERIOD = 1 # s
+
+""" Tracer of this node, set in main() if TRACING """
+tracer = None
+""" Trace id of the frame last taken off tun_in_queue """
+tx_trace_id = None
+last_clock_sync = 0
+
+""" Profile the SPI transactions of the radios, reported at shutdown """
+SPI_PROFILE = False
+spi_profiler = SPIProfiler()
+
+""" 
+    Radio watchdog: every WATCHDOG_PERIOD the thread driving a radio
+    compares its registers to the driver's shadow copies, and reprograms
+    the radio if its configuration was lost (e.g. a brown-out reset), a
+    FIFO is stuck or transmissions time out. WATCHDOG_PERIOD = None disables it.
+"""
+WATCHDOG_PERIOD = 1 # s
+RADIO_POWER_UP = 0.005 # s, oscillator start-up after reprogramming
+RADIO_INIT_ATTEMPTS = 3
+RADIO_INIT_DELAY = 0.1 # s, between attempts
+""" Last watchdog check and TX timeouts seen, per radio """
+last_radio_check = {}
+radio_tx_timeouts = {}
+
+""" 
+    Packet capture of the link to pcapng files, see capture.py: IP packets
+    read from and written to the TUN interface, and with CAPTURE_FRAGMENTS
+    the fragments sent and received. CAPTURE_FILE = None disables it.
+"""
+CAPTURE_FILE = None # e.g. "capture_node{}.pcapng", formatted with the node id, 0 for the base
+CAPTURE_FRAGMENTS = False
+CAPTURE_MAX_BYTES = 16 << 20 # Bytes per file
+CAPTURE_FILES = 4 # Files kept, the oldest is deleted
+""" Capture of this node, set in main() if CAPTURE_FILE """
+capture_tap = None
+
+""" Local endpoint of the link metrics, METRICS_PORT = None disables it """
+METRICS_PORT = 9101
+METRICS_HOST = "127.0.0.1"
+
+""" Packet taken off tun_in_queue that didn't fit in the last aggregate """
+tx_pending = None
 
 """ Define tun device """
 tun = Tun(if_name=TUN_IF_NAME)
 
+""" Link metrics, see metrics.py """
+link_metrics = metrics.Registry(prefix="longg_")
+fragments_sent = link_metrics.counter("fragments_sent", "Fragments acknowledged by the peer")
+fragments_failed = link_metrics.counter("fragments_failed", "Fragments not acknowledged after all retries")
+retransmits = link_metrics.counter("retransmits", "Automatic retransmissions of fragments")
+tx_arc = link_metrics.histogram("tx_arc", "Retransmissions needed per fragment", buckets=range(16))
+reassembly_drops = link_metrics.counter("reassembly_drops", "Packets dropped because of missing fragments")
+spi_transactions = link_metrics.counter("spi_transactions", "SPI transactions of both radios")
+tun_read_seconds = link_metrics.histogram("tun_read_seconds", "TUN reads, including the wait for a packet")
+tun_write_seconds = link_metrics.histogram("tun_write_seconds", "TUN writes")
+tx_timeouts = link_metrics.counter("tx_timeouts", "Transmissions the radio never flagged as sent or failed")
+radio_resets = link_metrics.counter("radio_resets", "Radios reprogrammed by the watchdog")
+control_rtt_seconds = link_metrics.histogram("control_rtt_seconds", "Control server round trips")
+link_metrics.gauge("tun_in_queue_depth", "Packets read from TUN waiting for the radio", tun_in_queue.qsize)
+link_metrics.gauge("tun_out_queue_depth", "Received packets waiting to be written to TUN", tun_out_queue.qsize)
+
+class CountingSpiDev(object):
+    """ spidev.SpiDev wrapper counting the transactions of a radio """
+    def __init__(self, spi):
+        self.spi = spi
+
+    def __getattr__(self, name):
+        return getattr(self.spi, name)
+
+    def __setattr__(self, name, value):
+        if name == "spi":
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.spi, name, value)
+
+    def xfer2(self, *args):
+        spi_transactions.inc()
+        return self.spi.xfer2(*args)
+
+    def xfer_many(self, out_bufs, speed_hz: int, no_cs: bool = False) -> bytearray:
+        # Batched register writes, one transaction each even in one ioctl
+        spi_transactions.inc(len(out_bufs))
+        return cpy_spidev.xfer_many(self.spi, out_bufs, speed_hz, no_cs)
+
+def pipe_address(stem: bytes, pipe: int) -> bytes:
+    """ Address of a pipe. Pipes 2-5 share the 4 upper bytes with pipe 1,
+    so only the first (least significant) byte differs between pipes.
+
+    Args:
+        stem (bytes): The 4 address bytes shared by all pipes of a node
+        pipe (int): Pipe number
+
+    Returns:
+        bytes: 5 byte address of the pipe
+    """
+    return str(pipe).encode() + stem
+
+def address_pipe(address: bytes) -> int:
+    """ Pipe number of an address made by pipe_address()
+
+    Args:
+        address (bytes): 5 byte address of the pipe
+
+    Returns:
+        int: Pipe number
+    """
+    return int(address[:1])
+
+def star_stem(node: int) -> bytes:
+    """ Address stem a mobile listens on in star mode
+
+    Args:
+        node (int): Node id of the mobile, 1 to STAR_MAX_NODES
+
+    Returns:
+        bytes: 4 byte address stem
+    """
+    return b"Mob" + str(node).encode()
+
+def node_ip(node: int) -> str:
+    """ IP address of a mobile, in the subnet of the base
+
+    Args:
+        node (int): Node id of the mobile, 1 to STAR_MAX_NODES
+
+    Returns:
+        str: IP address of the mobile
+    """
+    return str(ipaddress.ip_address(BASE_IP) + node)
+
+def route(packet: bytes):
+    """ Find the mobile a packet is destined to, by destination IP
+
+    Args:
+        packet (bytes): IP packet
+
+    Returns:
+        int: Node id of the mobile, or None if no mobile has the address
+    """
+    if len(packet) < 20 or packet[0] >> 4 != 4:
+        return None
+    node = int.from_bytes(packet[16:20], 'big') - int(ipaddress.ip_address(BASE_IP))
+    if 1 <= node <= STAR_MAX_NODES:
+        return node
+    return None
+
+def next_hop(packet: bytes):
+    """ TX address a packet should be sent to
+
+    Args:
+        packet (bytes): IP packet
+
+    Returns:
+        bytes: TX address, or None if the packet can't be routed
+    """
+    if STAR_MODE and node_role == 0:
+        node = route(packet)
+        if node is None:
+            return None
+        return pipe_address(star_stem(node), classify(packet))
+    if STAR_MODE:
+        # Uplink, the pipe on the base identifies the mobile
+        return tx_addresses[node_id]
+    return tx_addresses[classify(packet)]
+
+def classify(packet: bytes) -> int:
+    """ Map an IP packet to the pipe of its traffic class
+
+    Args:
+        packet (bytes): IP packet
+
+    Returns:
+        int: RX pipe number on the peer
+    """
+    if (len(packet) >= 20 and packet[0] >> 4 == 4
+            and control_server_addr in (packet[12:16], packet[16:20])):
+        return PIPE_CONTROL
+    return PIPE_BULK
+
+def emulator_address(node: int) -> Tuple[str, int]:
+    """ UDP address of the emulated ether of a node, 0 for the base """
+    return (EMULATOR_HOSTS.get(node, EMULATOR_HOST), EMULATOR_PORT + node)
+
+def open_radio(spi, csn, ce, bus: int) -> RF24:
+    """ Initialize the radio on a bus, retrying one that doesn't respond yet """
+    for attempt in range(1, RADIO_INIT_ATTEMPTS + 1):
+        try:
+            return RF24(spi, csn, ce, bus, SPI_DEV)
+        except RuntimeError:
+            if attempt == RADIO_INIT_ATTEMPTS:
+                raise
+            logging.warning("Radio on bus {} not responding, attempt {} of {}".format(bus, attempt, RADIO_INIT_ATTEMPTS))
+            time.sleep(RADIO_INIT_DELAY)
+
+def check_radio(nrf: RF24):
+    """ Watchdog, called by the thread driving the radio: reprogram it every
+    WATCHDOG_PERIOD if it lost its configuration or hung. The driver isn't
+    thread safe, so no other thread may do this.
+    """
+    if WATCHDOG_PERIOD is None or time.monotonic() - last_radio_check.get(nrf, 0) < WATCHDOG_PERIOD:
+        return
+    last_radio_check[nrf] = time.monotonic()
+    timeouts = nrf.tx_timeouts - radio_tx_timeouts.get(nrf, 0)
+    radio_tx_timeouts[nrf] = nrf.tx_timeouts
+    tx_timeouts.inc(timeouts)
+    differ = nrf.verify()
+    # Nothing is being sent between calls, so a full TX FIFO is stuck, and
+    # so is a full RX FIFO whose payloads the STATUS register doesn't report
+    stuck = nrf.fifo(True, False) or (nrf.fifo(False, False) and nrf.pipe is None)
+    if not (differ or stuck or timeouts):
+        return
+    logging.warning("Watchdog --> Resetting radio, registers differing: {}, FIFO stuck: {}, TX timeouts: {}".format(
+        ["%02X" % reg for reg in differ], stuck, timeouts))
+    reset_radio(nrf)
+
+def reset_radio(nrf: RF24):
+    """ Reprogram a radio from the shadow copies of its registers, and
+    drop whatever is in its FIFOs
+    """
+    radio_resets.inc()
+    nrf.ce_pin = False
+    nrf.sync()
+    nrf.flush_tx()
+    nrf.flush_rx()
+    nrf.clear_status_flags()
+    time.sleep(RADIO_POWER_UP)
+    if nrf.listen:
+        nrf.ce_pin = True
+    differ = nrf.verify()
+    if differ:
+        logging.error("Watchdog --> Radio not responding, registers differing after reset: {}".format(
+            ["%02X" % reg for reg in differ]))
+
 """ Setup the two radios """
-def setup(role) -> Tuple[RF24, RF24]:
+def setup(role, node=1) -> Tuple[RF24, RF24]:
+    global control_server_addr
+    global tx_address
+    global node_role
+    global node_id
+
+    node_role, node_id = (role, node)
     
     tun.create()
 
+    try:
+        control_server_addr = socket.inet_aton(CONTROL_SERVER_IP)
+    except OSError:
+        logging.debug("Control server IP not set, control traffic uses the bulk pipe")
+
     if role == 1:
         """ Mobile """
-        tun.setup_if(ip=MOBILE_IP, mask=TUN_IF_MASK)
+        tun.setup_if(ip=node_ip(node) if STAR_MODE else MOBILE_IP, mask=TUN_IF_MASK)
 
         command = 'ip route add 8.8.8.8 via '+BASE_IP+' dev '+TUN_IF_NAME
         subprocess.run(command, shell=True)
@@ -93,16 +480,29 @@ def setup(role) -> Tuple[RF24, RF24]:
         subprocess.run('sudo iptables -A FORWARD -i '+TUN_IF_NAME+' -o eth0 -j ACCEPT', shell=True)
 
 
-    """ Create SPI bus object """
-    SPI_BUS_RX = spidev.SpiDev()
-    SPI_BUS_TX = spidev.SpiDev()
+    if RADIO_BACKEND == "emulator":
+        """ Emulated radios, with SPI device and CE pin of their own """
+        ether = Ether(loss=EMULATOR_LOSS, latency=EMULATOR_LATENCY, collisions=EMULATOR_COLLISIONS,
+                      bind=emulator_address(0 if role == 0 else node),
+                      peers=[emulator_address(peer) for peer in range(STAR_MAX_NODES + 1)
+                             if peer != (0 if role == 0 else node)])
+        radio_0, radio_1 = (EmulatedRadio(ether), EmulatedRadio(ether))
+        SPI_BUS_RX, SPI_BUS_TX = (radio_0.spi, radio_1.spi)
+        CE_PIN_0, CE_PIN_1 = (radio_0.ce, radio_1.ce)
+    else:
+        """ Create SPI bus object """
+        SPI_BUS_RX = spidev.SpiDev()
+        SPI_BUS_TX = spidev.SpiDev()
+        CE_PIN_0 = DigitalInOut(CE_BUS_0)
+        CE_PIN_1 = DigitalInOut(CE_BUS_1)
+
+    if METRICS_PORT is not None:
+        SPI_BUS_RX, SPI_BUS_TX = (CountingSpiDev(SPI_BUS_RX), CountingSpiDev(SPI_BUS_TX))
 
     """ Radio 0 """
-    CE_PIN_0 = DigitalInOut(board.D22)
     CSN_PIN_0 = CSN_BUS_0
     SPI_BUS_NUM_0 = 0
     """ Radio 1 """
-    CE_PIN_1 = DigitalInOut(board.D24)
     CSN_PIN_1 = CSN_BUS_1 
     SPI_BUS_NUM_1 = 1
 
@@ -110,8 +510,15 @@ def setup(role) -> Tuple[RF24, RF24]:
         Initialize the nRF24L01 on the spi bus object with the specified CE & CSN pin:
         At the specified bus and device /dev/spidev{bus}.{device}
     """
-    nrf_rx = RF24(SPI_BUS_RX, CSN_PIN_0, CE_PIN_0, SPI_BUS_NUM_0, SPI_DEV)
-    nrf_tx = RF24(SPI_BUS_TX, CSN_PIN_1, CE_PIN_1, SPI_BUS_NUM_1, SPI_DEV)
+    nrf_rx = open_radio(SPI_BUS_RX, CSN_PIN_0, CE_PIN_0, SPI_BUS_NUM_0)
+    if HALF_DUPLEX and not STAR_MODE:
+        """ Radio 0 does both, radio 1 is left free """
+        nrf_tx = nrf_rx
+    else:
+        nrf_tx = open_radio(SPI_BUS_TX, CSN_PIN_1, CE_PIN_1, SPI_BUS_NUM_1)
+    if SPI_PROFILE:
+        nrf_rx.profiler = spi_profiler
+        nrf_tx.profiler = spi_profiler
 
 
 
@@ -135,13 +542,32 @@ def setup(role) -> Tuple[RF24, RF24]:
     nrf_tx.crc = CRC_LENGTH
 
 
-    """ Αddresses needs to be in a buffer protocol object (bytearray)"""
-    address = [b"1Base", b"2Node"]
-
-    nrf_tx.open_tx_pipe(address[role])
-    nrf_tx.open_rx_pipe(1, address[not role])
-    nrf_rx.open_tx_pipe(address[role])
-    nrf_rx.open_rx_pipe(1, address[not role])
+    """ 
+        Αddresses needs to be in a buffer protocol object (bytearray)
+        A node transmits to the stem of its role, and listens on the other one
+    """
+    address = [b"Base", b"Node"]
+
+    rx_stem = address[not role]
+    rx_pipes = RX_PIPES
+    if STAR_MODE and role == 0:
+        """ One pipe per mobile, downlink addresses are given by next_hop() """
+        rx_pipes = range(1, STAR_MAX_NODES + 1)
+    elif STAR_MODE:
+        """ Uplink to the pipe of this mobile, downlink on a stem of its own """
+        rx_stem = star_stem(node)
+        tx_addresses[node] = pipe_address(address[role], node)
+    if not STAR_MODE:
+        for pipe in RX_PIPES:
+            tx_addresses[pipe] = pipe_address(address[role], pipe)
+
+    tx_address = pipe_address(address[role], 1)
+    nrf_tx.open_tx_pipe(tx_address)
+    nrf_tx.open_rx_pipe(1, pipe_address(rx_stem, 1))
+    nrf_rx.open_tx_pipe(tx_address)
+    for pipe in rx_pipes:
+        nrf_rx.open_rx_pipe(pipe, pipe_address(rx_stem, pipe))
+        nrf_rx.set_payload_length(PIPE_PAYLOAD_LENGTH.get(pipe, FRAG_SIZE + 2), pipe)
 
     nrf_tx.flush_tx()
     nrf_rx.flush_rx()
@@ -151,60 +577,353 @@ def setup(role) -> Tuple[RF24, RF24]:
 
     return (nrf_rx, nrf_tx)
 
-def fragment(data: bytes) -> list:
+def fragment(data: bytes, trace_id: int = None) -> list:
     """ Fragments incoming binary data in bytes
 
     Args:
         data (bytes): Binary data converted with "bytes"
+        trace_id (int): Trace id to put in the fragment headers, if tracing
 
     Returns:
         list: list of fragments 
     """
 
-    fragments = []
     dataLength = len(data)
 
     if (dataLength == 0):
         return
 
-    id = 1
+    # The trace id follows the fragment id, both are packed as one header
+    (header, shift, trace) = (2, 0, 0)
+    if trace_id is not None:
+        (header, shift, trace) = (2 + tracing.TRACE_ID_SIZE, 8 * tracing.TRACE_ID_SIZE, trace_id)
+    size = FRAG_SIZE + 2 - header
 
-    while data:
-        if (len(data) <= FRAG_SIZE):
-            id = LAST_PACKET_ID
+    # Slice at offsets, re-slicing the remaining data would copy it per fragment
+    fragments = []
+    offset = 0
+    id = 1
 
-        fragments.append(id.to_bytes(2, 'big') + data[:FRAG_SIZE])
-        data = data[FRAG_SIZE:]
+    while dataLength - offset > size:
+        fragments.append((id << shift | trace).to_bytes(header, 'big') + data[offset:offset + size])
+        offset += size
         id += 1
+    fragments.append(((LAST_FRAGMENT | id) << shift | trace).to_bytes(header, 'big') + data[offset:])
 
     return fragments
 
-def tx(nrf_tx: RF24, packet: bytes):
+def aggregate(packets: list) -> bytes:
+    """ Pack several packets into one aggregate frame
+
+    Args:
+        packets (list): IP packets
+
+    Returns:
+        bytes: Aggregate frame
+    """
+    frame = bytearray([AGGREGATE_TAG])
+    for packet in packets:
+        frame += len(packet).to_bytes(2, 'big')
+        frame += packet
+    return bytes(frame)
+
+def deaggregate(frame: bytes) -> list:
+    """ Split a received frame back into IP packets
+
+    Args:
+        frame (bytes): Reassembled frame, an aggregate or a single packet
+
+    Returns:
+        list: IP packets
+    """
+    if not frame or frame[0] != AGGREGATE_TAG:
+        return [frame]
+    packets = []
+    offset = 1
+    while offset + 2 <= len(frame):
+        length = int.from_bytes(frame[offset:offset + 2], 'big')
+        offset += 2
+        if offset + length > len(frame):
+            logging.debug("Rx Radio --> Truncated aggregate, dropping the rest")
+            break
+        packets.append(frame[offset:offset + length])
+        offset += length
+    return packets
+
+def dequeue(timeout=None) -> Tuple[bytes, bytes]:
+    """ Take the next frame to transmit off tun_in_queue. Small packets
+    to the same next hop that are queued within AGGREGATION_WAIT are
+    aggregated into one frame.
+
+    Args:
+        timeout (float): Max wait for a first packet, 0 to not block
+
+    Raises:
+        queue.Empty: No packet was queued in time
+
+    Returns:
+        Tuple[bytes, bytes]: The frame and its TX address
+    """
+    global tx_pending
+    if tx_pending is not None:
+        packet, tx_pending = (tx_pending, None)
+    else:
+        packet = ack_filter.unwrap(tun_in_queue.get(timeout=timeout))
+    address = next_hop(packet)
+    if not AGGREGATION or len(packet) > AGGREGATE_MAX_PACKET:
+        trace_queued([packet])
+        return (packet, address)
+
+    packets = [packet]
+    size = 1 + 2 + len(packet)
+    deadline = time.monotonic() + AGGREGATION_WAIT
+    while size < AGGREGATE_MAX_SIZE:
+        try:
+            packet = ack_filter.unwrap(
+                tun_in_queue.get(timeout=max(0, deadline - time.monotonic())))
+        except queue.Empty:
+            break
+        if (len(packet) > AGGREGATE_MAX_PACKET or size + 2 + len(packet) > AGGREGATE_MAX_SIZE
+                or next_hop(packet) != address):
+            tx_pending = packet
+            break
+        packets.append(packet)
+        size += 2 + len(packet)
+
+    trace_queued(packets)
+    if len(packets) == 1:
+        return (packets[0], address)
+    logging.debug("Tx Radio --> Aggregated {} packets".format(len(packets)))
+    return (aggregate(packets), address)
+
+def trace_queued(packets: list):
+    """ Tracing: give the frame of packets a trace id, and trace their wait in tun_in_queue """
+    global tx_trace_id
+    if tracer is None:
+        return
+    tx_trace_id = tracer.new_id()
+    end = tracing.now()
+    for packet in packets:
+        stamp = tracer.taken(packet)
+        if stamp is not None:
+            tracer.span("tun_in_queue", tracing.TID_TUN_RX, stamp[0], end, tx_trace_id, size=len(packet))
+
+def tx(nrf_tx: RF24, packet: bytes, address: bytes = None):
     """ Transmit packet to the active writing pipe. Fragments bytes if needed.
 
     Args:
         packet (bytes): bytes to be transmitted
+        address (bytes): TX address, looked up with next_hop() if not given
 
     """
-    nrf_tx.listen = False
-    fragments = fragment(packet)
+    if address is None:
+        address = next_hop(packet)
+    if address is None:
+        logging.debug("Tx Radio --> No route for packet, dropping it")
+        return
+    if nrf_tx.listen or not nrf_tx.power:
+        nrf_tx.listen = False
+    trace_id = tx_trace_id if tracer is not None else None
+    fragments = fragment(packet, trace_id)
+
+    set_tx_address(nrf_tx, address)
 
     for frag in fragments:
+        if trace_id is not None:
+            send_start = tracing.now()
         # result = nrf_tx.write(frag)
-        result = nrf_tx.send(frag)
+        # send_only: in half-duplex mode the RX FIFO holds fragments of the receive path
+        result = nrf_tx.send(frag, send_only=True)
+        if trace_id is not None:
+            tracer.span("send", tracing.TID_RADIO_TX, send_start, tracing.now(), trace_id,
+                        fragment=int.from_bytes(frag[:2], 'big'), acked=bool(result))
+            if frag is fragments[0]:
+                tracer.flow(True, 0 if node_role == 0 else node_id, trace_id, tracing.TID_RADIO_TX, send_start)
+        if capture_tap is not None:
+            capture_tap.fragment(frag, capture.OUTBOUND, address_pipe(address), bool(result))
         if (result):
+            fragments_sent.inc()
             logging.debug("Tx Radio --> Frag sent id: {}".format(frag[:2]))
         else:
+            fragments_failed.inc()
             logging.debug("Tx Radio --> Frag not sent: {}".format(frag[:2]))
+        if METRICS_PORT is not None:
+            # One more SPI transaction, only made if metrics are served
+            arc = nrf_tx.last_tx_arc
+            tx_arc.observe(arc)
+            retransmits.inc(arc)
+
+def set_tx_address(nrf_tx: RF24, address: bytes):
+    """ Point the TX radio at an address, if it isn't already
+
+    Args:
+        address (bytes): TX address
+    """
+    global tx_address
+    if address != tx_address:
+        nrf_tx.open_tx_pipe(address)
+        tx_address = address
+
+def send_link_frame(nrf_tx: RF24, address: bytes, kind: int, arg: int = 0, payload: bytes = b'') -> bool:
+    """ Transmit a link-management frame
+
+    Args:
+        address (bytes): TX address
+        kind (int): Frame type, LINK_POLL or LINK_DONE
+        arg (int): One byte argument of the frame
+        payload (bytes): Further bytes of the frame
+
+    Returns:
+        bool: True if the frame was acknowledged
+    """
+    if nrf_tx.listen or not nrf_tx.power:
+        nrf_tx.listen = False
+    set_tx_address(nrf_tx, address)
+    frame = LINK_FRAME_ID.to_bytes(2, 'big') + bytes([kind, node_id, min(arg, 0xFF)]) + payload
+    result = bool(nrf_tx.send(frame, send_only=True))
+    if capture_tap is not None:
+        capture_tap.fragment(frame, capture.OUTBOUND, address_pipe(address), result)
+    return result
+
+def sync_clock(nrf_tx: RF24):
+    """ Tracing: send the peer a clock sync frame every CLOCK_SYNC_PERIOD """
+    global last_clock_sync
+    if tracer is None or STAR_MODE or time.monotonic() - last_clock_sync < CLOCK_SYNC_PERIOD:
+        return
+    last_clock_sync = time.monotonic()
+    send_link_frame(nrf_tx, tx_addresses[PIPE_LINK], LINK_CLOCK, payload=tracer.clock.frame())
+
+def handle_link_frame(frame: bytes, pipe_number: int):
+    """ Act on a received link-management frame
+
+    Args:
+        frame (bytes): Frame with the fragment id stripped
+        pipe_number (int): Pipe the frame arrived on
+    """
+    global uplink_count
+    global token_generation
+    kind = frame[0]
+    if kind == LINK_POLL:
+        uplink_grant.set()
+    elif kind == LINK_DONE and pipe_number == polled_node:
+        uplink_count = frame[2]
+        uplink_done.set()
+    elif kind == LINK_TOKEN:
+        if frame[2] == token_generation:
+            logging.debug("Half-duplex --> Dropping a duplicate token")
+        else:
+            token_generation = frame[2]
+            token.set()
+    elif kind == LINK_CLOCK and tracer is not None:
+        tracer.clock_received(frame[3:], tracing.now())
+    logging.debug("Rx Radio --> Link frame {} on pipe {}".format(kind, pipe_number))
+
+def poll_scheduler(nrf_tx: RF24):
+    """ Star mode base: transmit the downlink and poll the mobiles in turn.
+    Only the polled mobile transmits, so uplinks never collide.
+    """
+    global polled_node
+    idle_round = True
+    while do_run.is_set():
+        for node in range(1, STAR_MAX_NODES + 1):
+            check_radio(nrf_tx)
+            # Downlink, whatever is queued right now
+            while True:
+                try:
+                    tx(nrf_tx, *dequeue(timeout=0))
+                    idle_round = False
+                except queue.Empty:
+                    break
+            # Uplink slot of the node
+            polled_node = node
+            uplink_done.clear()
+            if send_link_frame(nrf_tx, pipe_address(star_stem(node), PIPE_LINK), LINK_POLL):
+                if uplink_done.wait(UPLINK_SLOT + UPLINK_GUARD) and uplink_count:
+                    idle_round = False
+            else:
+                logging.debug("Poll scheduler --> Node {} did not answer".format(node))
+            polled_node = None
+        if idle_round:
+            # Nothing moved during a whole round, wait for downlink traffic
+            try:
+                tx(nrf_tx, *dequeue(timeout=POLL_IDLE_PERIOD))
+            except queue.Empty:
+                pass
+        idle_round = True
+
+    print("Poll scheduler thread is shutting down")
+
+def uplink_tx(nrf_tx: RF24):
+    """ Star mode mobile: transmit queued packets when polled by the base """
+    while do_run.is_set():
+        check_radio(nrf_tx)
+        if not uplink_grant.wait(timeout=3):
+            continue
+        uplink_grant.clear()
+        deadline = time.monotonic() + UPLINK_SLOT
+        sent = 0
+        while time.monotonic() < deadline:
+            try:
+                tx(nrf_tx, *dequeue(timeout=0))
+                sent += 1
+            except queue.Empty:
+                break
+        send_link_frame(nrf_tx, tx_addresses[node_id], LINK_DONE, sent)
+
+    print("Uplink TX thread is shutting down")
+
+def half_duplex(nrf: RF24):
+    """ Half-duplex mode: transmit and receive on a single radio,
+    passing a token between base and mobile.
+    """
+    global token_generation
+    if node_role == 0:
+        token.set()
+    nrf.listen = True
+    last_token = time.monotonic()
+
+    buffers = {pipe: [] for pipe in range(6)}
+    while do_run.is_set():
+        check_radio(nrf)
+        if token.is_set():
+            # Burst, waiting a little for traffic if there is none queued
+            deadline = time.monotonic() + TOKEN_BURST
+            timeout = TOKEN_IDLE_HOLD
+            while time.monotonic() < deadline:
+                try:
+                    tx(nrf, *dequeue(timeout=timeout))
+                except queue.Empty:
+                    break
+                timeout = 0
+            sync_clock(nrf)
+            if send_link_frame(nrf, tx_addresses[PIPE_LINK], LINK_TOKEN, (token_generation + 1) & 0xFF):
+                token.clear()
+            else:
+                logging.debug("Half-duplex --> Peer did not take the token")
+            nrf.listen = True
+            last_token = time.monotonic()
+        elif nrf.available():
+            receive_fragment(nrf, buffers)
+            # The peer holds the token while it is sending
+            last_token = time.monotonic()
+        elif node_role == 0 and time.monotonic() - last_token > TOKEN_TIMEOUT:
+            logging.debug("Half-duplex --> Token lost, reclaiming it")
+            # The mobile may hold the next generation, pass it the one after
+            token_generation = (token_generation + 1) & 0xFF
+            token.set()
+
+    print("Half-duplex thread is shutting down")
 
 def radio_tx(nrf_tx: RF24):
     while do_run.is_set():
         #with cond_in:
             #while not len(tun_in_queue) > 0:
                 #cond_in.wait()
+        check_radio(nrf_tx)
+        sync_clock(nrf_tx)
         try:
-            packet = tun_in_queue.get(timeout=3)
-            tx(nrf_tx, packet)
+            (packet, address) = dequeue(timeout=3)
+            tx(nrf_tx, packet, address)
             logging.debug("Radio TX --> Transmitting a package:\n\t{}\n".format(packet))
         except queue.Empty:
             logging.debug("Radio Tx --> No packets found in queue")
@@ -219,10 +938,20 @@ def tun_rx():
     while do_run.is_set():
         logging.debug("[TUN RX] (Re)starting loop")
         logging.debug("[TUN RX] Attempting to read from TUN interface")
+        read_start = time.monotonic()
         (buffer, success) = tun.read(blocking=True,timeout=3)
+        tun_read_seconds.observe(time.monotonic() - read_start)
         logging.debug("[TUN RX] Attempt done")
-        if success:
-            tun_in_queue.put(buffer)
+        # A failed read leaves no buffer
+        if success and buffer:
+            if capture_tap is not None:
+                capture_tap.packet(buffer, capture.OUTBOUND)
+            if tracer is not None:
+                tracer.stamp(buffer)
+            if ACK_FILTER:
+                ack_filter.put(tun_in_queue, buffer)
+            else:
+                tun_in_queue.put(buffer)
             logging.debug("Rx Tun --> Got package from tun interface:\n\t{}\n".format(buffer))
             logging.debug("[TUN RX] Got package from tun interface: {}".format(buffer))
         else:
@@ -234,32 +963,85 @@ def tun_rx():
     print("TUN RX thread is shutting down")
 
 def radio_rx(nrf_rx:RF24):
-    """ Waits for incoming packet on reading pipe 
-    and forwards the packet to tun interface
+    """ Waits for incoming packet on reading pipes
+    and forwards the packet to tun interface.
+    Fragments are reassembled per pipe.
     """
     nrf_rx.listen = True
 
-    buffer = []
+    buffers = {pipe: [] for pipe in range(6)}
     while do_run.is_set():
+        check_radio(nrf_rx)
         # has_payload = nrf_rx.available()
         if nrf_rx.available():
-            # packet_size = nrf_rx.get_payload_length(nrf_rx.pipe)
-            payload_size, pipe_number = (nrf_rx.any(), nrf_rx.pipe)
-            fragment = nrf_rx.read(payload_size)
-            id = int.from_bytes(fragment[:2], 'big')
-            logging.debug("Rx Radio --> Frag received with id: {}, size: {}, pipe number: {}".format(id, payload_size, pipe_number))
+            receive_fragment(nrf_rx, buffers)
+    print("Radio RX thread is shutting down")
+
+def receive_fragment(nrf_rx: RF24, buffers: dict):
+    """ Read the next fragment from the RX FIFO. Forwards the packet
+    to tun interface once its last fragment is received.
 
-            buffer.append(fragment[2:])
+    Args:
+        buffers (dict): Fragments received so far, per pipe
+    """
+    # packet_size = nrf_rx.get_payload_length(nrf_rx.pipe)
+    payload_size, pipe_number = (nrf_rx.any(), nrf_rx.pipe)
+    fragment = nrf_rx.read(payload_size)
+    if tracer is not None:
+        arrival = tracing.now()
+    if capture_tap is not None:
+        capture_tap.fragment(fragment, capture.INBOUND, pipe_number, True)
+    id = int.from_bytes(fragment[:2], 'big')
+    logging.debug("Rx Radio --> Frag received with id: %s, size: %s, pipe number: %s", id, payload_size, pipe_number)
+
+    if id == LINK_FRAME_ID:
+        handle_link_frame(fragment[2:], pipe_number)
+        return
 
-            if id == LAST_PACKET_ID:  # packet is fragmented and this is the first fragment
-                packet = b''.join(buffer)
-                logging.debug("Rx Radio --> Packet received:\n\t{}\n".format(packet))
+    buffer = buffers.get(pipe_number)
+    if buffer is None:
+        logging.debug("Rx Radio --> Frag received on unused pipe: {}".format(pipe_number))
+        return
+    (last, index) = (bool(id & LAST_FRAGMENT), id & ~LAST_FRAGMENT)
+    if buffer and buffer[-1] is None:
+        # Rest of a packet that lost a fragment, wait for the next packet
+        if index != 1:
+            if last:
                 buffer.clear()
-                tun_out_queue.put(packet)
-                #with cond_out:
-                #    tun_out_queue.append(packet)
-                #    cond_out.notify()
-    print("Radio RX thread is shutting down")
+            return
+        buffer.clear()
+    elif index != len(buffer) + 1:
+        logging.debug("Rx Radio --> Missing fragment on pipe {}, dropping the packet".format(pipe_number))
+        reassembly_drops.inc()
+        buffer.clear()
+        if index != 1:
+            if not last:
+                buffer.append(None)
+            return
+    header = 2 + (tracing.TRACE_ID_SIZE if TRACING else 0)
+    if tracer is not None and not buffer:
+        tracer.rx_start[pipe_number] = arrival
+    buffer.append(fragment[header:])
+
+    if last:  # all fragments of the packet are in
+        packet = b''.join(buffer)
+        logging.debug("Rx Radio --> Packet received:\n\t%s\n", packet)
+        buffer.clear()
+        trace_id = None
+        if tracer is not None:
+            trace_id = int.from_bytes(fragment[2:header], 'big')
+            start = tracer.rx_start.pop(pipe_number, arrival)
+            tracer.span("reassembly", tracing.TID_RADIO_RX, start, tracing.now(), trace_id,
+                        pipe=pipe_number, size=len(packet))
+            sender = (pipe_number if STAR_MODE else 1) if node_role == 0 else 0
+            tracer.flow(False, sender, trace_id, tracing.TID_RADIO_RX, start)
+        for ip_packet in deaggregate(packet):
+            if tracer is not None:
+                tracer.stamp(ip_packet, trace_id)
+            tun_out_queue.put(ip_packet)
+        #with cond_out:
+        #    tun_out_queue.append(packet)
+        #    cond_out.notify()
     
 def tun_tx():
 
@@ -271,7 +1053,18 @@ def tun_tx():
         try:
             packet = tun_out_queue.get(timeout=3)
             print("[TUN TX] Got through tun out queue. Packet: {}".format(packet))
+            if capture_tap is not None:
+                capture_tap.packet(packet, capture.INBOUND)
+            stamp = tracer.taken(packet) if tracer is not None else None
+            if stamp is not None:
+                trace_write_start = tracing.now()
+            write_start = time.monotonic()
             (num_bytes, success) = tun.write(packet, blocking=True,timeout=3)
+            tun_write_seconds.observe(time.monotonic() - write_start)
+            if stamp is not None:
+                (queued, trace_id) = stamp
+                tracer.span("tun_out_queue", tracing.TID_TUN_TX, queued, trace_write_start, trace_id)
+                tracer.span("tun_write", tracing.TID_TUN_TX, trace_write_start, tracing.now(), trace_id)
             print("[TUN TX] Got through tun write")
             if success:
                 print("[TUN TX] Wrote a packet to tun interface:\n\t", packet, "\n")
@@ -299,26 +1092,71 @@ def process_update():
         end_time = time.monotonic_ns()
         time.sleep(PROCESS_UPDATE_PERIOD - ((end_time-start_time)/10e9))
 
+def http_request(curl: pycurl.Curl, url: str):
+    """ Request a control signal over HTTP, None if the request failed """
+    curl_buffer = BytesIO()
+    curl.setopt(curl.WRITEDATA, curl_buffer)
+    curl.setopt(curl.URL, url)
+    try:
+        curl.perform()
+    except pycurl.error as e:
+        logging.debug("Sampler --> HTTP request failed: {}".format(e))
+        return None
+    control_bytes = curl_buffer.getvalue()
+    if len(control_bytes) != 4:
+        return None
+    return struct.unpack('f', control_bytes)[0]
+
 def sampler():
     global water_height
     global control_signal
     logging.debug("Sampling thread starting")
+    udp_client = None
+    if CONTROL_TRANSPORT == "udp":
+        udp_client = UdpControlClient((CONTROL_SERVER_IP, CONTROL_SERVER_UDP_PORT), node_id, interface=TUN_IF_NAME)
     curl = pycurl.Curl()
-    url = 'http://'+CONTROL_SERVER_IP+':'+CONTROL_SERVER_PORT+'/'
+    # The node id picks the controller, the base NATs all mobiles to one IP
+    url = 'http://'+CONTROL_SERVER_IP+':'+CONTROL_SERVER_PORT+'/'+str(node_id)+'/'
     curl.setopt(curl.INTERFACE, TUN_IF_NAME)
+    # Reuse the keep-alive connection to the control server across samples
+    curl.setopt(curl.FORBID_REUSE, 0)
+    curl.setopt(curl.TCP_NODELAY, 1)
+    local_controller = None
+    degraded_samples = 0
+    if LOOKUP_TABLE is not None:
+        local_controller = LookupController(LOOKUP_TABLE)
+        # A server that doesn't answer within a sampling period is down
+        curl.setopt(curl.TIMEOUT_MS, PROCESS_SAMPLE_PERIOD * 1000)
     while do_run.is_set():
         start_time = time.monotonic_ns()
         print("Sampling loop start")
-        curl_buffer = BytesIO()
-        curl.setopt(curl.WRITEDATA, curl_buffer)
         # process_lock.acquire()
         water_height = process.get_water_height()
         # process_lock.release()
-        height_url = url + str(water_height)
-        curl.setopt(curl.URL, height_url)
-        curl.perform()
-        control_bytes = curl_buffer.getvalue()
-        control_signal_local = struct.unpack('f', control_bytes)[0]
+        if local_controller is not None:
+            # Run every sample, so the table sees the previous height when needed
+            local_controller.control(SET_POINT, water_height)
+        if degraded_samples > 0:
+            # Skip the radio round trip
+            degraded_samples -= 1
+            control_signal_local = local_controller.get_control_signal()
+        else:
+            request_start = time.monotonic()
+            if udp_client is not None:
+                control_signal_local = udp_client.request(water_height)
+            else:
+                control_signal_local = http_request(curl, url + str(water_height))
+            if control_signal_local is not None:
+                control_rtt_seconds.observe(time.monotonic() - request_start)
+            slow = time.monotonic() - request_start > DEGRADED_RTT
+            if local_controller is not None and (control_signal_local is None or slow):
+                logging.debug("Sampler --> Control server down or slow, controlling locally")
+                degraded_samples = DEGRADED_SAMPLES
+                if control_signal_local is None:
+                    control_signal_local = local_controller.get_control_signal()
+            if control_signal_local is None:
+                logging.debug("Sampler --> No reply from control server, keeping control signal")
+                control_signal_local = control_signal
         # control_signal_lock.acquire()
         control_signal = control_signal_local
         # control_signal_lock.release()
@@ -328,18 +1166,53 @@ def sampler():
     
     print("Sampling thread shutting down")
     curl.close()
+    if udp_client is not None:
+        udp_client.close()
+
+def create_radio_threads(role, rx_radio: RF24, tx_radio: RF24) -> list:
+    """ Threads driving the radios in the configured link mode, not started """
+    radio_tx_target = radio_tx
+    if STAR_MODE:
+        radio_tx_target = poll_scheduler if role == 0 else uplink_tx
+    if HALF_DUPLEX and not STAR_MODE:
+        return [threading.Thread(target=half_duplex, args=(rx_radio,))]
+    return [
+        threading.Thread(target=radio_rx, args=(rx_radio,)),
+        threading.Thread(target=radio_tx_target, args=(tx_radio,)),
+    ]
+
+def start_tracing(role, node=1):
+    """ Trace to TRACE_FILE, in the clock of the base """
+    global tracer
+    trace_node = 0 if role == 0 else node
+    tracer = tracing.Tracer(TRACE_FILE.format(trace_node), trace_node,
+                            "base" if role == 0 else "mobile {}".format(node), reference=role == 0)
+
+def start_capture(role, node=1):
+    """ Capture to CAPTURE_FILE """
+    global capture_tap
+    capture_tap = capture.Capture(CAPTURE_FILE.format(0 if role == 0 else node), fragments=CAPTURE_FRAGMENTS,
+                                  max_bytes=CAPTURE_MAX_BYTES, files=CAPTURE_FILES, if_name=TUN_IF_NAME)
 
 def main():
     logging.basicConfig(filename='tun_rx.log', level=logging.DEBUG) 
     node = int(input("Select node role. 0:Base 1:Mobile :"))
-    rx_radio, tx_radio = setup(node)
-    radio_rx_thread = threading.Thread(target=radio_rx, args=(rx_radio,))
-    radio_tx_thread = threading.Thread(target=radio_tx, args=(tx_radio,))
+    mobile_id = 1
+    if STAR_MODE and node == 1:
+        mobile_id = int(input("Select mobile node id. 1-{} :".format(STAR_MAX_NODES)))
+    rx_radio, tx_radio = setup(node, mobile_id)
+    if TRACING:
+        start_tracing(node, mobile_id)
+    if CAPTURE_FILE is not None:
+        start_capture(node, mobile_id)
+    if METRICS_PORT is not None and metrics.serve(link_metrics, METRICS_PORT, METRICS_HOST) is None:
+        logging.warning("Could not serve metrics on port {}".format(METRICS_PORT))
+    radio_threads = create_radio_threads(node, rx_radio, tx_radio)
     tun_rx_thread = threading.Thread(target=tun_rx, args=())
     tun_tx_thread = threading.Thread(target=tun_tx, args=())
     do_run.set()
-    radio_rx_thread.start()
-    radio_tx_thread.start()
+    for radio_thread in radio_threads:
+        radio_thread.start()
     time.sleep(0.05)
     tun_rx_thread.start()
     tun_tx_thread.start()
@@ -358,8 +1231,8 @@ def main():
             do_run.clear()
 
             # Join all threads
-            radio_rx_thread.join()
-            radio_tx_thread.join()
+            for radio_thread in radio_threads:
+                radio_thread.join()
             tun_rx_thread.join()
             tun_tx_thread.join()
             if node == 1:
@@ -381,6 +1254,14 @@ def main():
 
             # Close TUN interface
             tun.close()
+            if tracer is not None:
+                tracer.close()
+            if capture_tap is not None:
+                capture_tap.close()
+                if capture_tap.dropped:
+                    print("[MAIN] Capture dropped {} packets".format(capture_tap.dropped))
+            if SPI_PROFILE:
+                print("[MAIN] SPI transactions of the radios:\n" + spi_profiler.report())
             print("Main thread shutting down")
 
             break
@@ -0,0 +1,471 @@
+import contextlib
+import io
+import os
+import queue
+import socket
+import threading
+import unittest
+from unittest import mock
+
+import application
+import rf24_emulator
+import tracing
+from rf24 import RF24
+from rf24_emulator import EmulatedRadio, Ether
+
+"""
+    Tests of the packet pipeline that need no radio or TUN device:
+        python3 -m unittest application_test
+"""
+
+def ipv4(source: str, destination: str, size: int = 40) -> bytes:
+    """ IPv4 packet of size bytes between two addresses, with no valid checksum """
+    return (b"\x45" + bytes(11) + socket.inet_aton(source) + socket.inet_aton(destination)
+            + os.urandom(size - 20))
+
+class AggregationTest(unittest.TestCase):
+    def test_round_trip(self):
+        packets = [os.urandom(size) for size in (1, 20, 40, 80)]
+        self.assertEqual(application.deaggregate(application.aggregate(packets)), packets)
+
+    def test_mixed_sizes(self):
+        # Lengths past one byte, and up to the MTU, keep their two byte prefix
+        packets = [b"\x45" + os.urandom(size) for size in (0, 254, 255, 256, 1499)] + [b""]
+        self.assertEqual(application.deaggregate(application.aggregate(packets)), packets)
+
+    def test_tag_and_length_prefixes(self):
+        frame = application.aggregate([b"\x45ab", b"\x45c"])
+        self.assertEqual(frame, bytes([application.AGGREGATE_TAG]) + b"\x00\x03\x45ab\x00\x02\x45c")
+
+    def test_single_packet_passes_through(self):
+        # IPv4 and IPv6 packets never start with the aggregate tag
+        for packet in (b"\x45" + os.urandom(39), b"\x60" + os.urandom(59)):
+            self.assertEqual(application.deaggregate(packet), [packet])
+
+    def test_empty_frame(self):
+        self.assertEqual(application.deaggregate(b""), [b""])
+        self.assertEqual(application.deaggregate(application.aggregate([])), [])
+
+    def test_truncated_aggregate_keeps_whole_packets(self):
+        frame = application.aggregate([b"\x45" * 10, b"\x45" * 10])
+        self.assertEqual(application.deaggregate(frame[:-1]), [b"\x45" * 10])
+
+class DequeueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        addresses = {pipe: application.pipe_address(b"Node", pipe) for pipe in range(1, 4)}
+        for patch in (mock.patch.object(application, "tun_in_queue", self.queue),
+                      mock.patch.object(application, "tx_pending", None),
+                      mock.patch.object(application, "tx_addresses", addresses),
+                      mock.patch.object(application, "control_server_addr", socket.inet_aton("10.0.0.9"))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def dequeue(self, packets: list) -> list:
+        """ Frames taken off the queue after queueing packets, deaggregated """
+        for packet in packets:
+            self.queue.put(packet)
+        frames = []
+        while True:
+            try:
+                frames.append(application.deaggregate(application.dequeue(timeout=0)[0]))
+            except queue.Empty:
+                return frames
+
+    def test_mixed_sizes(self):
+        small = [ipv4("125.100.1.2", "10.0.0.8", size) for size in (20, 40, 80)]
+        large = ipv4("125.100.1.2", "10.0.0.8", 81)
+        self.assertEqual(self.dequeue(small + [large] + small[:2]), [small, [large], small[:2]])
+
+    def test_size_limit(self):
+        packets = [ipv4("125.100.1.2", "10.0.0.8", 80) for _ in range(5)]
+        frames = self.dequeue(packets)
+        self.assertEqual(sum(frames, []), packets)
+        self.assertGreater(len(frames), 1)
+        self.assertTrue(all(len(application.aggregate(frame)) <= application.AGGREGATE_MAX_SIZE for frame in frames))
+
+    def test_classes_are_not_mixed(self):
+        (control, bulk) = (ipv4("125.100.1.2", "10.0.0.9"), ipv4("125.100.1.2", "10.0.0.8"))
+        self.assertEqual(self.dequeue([control, control, bulk, control]), [[control, control], [bulk], [control]])
+
+    def test_aggregation_off(self):
+        packets = [ipv4("125.100.1.2", "10.0.0.8") for _ in range(3)]
+        with mock.patch.object(application, "AGGREGATION", False):
+            self.assertEqual(self.dequeue(packets), [[packet] for packet in packets])
+
+class FragmentSource(object):
+    """ Stands in for the RX radio of receive_fragment() """
+    def __init__(self, fragments: list, pipe: int = 1):
+        self.fragments = list(fragments)
+        self.pipe = pipe
+
+    def any(self) -> int:
+        return len(self.fragments[0])
+
+    def read(self, length: int) -> bytearray:
+        return bytearray(self.fragments.pop(0))
+
+class FragmentationTest(unittest.TestCase):
+    def setUp(self):
+        self.buffers = {pipe: [] for pipe in range(6)}
+        self.drops = application.reassembly_drops.value()
+        while not application.tun_out_queue.empty():
+            application.tun_out_queue.get_nowait()
+
+    def receive(self, fragments: list) -> list:
+        """ Packets forwarded to the TUN interface after receiving fragments """
+        radio = FragmentSource(fragments)
+        while radio.fragments:
+            application.receive_fragment(radio, self.buffers)
+        packets = []
+        while not application.tun_out_queue.empty():
+            packets.append(application.tun_out_queue.get_nowait())
+        return packets
+
+    def receive_on(self, fragment: bytes, pipe: int):
+        application.receive_fragment(FragmentSource([fragment], pipe), self.buffers)
+
+    def dropped(self) -> int:
+        return application.reassembly_drops.value() - self.drops
+
+    def test_fragment_ids(self):
+        fragments = application.fragment(b"\x45" + bytes(99))
+        ids = [int.from_bytes(fragment[:2], "big") for fragment in fragments]
+        self.assertEqual(ids, [1, 2, 3, application.LAST_FRAGMENT | 4])
+        self.assertTrue(all(len(fragment) <= application.FRAG_SIZE + 2 for fragment in fragments))
+        self.assertEqual(application.fragment(b"\x45"), [(application.LAST_FRAGMENT | 1).to_bytes(2, "big") + b"\x45"])
+
+    def test_round_trip(self):
+        packets = [b"\x45" + os.urandom(size) for size in (0, 29, 30, 200, 1399)]
+        fragments = [fragment for packet in packets for fragment in application.fragment(packet)]
+        self.assertEqual(self.receive(fragments), packets)
+        self.assertEqual(self.dropped(), 0)
+
+    def test_round_trip_with_trace_ids(self):
+        packets = [b"\x45" + os.urandom(size) for size in (10, 100)]
+        fragments = [application.fragment(packet, trace_id) for (packet, trace_id) in zip(packets, (0xFFFF, 0))]
+        headers = [int.from_bytes(fragment[:2 + tracing.TRACE_ID_SIZE], "big") for fragment in fragments[1]]
+        self.assertEqual(headers, [1 << 16, 2 << 16, 3 << 16, (application.LAST_FRAGMENT | 4) << 16])
+        self.assertEqual(fragments[0][0][:4], (application.LAST_FRAGMENT | 1).to_bytes(2, "big") + b"\xff\xff")
+        with mock.patch.object(application, "TRACING", True):
+            self.assertEqual(self.receive(sum(fragments, [])), packets)
+
+    def test_gap_drops_only_that_packet(self):
+        packets = [b"\x45" + os.urandom(100) for _ in range(3)]
+        fragments = [application.fragment(packet) for packet in packets]
+        del fragments[1][1]
+        self.assertEqual(self.receive(sum(fragments, [])), [packets[0], packets[2]])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_lost_fragment_before_the_last(self):
+        packets = [b"\x45" + os.urandom(100) for _ in range(2)]
+        fragments = [application.fragment(packet) for packet in packets]
+        del fragments[0][-2]
+        self.assertEqual(self.receive(sum(fragments, [])), [packets[1]])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_lost_first_fragment(self):
+        packets = [b"\x45" + os.urandom(100) for _ in range(2)]
+        fragments = [application.fragment(packet) for packet in packets]
+        del fragments[0][0]
+        self.assertEqual(self.receive(sum(fragments, [])), [packets[1]])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_lost_last_fragment(self):
+        packets = [b"\x45" + os.urandom(100), b"\x45" + os.urandom(10)]
+        fragments = [application.fragment(packet) for packet in packets]
+        del fragments[0][-1]
+        self.assertEqual(self.receive(sum(fragments, [])), [packets[1]])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_pipes_reassemble_separately(self):
+        (bulk, control) = (b"\x45" + os.urandom(100), b"\x45" + os.urandom(100))
+        (bulk_fragments, control_fragments) = (application.fragment(bulk), application.fragment(control))
+        for (bulk_fragment, control_fragment) in zip(bulk_fragments, control_fragments):
+            self.receive_on(bulk_fragment, 1)
+            self.receive_on(control_fragment, 2)
+        self.assertEqual(self.receive([]), [bulk, control])
+
+    def test_interleaved_pipes(self):
+        packets = {pipe: [b"\x45" + os.urandom(size) for size in (150, 10, 70)] for pipe in (1, 2, 3)}
+        queues = {pipe: [fragment for packet in packets[pipe] for fragment in application.fragment(packet)]
+                  for pipe in packets}
+        # Drop a middle fragment of the first packet on pipe 2
+        del queues[2][2]
+        received = {pipe: [] for pipe in packets}
+        while any(queues.values()):
+            for pipe in (3, 1, 2, 1):
+                if queues[pipe]:
+                    self.receive_on(queues[pipe].pop(0), pipe)
+                    received[pipe] += self.receive([])
+        self.assertEqual(received[1], packets[1])
+        self.assertEqual(received[2], packets[2][1:])
+        self.assertEqual(received[3], packets[3])
+        self.assertEqual(self.dropped(), 1)
+
+    def test_unused_pipe_is_ignored(self):
+        del self.buffers[4]
+        for fragment in application.fragment(b"\x45" + bytes(50)):
+            self.receive_on(fragment, 4)
+        self.assertEqual(self.receive([]), [])
+
+class ClassifyTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(application, "control_server_addr", socket.inet_aton("10.0.0.9"))
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_control_traffic_both_ways(self):
+        self.assertEqual(application.classify(ipv4("125.100.1.2", "10.0.0.9")), application.PIPE_CONTROL)
+        self.assertEqual(application.classify(ipv4("10.0.0.9", "125.100.1.2")), application.PIPE_CONTROL)
+
+    def test_everything_else_is_bulk(self):
+        self.assertEqual(application.classify(ipv4("125.100.1.2", "10.0.0.8")), application.PIPE_BULK)
+        self.assertEqual(application.classify(b"\x60" + bytes(39)), application.PIPE_BULK)
+        self.assertEqual(application.classify(b"\x45"), application.PIPE_BULK)
+
+    def test_next_hop_is_the_pipe_of_the_class(self):
+        addresses = {pipe: application.pipe_address(b"Node", pipe) for pipe in range(1, 4)}
+        with mock.patch.object(application, "tx_addresses", addresses):
+            self.assertEqual(application.next_hop(ipv4("125.100.1.2", "10.0.0.9")), addresses[application.PIPE_CONTROL])
+            self.assertEqual(application.next_hop(ipv4("125.100.1.2", "10.0.0.8")), addresses[application.PIPE_BULK])
+
+class StarTest(unittest.TestCase):
+    def setUp(self):
+        self.uplink_grant = threading.Event()
+        self.uplink_done = threading.Event()
+        for patch in (mock.patch.object(application, "STAR_MODE", True),
+                      mock.patch.object(application, "control_server_addr", socket.inet_aton("10.0.0.9")),
+                      mock.patch.object(application, "uplink_grant", self.uplink_grant),
+                      mock.patch.object(application, "uplink_done", self.uplink_done),
+                      mock.patch.object(application, "polled_node", None),
+                      mock.patch.object(application, "uplink_count", 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_stems_differ_per_node(self):
+        stems = [application.star_stem(node) for node in range(1, application.STAR_MAX_NODES + 1)]
+        self.assertTrue(all(len(stem) == 4 for stem in stems))
+        self.assertEqual(len(set(stems)), len(stems))
+
+    def test_route(self):
+        for node in range(1, application.STAR_MAX_NODES + 1):
+            self.assertEqual(application.route(ipv4("10.0.0.9", application.node_ip(node))), node)
+        self.assertEqual(application.node_ip(1), "125.100.1.2")
+        self.assertIsNone(application.route(ipv4("10.0.0.9", application.BASE_IP)))
+        self.assertIsNone(application.route(ipv4("10.0.0.9", application.node_ip(application.STAR_MAX_NODES + 1))))
+        self.assertIsNone(application.route(b"\x60" + bytes(39)))
+        self.assertIsNone(application.route(b"\x45" + bytes(10)))
+
+    def test_next_hop_of_the_base(self):
+        with mock.patch.object(application, "node_role", 0):
+            self.assertEqual(application.next_hop(ipv4("10.0.0.9", application.node_ip(3))),
+                             application.pipe_address(application.star_stem(3), application.PIPE_CONTROL))
+            self.assertEqual(application.next_hop(ipv4("10.0.0.8", application.node_ip(2))),
+                             application.pipe_address(application.star_stem(2), application.PIPE_BULK))
+            self.assertIsNone(application.next_hop(ipv4("10.0.0.9", "10.0.0.8")))
+
+    def test_next_hop_of_a_mobile(self):
+        with mock.patch.multiple(application, node_role=1, node_id=2, tx_addresses={2: b"2Base"}):
+            self.assertEqual(application.next_hop(ipv4(application.node_ip(2), "10.0.0.9")), b"2Base")
+
+    def test_poll(self):
+        application.handle_link_frame(bytes([application.LINK_POLL, 0, 0]), application.PIPE_LINK)
+        self.assertTrue(self.uplink_grant.is_set())
+
+    def test_done_only_from_the_polled_node(self):
+        application.polled_node = 2
+        application.handle_link_frame(bytes([application.LINK_DONE, 3, 7]), 3)
+        self.assertFalse(self.uplink_done.is_set())
+        application.handle_link_frame(bytes([application.LINK_DONE, 2, 7]), 2)
+        self.assertTrue(self.uplink_done.is_set())
+        self.assertEqual(application.uplink_count, 7)
+
+class PipeAddressTest(unittest.TestCase):
+    def test_round_trip(self):
+        for stem in (b"Node", application.star_stem(1)):
+            for pipe in range(6):
+                address = application.pipe_address(stem, pipe)
+                self.assertEqual(len(address), 5)
+                self.assertEqual(application.address_pipe(address), pipe)
+
+    def test_pipes_differ_in_the_first_byte(self):
+        self.assertEqual(application.pipe_address(b"Node", 2)[1:], application.pipe_address(b"Node", 3)[1:])
+
+class TokenTest(unittest.TestCase):
+    """ Half-duplex token passing between two emulated radios, this process being the receiver """
+    def setUp(self):
+        ether = Ether()
+        (sender, receiver) = (EmulatedRadio(ether), EmulatedRadio(ether))
+        self.sender = RF24(sender.spi, 0, sender.ce, 0, 0)
+        self.receiver = RF24(receiver.spi, 0, receiver.ce, 0, 0)
+        self.address = application.pipe_address(b"Node", application.PIPE_LINK)
+        self.receiver.open_rx_pipe(application.PIPE_LINK, self.address)
+        self.receiver.listen = True
+        self.lose_acks = False
+        ack = ether.ack
+        ether.ack = lambda tx, ack_time: ack(tx, None if self.lose_acks else ack_time)
+        self.token = threading.Event()
+        for patch in (mock.patch.object(application, "token", self.token),
+                      mock.patch.object(application, "token_generation", 0),
+                      mock.patch.object(application, "tx_address", None)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def pass_token(self, generation: int) -> bool:
+        acked = application.send_link_frame(self.sender, self.address, application.LINK_TOKEN, generation)
+        buffers = {pipe: [] for pipe in range(6)}
+        while self.receiver.available():
+            application.receive_fragment(self.receiver, buffers)
+        return acked
+
+    def test_token_is_taken(self):
+        self.assertTrue(self.pass_token(1))
+        self.assertTrue(self.token.is_set())
+        self.assertEqual(application.token_generation, 1)
+
+    def test_retransmission_after_a_lost_ack_is_dropped(self):
+        self.lose_acks = True
+        self.assertFalse(self.pass_token(1))
+        self.assertTrue(self.token.is_set())
+        # The receiver passes the token on before the sender retransmits it
+        self.token.clear()
+        self.lose_acks = False
+        self.assertTrue(self.pass_token(1))
+        self.assertFalse(self.token.is_set())
+        self.assertTrue(self.pass_token(2))
+        self.assertTrue(self.token.is_set())
+
+    def test_generation_wraps(self):
+        application.token_generation = 0xFF
+        self.assertTrue(self.pass_token(0))
+        self.assertTrue(self.token.is_set())
+
+class SamplerTest(unittest.TestCase):
+    def setUp(self):
+        self.table = mock.Mock()
+        self.table.get_control_signal.return_value = 0.5
+        self.http_request = mock.Mock(return_value=None)
+        for patch in (mock.patch.multiple(application, LOOKUP_TABLE="table", CONTROL_TRANSPORT="http",
+                                          PROCESS_SAMPLE_PERIOD=0.001, control_signal=0.1,
+                                          http_request=self.http_request,
+                                          LookupController=mock.Mock(return_value=self.table),
+                                          process=mock.Mock(**{"get_water_height.return_value": 0.01})),
+                      contextlib.redirect_stdout(io.StringIO())):
+            patch.__enter__()
+            self.addCleanup(patch.__exit__, None, None, None)
+
+    def sample(self, samples: int):
+        """ Run the sampler for a number of samples """
+        with mock.patch.object(application, "do_run", mock.Mock(**{"is_set.side_effect": [True] * samples + [False]})):
+            application.sampler()
+
+    def test_healthy_server(self):
+        self.http_request.return_value = 0.25
+        self.sample(3)
+        self.assertEqual(self.http_request.call_count, 3)
+        self.assertEqual(application.control_signal, 0.25)
+
+    def test_down_server_is_skipped_for_a_while(self):
+        self.sample(application.DEGRADED_SAMPLES + 2)
+        self.assertEqual(self.http_request.call_count, 2)
+        self.assertEqual(application.control_signal, 0.5)
+        # The table sees every sample, also while the server is asked
+        self.assertEqual(self.table.control.call_count, application.DEGRADED_SAMPLES + 2)
+
+    def test_slow_answer_is_used_once(self):
+        self.http_request.return_value = 0.25
+        with mock.patch.object(application, "DEGRADED_RTT", -1):
+            self.sample(1)
+            self.assertEqual(application.control_signal, 0.25)
+            self.http_request.reset_mock()
+            # The next sample is controlled locally
+            self.sample(2)
+        self.assertEqual(self.http_request.call_count, 1)
+        self.assertEqual(application.control_signal, 0.5)
+
+    def test_without_a_table_the_signal_is_kept(self):
+        with mock.patch.object(application, "LOOKUP_TABLE", None):
+            self.sample(3)
+        self.assertEqual(self.http_request.call_count, 3)
+        self.assertEqual(application.control_signal, 0.1)
+
+class CountingSpiDevTest(unittest.TestCase):
+    def setUp(self):
+        radio = EmulatedRadio(Ether())
+        self.nrf = RF24(application.CountingSpiDev(radio.spi), 0, radio.ce, 0, 0)
+        self.count = application.spi_transactions.value()
+
+    def counted(self) -> int:
+        return application.spi_transactions.value() - self.count
+
+    def test_counts_single_transactions(self):
+        self.nrf.update()
+        self.nrf.channel = 100
+        self.assertEqual(self.counted(), 2)
+
+    def test_counts_every_batched_write(self):
+        with self.nrf.batch():
+            self.nrf.channel = 100
+            self.nrf.arc = 5
+            self.nrf.ard = 500
+        self.assertEqual(self.counted(), 3)
+
+    def test_counts_batches_sent_in_one_ioctl(self):
+        self.nrf._spi._spi.spi.fileno = lambda: 3
+        with mock.patch("cpy_spidev._ioc_message", return_value=bytearray(2)) as ioc_message:
+            with self.nrf.batch():
+                self.nrf.channel = 100
+                self.nrf.arc = 5
+        self.assertEqual(ioc_message.call_count, 1)
+        self.assertEqual(self.counted(), 2)
+
+class WatchdogTest(unittest.TestCase):
+    def setUp(self):
+        self.radio = EmulatedRadio(Ether())
+        self.nrf = RF24(self.radio.spi, 0, self.radio.ce, 0, 0)
+        self.nrf.open_tx_pipe(b"1Node")
+        self.nrf.listen = False
+        self.nrf.tx_timeout = 0.05
+        self.timeouts = application.tx_timeouts.value()
+        self.resets = application.radio_resets.value()
+
+    def check(self):
+        application.last_radio_check.pop(self.nrf, None)
+        application.check_radio(self.nrf)
+
+    def test_healthy_radio_is_left_alone(self):
+        self.check()
+        self.assertEqual(application.radio_resets.value(), self.resets)
+
+    def test_tx_timeouts_reset_the_radio(self):
+        ce = self.nrf._ce_pin
+        self.nrf._ce_pin = mock.Mock(value=False)
+        self.assertFalse(self.nrf.send(b"hello"))
+        self.nrf._ce_pin = ce
+        with self.assertLogs(level="WARNING") as logs:
+            self.check()
+        self.assertIn("TX timeouts: 1", logs.output[0])
+        self.assertEqual(application.tx_timeouts.value(), self.timeouts + 1)
+        self.assertEqual(application.radio_resets.value(), self.resets + 1)
+        # Timeouts are counted once
+        self.check()
+        self.assertEqual(application.tx_timeouts.value(), self.timeouts + 1)
+        self.assertEqual(application.radio_resets.value(), self.resets + 1)
+        self.assertTrue(self.nrf.send(b"hello", ask_no_ack=True))
+
+    def test_lost_configuration_is_restored(self):
+        self.radio.registers[rf24_emulator.RF_CH] ^= 1
+        with self.assertLogs(level="WARNING"):
+            self.check()
+        self.assertEqual(application.radio_resets.value(), self.resets + 1)
+        self.assertEqual(self.nrf.verify(), [])
+
+    def test_checks_once_per_period(self):
+        application.check_radio(self.nrf)
+        self.radio.registers[rf24_emulator.RF_CH] ^= 1
+        application.check_radio(self.nrf)
+        self.assertEqual(application.radio_resets.value(), self.resets)
+
+if __name__ == "__main__":
+    unittest.main()
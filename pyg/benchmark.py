@@ -0,0 +1,386 @@
+import argparse
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from typing import List, Optional
+
+"""
+    End-to-end benchmark of the LongG link: UDP and TCP goodput, packets
+    per second, RTT percentiles and CPU time per delivered byte, for a
+    range of packet sizes. Results are written as JSON.
+
+    Emulated radios, everything on one host (needs root):
+        python3 benchmark.py emulated --output results.json
+    This puts base and mobile in network namespaces of their own, each
+    running the application pipelines over rf24_emulator radios whose
+    ether is carried by a veth pair.
+
+    Real radios, with application.py already running on both nodes:
+        base:   python3 benchmark.py serve
+        mobile: python3 benchmark.py run --target 125.100.1.1 --cpu-pids <pid of application.py>
+"""
+
+UDP_SINK_PORT = 9001
+TCP_SINK_PORT = 9002
+ECHO_PORT = 9003
+
+""" UDP sink messages: run nonce, test id and sequence number, then padding. Test ids restart with every run """
+UDP_HEADER = struct.Struct("!III")
+UDP_END = 0xFFFFFFFF # Sequence number asking the sink for the count of a test
+UDP_COUNT = struct.Struct("!IIQdd") # Test id, packets, bytes, first and last arrival
+
+""" Emulated setup """
+NAMESPACES = ("longg-base", "longg-mobile")
+VETH = ("longg-ether0", "longg-ether1")
+ETHER_HOSTS = ("10.254.0.1", "10.254.0.2")
+BASE_IP = "125.100.1.1"
+
+""" Time for a node to bring up its TUN interface and radios """
+NODE_STARTUP = 3.0 # s
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def cpu_seconds(pids: List[int]) -> float:
+    """ User and system time of processes so far, in s """
+    total = 0
+    for pid in pids:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+""" Servers, on the base side """
+
+def udp_sink():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", UDP_SINK_PORT))
+    counts = {}
+    while True:
+        (data, address) = sock.recvfrom(65535)
+        now = time.monotonic()
+        if len(data) < UDP_HEADER.size:
+            continue
+        (nonce, test, seq) = UDP_HEADER.unpack_from(data)
+        (packets, size, first, last) = counts.get((nonce, test), (0, 0, now, now))
+        if seq == UDP_END:
+            sock.sendto(UDP_COUNT.pack(test, packets, size, first, last), address)
+            continue
+        counts[(nonce, test)] = (packets + 1, size + len(data), first, now)
+
+def tcp_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("0.0.0.0", TCP_SINK_PORT))
+    server.listen()
+    while True:
+        (connection, _) = server.accept()
+        received = 0
+        with connection:
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                received += len(data)
+            connection.sendall(struct.pack("!Q", received))
+
+def echo_server():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", ECHO_PORT))
+    while True:
+        (data, address) = sock.recvfrom(65535)
+        sock.sendto(data, address)
+
+def serve():
+    for server in (udp_sink, tcp_sink):
+        threading.Thread(target=server, daemon=True).start()
+    echo_server()
+
+""" Clients, on the mobile side """
+
+def udp_test(target: str, nonce: int, test: int, size: int, duration: float, rate: float, settle: float) -> dict:
+    """ Offer UDP packets of size bytes at rate bit/s, and count what arrives """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    payload = bytearray(max(size, UDP_HEADER.size))
+    interval = 8 * len(payload) / rate
+    sent = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        UDP_HEADER.pack_into(payload, 0, nonce, test, sent)
+        sock.sendto(payload, (target, UDP_SINK_PORT))
+        sent += 1
+        delay = start + sent * interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    # Let the link drain what is still queued
+    time.sleep(settle)
+    sock.settimeout(1.0)
+    count = None
+    for _ in range(10):
+        sock.sendto(UDP_HEADER.pack(nonce, test, UDP_END), (target, UDP_SINK_PORT))
+        try:
+            count = UDP_COUNT.unpack(sock.recv(UDP_COUNT.size))
+            break
+        except socket.timeout:
+            continue
+    sock.close()
+    if count is None:
+        return {"test": "udp", "size": size, "sent": sent, "error": "no count from sink"}
+    (_, packets, received, first, last) = count
+    span = last - first
+    return {
+        "test": "udp", "size": size, "offered_bps": rate, "sent": sent, "received": packets,
+        "loss": 1 - packets / sent if sent else None,
+        "goodput_bps": 8 * received / span if span > 0 else None,
+        "pps": packets / span if span > 0 else None,
+        "bytes": received,
+    }
+
+def tcp_test(target: str, size: int, duration: float) -> dict:
+    """ Send over one TCP connection in writes of size bytes """
+    sock = socket.create_connection((target, TCP_SINK_PORT), timeout=duration + 60)
+    payload = bytes(size)
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+    reply = b""
+    while len(reply) < 8:
+        data = sock.recv(8 - len(reply))
+        if not data:
+            break
+        reply += data
+    elapsed = time.monotonic() - start
+    sock.close()
+    if len(reply) < 8:
+        return {"test": "tcp", "size": size, "error": "no count from sink"}
+    received = struct.unpack("!Q", reply)[0]
+    return {"test": "tcp", "size": size, "goodput_bps": 8 * received / elapsed, "bytes": received}
+
+def rtt_test(target: str, size: int, probes: int, interval: float, timeout: float) -> dict:
+    """ Round trip times of UDP echo probes of size bytes """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rtts = []
+    for probe in range(probes):
+        payload = struct.pack("!I", probe) + bytes(max(0, size - 4))
+        sent = time.monotonic()
+        sock.sendto(payload, (target, ECHO_PORT))
+        deadline = sent + timeout
+        while time.monotonic() < deadline:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            try:
+                data = sock.recv(65535)
+            except socket.timeout:
+                break
+            if data[:4] == payload[:4]:
+                rtts.append(time.monotonic() - sent)
+                break
+        time.sleep(max(0.0, sent + interval - time.monotonic()))
+    sock.close()
+    to_ms = lambda value: None if value is None else 1000 * value
+    return {
+        "test": "rtt", "size": size, "probes": probes, "lost": probes - len(rtts),
+        "p50_ms": to_ms(percentile(rtts, 0.5)), "p90_ms": to_ms(percentile(rtts, 0.9)),
+        "p99_ms": to_ms(percentile(rtts, 0.99)), "max_ms": to_ms(max(rtts, default=None)),
+    }
+
+def run(args) -> dict:
+    results = []
+    nonce = random.getrandbits(32)
+    test = 0
+    for size in args.sizes:
+        for kind in args.tests:
+            cpu_before = cpu_seconds(args.cpu_pids)
+            test += 1
+            try:
+                if kind == "udp":
+                    result = udp_test(args.target, nonce, test, size, args.duration, args.udp_rate, args.settle)
+                elif kind == "tcp":
+                    result = tcp_test(args.target, size, args.duration)
+                else:
+                    result = rtt_test(args.target, size, args.probes, args.probe_interval, args.probe_timeout)
+            except OSError as e:
+                result = {"test": kind, "size": size, "error": str(e)}
+            if args.cpu_pids and result.get("bytes"):
+                cpu = cpu_seconds(args.cpu_pids) - cpu_before
+                result["cpu_s"] = cpu
+                result["cpu_ns_per_byte"] = 1e9 * cpu / result["bytes"]
+            logging.info(json.dumps(result))
+            results.append(result)
+    return {
+        "version": 1,
+        "timestamp": time.time(),
+        "parameters": {
+            "target": args.target, "sizes": args.sizes, "tests": args.tests,
+            "duration": args.duration, "udp_rate": args.udp_rate, "probes": args.probes,
+        },
+        "results": results,
+    }
+
+def write_results(report: dict, output: str):
+    if output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(output, "w") as out:
+        json.dump(report, out, indent=2)
+
+""" Emulated setup """
+
+def node(args):
+    """ Run the pipelines of one node over emulated radios until SIGTERM """
+    import application
+    application.RADIO_BACKEND = "emulator"
+    application.EMULATOR_HOSTS = {0: ETHER_HOSTS[0], 1: ETHER_HOSTS[1]}
+    application.EMULATOR_LOSS = args.loss
+    application.EMULATOR_LATENCY = args.latency
+    application.EMULATOR_COLLISIONS = not args.no_collisions
+    application.TRACING = args.trace
+    if args.capture:
+        application.CAPTURE_FILE = "capture_node{}.pcapng"
+        application.CAPTURE_FRAGMENTS = True
+    logging.basicConfig(level=logging.WARNING)
+    (rx_radio, tx_radio) = application.setup(args.role)
+    if args.trace:
+        application.start_tracing(args.role)
+    if args.capture:
+        application.start_capture(args.role)
+    threads = application.create_radio_threads(args.role, rx_radio, tx_radio)
+    threads += [threading.Thread(target=application.tun_rx), threading.Thread(target=application.tun_tx)]
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    application.do_run.set()
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    application.do_run.clear()
+    for thread in threads:
+        thread.join()
+    application.tun.close()
+    if application.tracer is not None:
+        application.tracer.close()
+    if application.capture_tap is not None:
+        application.capture_tap.close()
+
+def ip(command: str, check=True):
+    subprocess.run("ip " + command, shell=True, check=check)
+
+def emulated(args) -> dict:
+    """ Benchmark base and mobile in network namespaces on one host """
+    script = os.path.abspath(__file__)
+    here = os.path.dirname(script)
+    node_args = ["--loss", str(args.loss), "--latency", str(args.latency)]
+    if args.no_collisions:
+        node_args.append("--no-collisions")
+    if args.trace:
+        node_args.append("--trace")
+    if args.capture:
+        node_args.append("--capture")
+    processes = []
+    logs = []
+    try:
+        for namespace in NAMESPACES:
+            ip("netns add " + namespace)
+            ip("-n {} link set lo up".format(namespace))
+        ip("link add {} type veth peer name {}".format(*VETH))
+        for (namespace, veth, host) in zip(NAMESPACES, VETH, ETHER_HOSTS):
+            ip("link set {} netns {}".format(veth, namespace))
+            ip("-n {} addr add {}/30 dev {}".format(namespace, host, veth))
+            ip("-n {} link set {} up".format(namespace, veth))
+        nodes = []
+        for (role, namespace) in enumerate(NAMESPACES):
+            log = open(os.path.join(here, "benchmark_node{}.log".format(role)), "w")
+            logs.append(log)
+            nodes.append(subprocess.Popen(
+                ["ip", "netns", "exec", namespace, sys.executable, script, "node", "--role", str(role)] + node_args,
+                cwd=here, stdout=log, stderr=subprocess.STDOUT))
+        processes += nodes
+        time.sleep(NODE_STARTUP)
+        processes.append(subprocess.Popen(
+            ["ip", "netns", "exec", NAMESPACES[0], sys.executable, script, "serve"],
+            cwd=here, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        time.sleep(0.5)
+        # `ip netns exec` execs the command, so these are the pids of the nodes
+        client = ["ip", "netns", "exec", NAMESPACES[1], sys.executable, script, "run",
+                  "--target", BASE_IP, "--output", "-",
+                  "--cpu-pids", ",".join(str(process.pid) for process in nodes)] + client_args(args)
+        report = json.loads(subprocess.run(client, cwd=here, check=True, stdout=subprocess.PIPE).stdout)
+        report["parameters"].update({"backend": "emulator", "loss": args.loss, "latency": args.latency,
+                                     "collisions": not args.no_collisions})
+        return report
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in logs:
+            log.close()
+        for namespace in NAMESPACES:
+            ip("netns del " + namespace, check=False)
+
+def client_args(args) -> List[str]:
+    return ["--sizes", ",".join(map(str, args.sizes)), "--tests", ",".join(args.tests),
+            "--duration", str(args.duration), "--udp-rate", str(args.udp_rate),
+            "--settle", str(args.settle), "--probes", str(args.probes),
+            "--probe-interval", str(args.probe_interval), "--probe-timeout", str(args.probe_timeout)]
+
+def int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value]
+
+def main():
+    parser = argparse.ArgumentParser(description="LongG link benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run UDP/TCP sinks and the echo server")
+    run_parser = commands.add_parser("run", help="run the tests against a serving node")
+    run_parser.add_argument("--target", default=BASE_IP)
+    run_parser.add_argument("--cpu-pids", type=int_list, default=[],
+                            help="comma separated pids whose CPU time is charged to the tests")
+    emulated_parser = commands.add_parser("emulated", help="run both nodes on emulated radios, needs root")
+    node_parser = commands.add_parser("node", help=argparse.SUPPRESS)
+    node_parser.add_argument("--role", type=int, required=True)
+    for sub in (run_parser, emulated_parser):
+        sub.add_argument("--sizes", type=int_list, default=[64, 256, 1024, 1400], help="bytes")
+        sub.add_argument("--tests", type=lambda text: text.split(","), default=["udp", "tcp", "rtt"])
+        sub.add_argument("--duration", type=float, default=10.0, help="s per goodput test")
+        sub.add_argument("--udp-rate", type=float, default=200000, help="offered UDP load, bit/s")
+        sub.add_argument("--settle", type=float, default=2.0, help="s for the link to drain after a UDP test")
+        sub.add_argument("--probes", type=int, default=100)
+        sub.add_argument("--probe-interval", type=float, default=0.05, help="s")
+        sub.add_argument("--probe-timeout", type=float, default=2.0, help="s")
+        sub.add_argument("--output", default="benchmark.json", help="file, or - for stdout")
+    for sub in (emulated_parser, node_parser):
+        sub.add_argument("--loss", type=float, default=0.0)
+        sub.add_argument("--latency", type=float, default=0.0, help="s")
+        sub.add_argument("--no-collisions", action="store_true")
+        sub.add_argument("--trace", action="store_true",
+                         help="write packet traces of the nodes, see tracing.py")
+        sub.add_argument("--capture", action="store_true",
+                         help="capture the packets and fragments of the nodes, see capture.py")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    if args.command == "serve":
+        serve()
+    elif args.command == "node":
+        node(args)
+    elif args.command == "run":
+        write_results(run(args), args.output)
+    else:
+        write_results(emulated(args), args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import collections
+import os
+import struct
+import threading
+import time
+
+"""
+    Packet capture of the link, for analysis in Wireshark. IP packets
+    entering and leaving the TUN interface, and optionally the fragments
+    sent and received by the radios, are written to pcapng files:
+
+        tap = Capture("capture_node0.pcapng", fragments=True)
+        tap.packet(packet, OUTBOUND)
+        ...
+        tap.close()
+
+    The forwarding threads only append to a deque, which needs no lock in
+    CPython; a writer thread of its own encodes and writes the blocks.
+    Files are rotated at max_bytes, keeping the last `files` of them.
+
+    Fragments are captured on an interface of link type USER0, each with
+    a pseudo-header of FRAGMENT_HEADER before the fragment as sent on air.
+"""
+
+""" Link types of the capture interfaces """
+LINKTYPE_RAW = 101 # IPv4 or IPv6 packets without a link layer
+LINKTYPE_USER0 = 147 # Fragments, see FRAGMENT_HEADER
+
+""" Interface ids """
+IF_PACKETS = 0
+IF_FRAGMENTS = 1
+
+""" Directions, the epb_flags of the packet """
+INBOUND = 1
+OUTBOUND = 2
+
+""" Pseudo-header of a captured fragment: pipe, and 1 if it was acknowledged or received """
+FRAGMENT_HEADER = struct.Struct("!BB")
+
+SNAPLEN = 0xFFFF
+""" Packets waiting for the writer, more are dropped and counted """
+MAX_QUEUED = 4096
+""" s the writer waits for packets when it finds none """
+WRITE_PERIOD = 0.05
+
+""" pcapng block types and options """
+BLOCK_SHB = 0x0A0D0D0A
+BLOCK_IDB = 0x00000001
+BLOCK_EPB = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+OPT_ENDOFOPT = 0
+OPT_IF_NAME = 2
+OPT_IF_TSRESOL = 9
+OPT_EPB_FLAGS = 2
+
+def pad(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+def option(code: int, value: bytes) -> bytes:
+    return struct.pack("<HH", code, len(value)) + pad(value)
+
+def block(block_type: int, body: bytes) -> bytes:
+    """ A pcapng block, the body padded to 32 bits """
+    body = pad(body)
+    length = len(body) + 12
+    return struct.pack("<II", block_type, length) + body + struct.pack("<I", length)
+
+def section_header() -> bytes:
+    # Section length -1: not known in advance
+    return block(BLOCK_SHB, struct.pack("<IHHq", BYTE_ORDER_MAGIC, 1, 0, -1) + option(OPT_ENDOFOPT, b""))
+
+def interface_description(linktype: int, name: str) -> bytes:
+    # Timestamps in ns
+    return block(BLOCK_IDB, struct.pack("<HHI", linktype, 0, SNAPLEN)
+                 + option(OPT_IF_NAME, name.encode()) + option(OPT_IF_TSRESOL, bytes([9]))
+                 + option(OPT_ENDOFOPT, b""))
+
+def enhanced_packet(interface: int, timestamp: int, flags: int, data: bytes) -> bytes:
+    captured = data[:SNAPLEN]
+    return block(BLOCK_EPB, struct.pack("<IIIII", interface, timestamp >> 32, timestamp & 0xFFFFFFFF,
+                                        len(captured), len(data))
+                 + pad(captured) + option(OPT_EPB_FLAGS, struct.pack("<I", flags)) + option(OPT_ENDOFOPT, b""))
+
+class Capture(object):
+    """ Writes captured packets to rotating pcapng files from a thread of its own """
+    def __init__(self, path: str, fragments: bool = False, max_bytes: int = 16 << 20, files: int = 4,
+                 if_name: str = "LongG"):
+        self.path = path
+        self.fragments = fragments
+        self.max_bytes = max_bytes
+        self.files = files
+        self.if_name = if_name
+        self.queue = collections.deque()
+        self.dropped = 0
+        self.index = 0
+        self.file = None
+        self.written = 0
+        self.open_file()
+        self.running = True
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def packet(self, data: bytes, direction: int):
+        """ Capture an IP packet read from or written to the TUN interface """
+        if len(self.queue) >= MAX_QUEUED:
+            self.dropped += 1
+            return
+        self.queue.append((IF_PACKETS, time.time_ns(), direction, data))
+
+    def fragment(self, data: bytes, direction: int, pipe: int, delivered: bool):
+        """ Capture a fragment sent or received by a radio, if capturing fragments """
+        if not self.fragments:
+            return
+        if len(self.queue) >= MAX_QUEUED:
+            self.dropped += 1
+            return
+        self.queue.append((IF_FRAGMENTS, time.time_ns(), direction,
+                           FRAGMENT_HEADER.pack(pipe, delivered) + bytes(data)))
+
+    def file_path(self, index: int) -> str:
+        """ Path of the index-th file, the first one is the path itself """
+        if index == 0:
+            return self.path
+        (root, ext) = os.path.splitext(self.path)
+        return "{}_{}{}".format(root, index, ext)
+
+    def open_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.index += 1
+            if self.index >= self.files:
+                try:
+                    os.remove(self.file_path(self.index - self.files))
+                except OSError:
+                    pass
+        self.file = open(self.file_path(self.index), "wb")
+        header = section_header() + interface_description(LINKTYPE_RAW, self.if_name)
+        if self.fragments:
+            header += interface_description(LINKTYPE_USER0, self.if_name + "-fragments")
+        self.file.write(header)
+        self.written = self.header_size = len(header)
+
+    def write_queued(self) -> int:
+        """ Write the queued packets, returns how many """
+        blocks = []
+        while self.queue:
+            blocks.append(enhanced_packet(*self.queue.popleft()))
+        for data in blocks:
+            if self.written + len(data) > self.max_bytes and self.written > self.header_size:
+                self.open_file()
+            self.file.write(data)
+            self.written += len(data)
+        if blocks:
+            self.file.flush()
+        return len(blocks)
+
+    def writer(self):
+        while self.running:
+            if not self.write_queued():
+                time.sleep(WRITE_PERIOD)
+        self.write_queued()
+
+    def close(self):
+        """ Write what is queued and close the file """
+        self.running = False
+        self.thread.join()
+        self.file.close()
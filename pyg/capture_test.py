@@ -0,0 +1,137 @@
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+import capture
+from capture import (BLOCK_EPB, BLOCK_IDB, BLOCK_SHB, IF_FRAGMENTS, IF_PACKETS, INBOUND, LINKTYPE_RAW, LINKTYPE_USER0,
+                     OUTBOUND, SNAPLEN, Capture)
+
+"""
+    Tests of the pcapng encoding and of Capture, which read the files back
+"""
+
+def blocks(data: bytes) -> list:
+    """ Split pcapng data into (block type, body) """
+    result = []
+    while data:
+        (block_type, length) = struct.unpack_from("<II", data)
+        (trailing_length,) = struct.unpack_from("<I", data, length - 4)
+        assert length % 4 == 0 and trailing_length == length
+        result.append((block_type, data[8:length - 4]))
+        data = data[length:]
+    return result
+
+def options(data: bytes) -> dict:
+    """ Options up to opt_endofopt, by code """
+    result = {}
+    while True:
+        (code, length) = struct.unpack_from("<HH", data)
+        if code == capture.OPT_ENDOFOPT:
+            assert length == 0 and len(data) == 4
+            return result
+        result[code] = data[4:4 + length]
+        data = data[4 + length + (-length % 4):]
+
+def packet(body: bytes) -> tuple:
+    """ (interface, timestamp, data, original length, epb_flags) of an EPB body """
+    (interface, high, low, captured, length) = struct.unpack_from("<IIIII", body)
+    flags = options(body[20 + captured + (-captured % 4):])[capture.OPT_EPB_FLAGS]
+    return (interface, high << 32 | low, body[20:20 + captured], length, struct.unpack("<I", flags)[0])
+
+class EncodingTest(unittest.TestCase):
+    def test_pad(self):
+        self.assertEqual(capture.pad(b""), b"")
+        self.assertEqual(capture.pad(b"a"), b"a\0\0\0")
+        self.assertEqual(capture.pad(b"abcd"), b"abcd")
+        self.assertEqual(capture.pad(b"abcde"), b"abcde\0\0\0")
+
+    def test_option(self):
+        self.assertEqual(capture.option(2, b"eth"), b"\x02\x00\x03\x00eth\0")
+        self.assertEqual(capture.option(capture.OPT_ENDOFOPT, b""), b"\0\0\0\0")
+
+    def test_block_lengths(self):
+        data = capture.block(0x1234, b"abcde")
+        self.assertEqual(len(data), 20)
+        self.assertEqual(blocks(data), [(0x1234, b"abcde\0\0\0")])
+
+    def test_section_header(self):
+        [(block_type, body)] = blocks(capture.section_header())
+        self.assertEqual(block_type, BLOCK_SHB)
+        self.assertEqual(struct.unpack_from("<IHHq", body), (capture.BYTE_ORDER_MAGIC, 1, 0, -1))
+        self.assertEqual(options(body[16:]), {})
+
+    def test_interface_description(self):
+        [(block_type, body)] = blocks(capture.interface_description(LINKTYPE_USER0, "LongG-fragments"))
+        self.assertEqual(block_type, BLOCK_IDB)
+        self.assertEqual(struct.unpack_from("<HHI", body), (LINKTYPE_USER0, 0, SNAPLEN))
+        self.assertEqual(options(body[8:]), {capture.OPT_IF_NAME: b"LongG-fragments", capture.OPT_IF_TSRESOL: b"\x09"})
+
+    def test_enhanced_packet(self):
+        timestamp = 1700000000123456789
+        [(block_type, body)] = blocks(capture.enhanced_packet(IF_FRAGMENTS, timestamp, INBOUND, b"\x45abcde"))
+        self.assertEqual(block_type, BLOCK_EPB)
+        self.assertEqual(packet(body), (IF_FRAGMENTS, timestamp, b"\x45abcde", 6, INBOUND))
+
+    def test_long_packet_is_truncated(self):
+        data = b"\x45" * (SNAPLEN + 10)
+        [(_, body)] = blocks(capture.enhanced_packet(IF_PACKETS, 0, OUTBOUND, data))
+        (_, _, captured, length, _) = packet(body)
+        self.assertEqual(len(captured), SNAPLEN)
+        self.assertEqual(length, len(data))
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "capture.pcapng")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, path: str) -> list:
+        with open(path, "rb") as file:
+            return blocks(file.read())
+
+    def test_packets_and_fragments(self):
+        tap = Capture(self.path, fragments=True)
+        tap.packet(b"\x45" * 20, OUTBOUND)
+        tap.fragment(b"\x00\x01abc", INBOUND, 3, True)
+        tap.close()
+        written = self.read(self.path)
+        self.assertEqual([block_type for (block_type, _) in written], [BLOCK_SHB, BLOCK_IDB, BLOCK_IDB, BLOCK_EPB, BLOCK_EPB])
+        self.assertEqual(struct.unpack_from("<H", written[1][1])[0], LINKTYPE_RAW)
+        self.assertEqual(struct.unpack_from("<H", written[2][1])[0], LINKTYPE_USER0)
+        (interface, _, data, _, flags) = packet(written[3][1])
+        self.assertEqual((interface, data, flags), (IF_PACKETS, b"\x45" * 20, OUTBOUND))
+        (interface, _, data, _, flags) = packet(written[4][1])
+        self.assertEqual((interface, data, flags), (IF_FRAGMENTS, b"\x03\x01\x00\x01abc", INBOUND))
+
+    def test_fragments_are_optional(self):
+        tap = Capture(self.path)
+        tap.fragment(b"\x00\x01abc", OUTBOUND, 1, False)
+        tap.close()
+        self.assertEqual([block_type for (block_type, _) in self.read(self.path)], [BLOCK_SHB, BLOCK_IDB])
+
+    def test_rotation_keeps_the_last_files(self):
+        size = len(capture.enhanced_packet(IF_PACKETS, 0, OUTBOUND, b"\x45" * 100))
+        tap = Capture(self.path, max_bytes=200 + size, files=2)
+        for _ in range(5):
+            tap.packet(b"\x45" * 100, OUTBOUND)
+        tap.close()
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["capture_3.pcapng", "capture_4.pcapng"])
+        for name in ("capture_3.pcapng", "capture_4.pcapng"):
+            written = self.read(os.path.join(self.directory.name, name))
+            self.assertEqual([block_type for (block_type, _) in written], [BLOCK_SHB, BLOCK_IDB, BLOCK_EPB])
+
+    def test_full_queue_drops(self):
+        with mock.patch("capture.MAX_QUEUED", 0):
+            tap = Capture(self.path, fragments=True)
+            tap.packet(b"\x45", INBOUND)
+            tap.fragment(b"\x00\x01", INBOUND, 1, True)
+            tap.close()
+        self.assertEqual(tap.dropped, 2)
+        self.assertEqual(len(self.read(self.path)), 3)
+
+if __name__ == "__main__":
+    unittest.main()
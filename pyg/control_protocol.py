@@ -0,0 +1,189 @@
+import socket
+import struct
+import time
+from typing import List, Optional, Tuple
+
+"""
+    Binary control protocol over UDP, an alternative to HTTP sampling.
+    Both the sample and the reply are one 16 byte message:
+    magic, type, node id, sequence number, timestamp (ms) and a float.
+    The reply echoes sequence number and timestamp of the sample.
+"""
+MAGIC = 0x50
+MSG_SAMPLE = 1 # Mobile -> server: measured value
+MSG_CONTROL = 2 # Server -> mobile: control signal
+MSG_BATCH = 3 # Base -> server: measured values of several nodes
+MSG_BATCH_CONTROL = 4 # Server -> base: control signals, in request order
+
+MESSAGE = struct.Struct("!BBHIIf")
+
+""" 
+    Batch messages: magic, type, count, sequence number, timestamp (ms),
+    then count times (node id, measured value) or count control signals
+"""
+BATCH_HEADER = struct.Struct("!BBHII")
+BATCH_SAMPLE = struct.Struct("!Hf")
+BATCH_CONTROL = struct.Struct("!f")
+
+""" Client retransmission """
+RETRY_TIMEOUT = 0.5 # s
+RETRIES = 3
+
+def encode(msg_type: int, node: int, seq: int, timestamp: int, value: float) -> bytes:
+    """ Encode a message
+
+    Args:
+        msg_type (int): MSG_SAMPLE or MSG_CONTROL
+        node (int): Node id of the mobile
+        seq (int): Sequence number of the sample
+        timestamp (int): Timestamp of the sample in ms
+        value (float): Measured value or control signal
+
+    Returns:
+        bytes: Encoded message
+    """
+    return MESSAGE.pack(MAGIC, msg_type, node & 0xFFFF, seq & 0xFFFFFFFF,
+                        timestamp & 0xFFFFFFFF, value)
+
+def decode(data: bytes) -> Tuple[int, int, int, int, float]:
+    """ Decode a message
+
+    Args:
+        data (bytes): Received datagram
+
+    Raises:
+        ValueError: The datagram is not a message of this protocol
+
+    Returns:
+        Tuple[int, int, int, int, float]: Type, node id, sequence number,
+        timestamp and value
+    """
+    if len(data) != MESSAGE.size or data[0] != MAGIC:
+        raise ValueError("not a control protocol message")
+    return MESSAGE.unpack(data)[1:]
+
+def message_type(data: bytes) -> Optional[int]:
+    """ Type of a datagram, None if it is not of this protocol """
+    if len(data) < 2 or data[0] != MAGIC:
+        return None
+    return data[1]
+
+def encode_batch(seq: int, timestamp: int, samples: List[Tuple[int, float]]) -> bytes:
+    """ Encode a batch of measured values
+
+    Args:
+        seq (int): Sequence number of the batch
+        timestamp (int): Timestamp of the batch in ms
+        samples (List[Tuple[int, float]]): Node id and measured value per node
+
+    Returns:
+        bytes: Encoded batch
+    """
+    header = BATCH_HEADER.pack(MAGIC, MSG_BATCH, len(samples), seq & 0xFFFFFFFF,
+                               timestamp & 0xFFFFFFFF)
+    return header + b"".join(BATCH_SAMPLE.pack(node & 0xFFFF, value) for (node, value) in samples)
+
+def decode_batch(data: bytes) -> Tuple[int, int, List[Tuple[int, float]]]:
+    """ Decode a batch of measured values
+
+    Raises:
+        ValueError: The data is not a batch of this protocol
+
+    Returns:
+        Tuple[int, int, List[Tuple[int, float]]]: Sequence number, timestamp,
+        and node id and measured value per node
+    """
+    if len(data) < BATCH_HEADER.size or message_type(data) != MSG_BATCH:
+        raise ValueError("not a batch message")
+    (_, _, count, seq, timestamp) = BATCH_HEADER.unpack_from(data)
+    if len(data) != BATCH_HEADER.size + count * BATCH_SAMPLE.size:
+        raise ValueError("batch length does not match its count")
+    return (seq, timestamp, list(BATCH_SAMPLE.iter_unpack(data[BATCH_HEADER.size:])))
+
+def encode_batch_control(seq: int, timestamp: int, signals: List[float]) -> bytes:
+    """ Encode the control signals answering a batch, in request order """
+    header = BATCH_HEADER.pack(MAGIC, MSG_BATCH_CONTROL, len(signals), seq & 0xFFFFFFFF,
+                               timestamp & 0xFFFFFFFF)
+    return header + b"".join(BATCH_CONTROL.pack(signal) for signal in signals)
+
+def decode_batch_control(data: bytes) -> Tuple[int, int, List[float]]:
+    """ Decode the control signals answering a batch
+
+    Raises:
+        ValueError: The data is not a batch reply of this protocol
+
+    Returns:
+        Tuple[int, int, List[float]]: Sequence number, timestamp and the
+        control signals in request order
+    """
+    if len(data) < BATCH_HEADER.size or message_type(data) != MSG_BATCH_CONTROL:
+        raise ValueError("not a batch control message")
+    (_, _, count, seq, timestamp) = BATCH_HEADER.unpack_from(data)
+    if len(data) != BATCH_HEADER.size + count * BATCH_CONTROL.size:
+        raise ValueError("batch length does not match its count")
+    return (seq, timestamp, [signal for (signal,) in BATCH_CONTROL.iter_unpack(data[BATCH_HEADER.size:])])
+
+class UdpControlClient(object):
+    """
+    Requests control signals over UDP. A sample is retransmitted with the
+    same sequence number until a reply arrives, so the server can answer
+    retransmissions without running the controller again.
+    """
+    def __init__(self, server, node, interface=None):
+        self.server = server
+        self.node = node
+        self.seq = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if interface is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+        self.rtt = None
+
+    def request(self, measured_value: float) -> Optional[float]:
+        """
+        Send a sample and wait for its control signal. Returns None if no
+        reply arrived after all retransmissions.
+        """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        timestamp = time.monotonic_ns() // 1000000
+        sample = encode(MSG_SAMPLE, self.node, self.seq, timestamp, measured_value)
+        for _ in range(RETRIES + 1):
+            self.sock.sendto(sample, self.server)
+            deadline = time.monotonic() + RETRY_TIMEOUT
+            while time.monotonic() < deadline:
+                try:
+                    self.sock.settimeout(max(0.001, deadline - time.monotonic()))
+                    data = self.sock.recv(64)
+                    (msg_type, _, seq, sent, value) = decode(data)
+                except (socket.timeout, ValueError):
+                    continue
+                if msg_type == MSG_CONTROL and seq == self.seq:
+                    self.rtt = ((time.monotonic_ns() // 1000000 - sent) & 0xFFFFFFFF) / 1000
+                    return value
+        return None
+
+    def request_batch(self, samples: List[Tuple[int, float]]) -> Optional[List[float]]:
+        """
+        Send measured values of several nodes in one datagram, and wait for
+        all their control signals. Returns None if no reply arrived after all
+        retransmissions.
+        """
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        timestamp = time.monotonic_ns() // 1000000
+        batch = encode_batch(self.seq, timestamp, samples)
+        for _ in range(RETRIES + 1):
+            self.sock.sendto(batch, self.server)
+            deadline = time.monotonic() + RETRY_TIMEOUT
+            while time.monotonic() < deadline:
+                try:
+                    self.sock.settimeout(max(0.001, deadline - time.monotonic()))
+                    data = self.sock.recv(65535)
+                    (seq, sent, signals) = decode_batch_control(data)
+                except (socket.timeout, ValueError):
+                    continue
+                if seq == self.seq:
+                    self.rtt = ((time.monotonic_ns() // 1000000 - sent) & 0xFFFFFFFF) / 1000
+                    return signals
+        return None
+
+    def close(self):
+        self.sock.close()
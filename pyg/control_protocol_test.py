@@ -0,0 +1,96 @@
+import socket
+import threading
+import unittest
+
+import control_protocol
+from control_protocol import (MSG_BATCH_CONTROL, MSG_CONTROL, MSG_SAMPLE, UdpControlClient, decode, decode_batch,
+                              decode_batch_control, encode, encode_batch, encode_batch_control, message_type)
+from control_webserver import Controller
+
+class MessageTest(unittest.TestCase):
+    def test_round_trip(self):
+        data = encode(MSG_SAMPLE, 7, 42, 123456, 0.5)
+        self.assertEqual(len(data), 16)
+        self.assertEqual(decode(data), (MSG_SAMPLE, 7, 42, 123456, 0.5))
+        self.assertEqual(message_type(data), MSG_SAMPLE)
+
+    def test_fields_wrap(self):
+        self.assertEqual(decode(encode(MSG_CONTROL, 0x10001, 1 << 32, (1 << 32) + 5, 0.0))[1:4], (1, 0, 5))
+
+    def test_foreign_datagrams(self):
+        self.assertRaises(ValueError, decode, b"GET / HTTP/1.1\r\n")
+        self.assertRaises(ValueError, decode, encode(MSG_SAMPLE, 1, 1, 1, 1.0)[:-1])
+        self.assertIsNone(message_type(b"\x45"))
+        self.assertIsNone(message_type(b"\x45\x00\x00\x14"))
+
+class BatchTest(unittest.TestCase):
+    def test_round_trip(self):
+        samples = [(1, 0.25), (2, -1.5), (300, 0.0)]
+        self.assertEqual(decode_batch(encode_batch(9, 1000, samples)), (9, 1000, samples))
+
+    def test_empty_batch(self):
+        self.assertEqual(decode_batch(encode_batch(1, 2, [])), (1, 2, []))
+
+    def test_length_must_match_count(self):
+        data = encode_batch(1, 2, [(1, 0.5), (2, 0.5)])
+        self.assertRaises(ValueError, decode_batch, data[:-1])
+        self.assertRaises(ValueError, decode_batch, data + b"\0" * control_protocol.BATCH_SAMPLE.size)
+
+    def test_control_round_trip(self):
+        data = encode_batch_control(3, 4, [0.5, -0.25])
+        self.assertEqual(message_type(data), MSG_BATCH_CONTROL)
+        self.assertEqual(decode_batch_control(data), (3, 4, [0.5, -0.25]))
+
+    def test_types_are_not_mixed_up(self):
+        self.assertRaises(ValueError, decode_batch, encode_batch_control(1, 2, [0.5]))
+        self.assertRaises(ValueError, decode_batch_control, encode_batch(1, 2, [(1, 0.5)]))
+
+class CountingRegistry(object):
+    """ Stands in for the PID bank of the control server """
+    def __init__(self):
+        self.steps = 0
+
+    def step(self, indices, measured_values):
+        self.steps += 1
+        return [float(self.steps) for _ in indices]
+
+class DeduplicationTest(unittest.TestCase):
+    def test_retransmitted_sample_gets_the_same_answer(self):
+        registry = CountingRegistry()
+        controller = Controller(registry, 0)
+        self.assertEqual(controller.control_sample(1, 0.1), 1.0)
+        self.assertEqual(controller.control_sample(1, 0.1), 1.0)
+        self.assertEqual(controller.control_sample(2, 0.1), 2.0)
+        self.assertEqual(registry.steps, 2)
+
+    def test_client_retransmits_with_the_same_sequence_number(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        received = []
+
+        def answer_second():
+            # Drop the first transmission, answer the retransmission
+            for _ in range(2):
+                (data, address) = server.recvfrom(64)
+                received.append(decode(data))
+            (_, node, seq, timestamp, _) = received[-1]
+            server.sendto(encode(MSG_CONTROL, node, seq, timestamp, 0.75), address)
+
+        old_timeout = control_protocol.RETRY_TIMEOUT
+        control_protocol.RETRY_TIMEOUT = 0.05
+        thread = threading.Thread(target=answer_second)
+        thread.start()
+        client = UdpControlClient(server.getsockname(), 5)
+        try:
+            self.assertEqual(client.request(0.1), 0.75)
+        finally:
+            control_protocol.RETRY_TIMEOUT = old_timeout
+            thread.join()
+            client.close()
+            server.close()
+        self.assertEqual(received[0], received[1])
+        self.assertEqual(received[0][:3], (MSG_SAMPLE, 5, 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,33 +1,102 @@
+import collections
 import http.server
 import logging
+import socketserver
 import struct
+import threading
 from urllib.parse import urlparse
-from pyg_control_system import PID, control_it, get_control_signal
+from pyg_control_system import PIDBank
+from control_protocol import MSG_BATCH, MSG_CONTROL, MSG_SAMPLE, decode, decode_batch, encode, encode_batch_control, message_type
 import sys
 
 PORT = 8080
+UDP_PORT = 8081
+SET_POINT = 0.02
+KEEP_ALIVE_TIMEOUT = 60 # s, idle keep-alive connections are closed after this
+MAX_BATCH_CLIENTS = 1024 # Client addresses whose last UDP batch reply is kept
 
-class RequestHandler(http.server.SimpleHTTPRequestHandler):
+class Controller(object):
+    """ A controller of the registry's PID bank, kept between requests """
+    def __init__(self, registry, index):
+        self.lock = threading.Lock()
+        self.registry = registry
+        self.index = index
+        self.last_seq = None
+        self.last_signal = 0.0
 
-    def __init__(self, *args, **kwargs):
-        self.pid = PID()
-        self.set_point = 0.02
-        super().__init__(*args, **kwargs)
+    def control(self, measured_value: float) -> float:
+        return self.registry.step([self.index], [measured_value])[0]
+
+    def control_sample(self, seq: int, measured_value: float) -> float:
+        """ Like control(), but a retransmitted sample gets the same answer """
+        with self.lock:
+            if seq != self.last_seq:
+                self.last_signal = self.control(measured_value)
+                self.last_seq = seq
+            return self.last_signal
+
+class ControllerRegistry(object):
+    """ 
+    One long-lived controller per node, created on first use.
+    All controllers live in one PIDBank, so a batch is one call into it.
+    """
+    def __init__(self, set_point=SET_POINT):
+        self.lock = threading.Lock()
+        self.bank_lock = threading.Lock()
+        self.bank = PIDBank()
+        self.set_point = set_point
+        self.controllers = {}
+
+    def get(self, key) -> Controller:
+        with self.lock:
+            controller = self.controllers.get(key)
+            if controller is None:
+                with self.bank_lock:
+                    index = self.bank.add()
+                controller = Controller(self, index)
+                self.controllers[key] = controller
+            return controller
+
+    def step(self, indices: list, measured_values: list) -> list:
+        """ Run one iteration of the controllers at indices """
+        with self.bank_lock:
+            return self.bank.step_indices(indices, [self.set_point] * len(indices), measured_values)
+
+    def control_batch(self, keys: list, measured_values: list) -> list:
+        """ Run one iteration of the controllers of several nodes """
+        return self.step([self.get(key).index for key in keys], measured_values)
+
+controllers = ControllerRegistry()
+
+def control_batch(data: bytes) -> bytes:
+    """ Answer a batch request of the binary control protocol """
+    (seq, timestamp, samples) = decode_batch(data)
+    signals = controllers.control_batch([str(node) for (node, _) in samples],
+                                        [value for (_, value) in samples])
+    return encode_batch_control(seq, timestamp, signals)
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between samples, saving a TCP
+    # handshake and teardown over the radio link per sample
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
 
     def do_GET(self) -> None:
-        # Parse measured value from URL
+        # Parse node id and measured value from URL: /<node id>/<value> or /<value>
+        # Without a node id, the controller is picked by client IP
         parsed_path = urlparse(self.path)
-        value_str = parsed_path.path.lstrip("/")
-        if value_str.replace('.', '', 1).isdigit():
+        parts = parsed_path.path.strip("/").split("/")
+        value_str = parts[-1]
+        key = parts[0] if len(parts) == 2 else self.client_address[0]
+        if len(parts) <= 2 and value_str.replace('.', '', 1).isdigit():
             measured_value = float(value_str)
         else:
             self.send_error(400, "Bad request: measured value must be a floating-point type value")
+            return
 
         print("Measured value: {}".format(measured_value))
 
-        control_it(self.pid, self.set_point, measured_value)        
-
-        control_signal = get_control_signal(self.pid)
+        control_signal = controllers.get(key).control(measured_value)
         control_signal_bytes = bytearray(struct.pack("f", control_signal))
 
         print("Control signal: {}".format(control_signal))
@@ -42,12 +111,92 @@ class RequestHandler(http.server.SimpleHTTPRequestHandler):
         log_message = (f"Request: {self.path} | "
                        f"Measured value: {measured_value}"
                        f"Payload: {control_signal_bytes} | "
-                       f"By: {client_ip}")
+                       f"By: {client_ip} | "
+                       f"Node: {key}")
 
         logging.info(log_message)
+
+    def do_POST(self) -> None:
+        # Batch of measured values in the binary format of control_protocol
+        if urlparse(self.path).path != "/batch":
+            self.send_error(404, "Not found: batches are posted to /batch")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_error(400, "Bad request: Content-Length must be a non-negative integer")
+            return
+        body = self.rfile.read(length)
+        try:
+            reply = control_batch(body)
+        except ValueError:
+            self.send_error(400, "Bad request: body must be a control protocol batch")
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'application/octet-stream')
+        self.send_header('Content-Length', len(reply))
+        self.end_headers()
+        self.wfile.write(reply)
+
+        logging.info(f"Batch request: {len(body)} bytes | "
+                     f"By: {self.client_address[0]}")
         
-def run(server_class=http.server.HTTPServer):
+""" Last UDP batch sequence number and reply, of the MAX_BATCH_CLIENTS most recent client addresses """
+batch_replies = collections.OrderedDict()
+
+class UdpRequestHandler(socketserver.BaseRequestHandler):
+    """ Answers samples of the binary control protocol, see control_protocol """
+
+    def handle(self) -> None:
+        (data, sock) = self.request
+        if message_type(data) == MSG_BATCH:
+            self.handle_batch(data, sock)
+            return
+        try:
+            (msg_type, node, seq, timestamp, measured_value) = decode(data)
+        except ValueError:
+            logging.info(f"Bad datagram from {self.client_address[0]}")
+            return
+        if msg_type != MSG_SAMPLE:
+            return
+
+        control_signal = controllers.get(str(node)).control_sample(seq, measured_value)
+        sock.sendto(encode(MSG_CONTROL, node, seq, timestamp, control_signal), self.client_address)
+
+        logging.info(f"UDP sample: {seq} | "
+                     f"Measured value: {measured_value} | "
+                     f"Control signal: {control_signal} | "
+                     f"By: {self.client_address[0]} | "
+                     f"Node: {node}")
+
+    def handle_batch(self, data: bytes, sock) -> None:
+        try:
+            seq = decode_batch(data)[0]
+        except ValueError:
+            logging.info(f"Bad batch from {self.client_address[0]}")
+            return
+        # A retransmitted batch gets the same answer, without stepping the controllers
+        (last_seq, reply) = batch_replies.get(self.client_address, (None, None))
+        if seq != last_seq:
+            reply = control_batch(data)
+            batch_replies[self.client_address] = (seq, reply)
+        batch_replies.move_to_end(self.client_address)
+        if len(batch_replies) > MAX_BATCH_CLIENTS:
+            batch_replies.popitem(last=False)
+        sock.sendto(reply, self.client_address)
+
+        logging.info(f"UDP batch: {len(data)} bytes | "
+                     f"By: {self.client_address[0]}")
+
+def run(server_class=http.server.ThreadingHTTPServer):
     logging.basicConfig(filename='control_server.log', level=logging.INFO) 
+    udp_server = socketserver.UDPServer(('', UDP_PORT), UdpRequestHandler)
+    threading.Thread(target=udp_server.serve_forever, daemon=True).start()
+    print(f"Starting UDP control server on port {UDP_PORT}")
+    logging.info(f"Starting UDP control server on port {UDP_PORT}")
     server_address = ('', PORT)
     httpd = server_class(server_address, RequestHandler)
     print(f"Starting server on port {PORT}")
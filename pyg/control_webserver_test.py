@@ -0,0 +1,182 @@
+import collections
+import contextlib
+import http.client
+import http.server
+import io
+import socket
+import struct
+import threading
+import unittest
+from unittest import mock
+
+import control_webserver
+from control_protocol import encode_batch
+
+"""
+    Tests of the control server handlers, with the controllers replaced
+"""
+
+class StubBank(object):
+    """ Stands in for PIDBank: the control signal of a controller is the number of its steps """
+    def __init__(self):
+        self.steps = []
+
+    def add(self) -> int:
+        self.steps.append(0)
+        return len(self.steps) - 1
+
+    def step_indices(self, indices, set_points, measured_values) -> list:
+        for index in indices:
+            self.steps[index] += 1
+        return [float(self.steps[index]) for index in indices]
+
+def registry() -> control_webserver.ControllerRegistry:
+    with mock.patch("control_webserver.PIDBank", StubBank):
+        return control_webserver.ControllerRegistry()
+
+class ControllerRegistryTest(unittest.TestCase):
+    def test_one_controller_per_node(self):
+        controllers = registry()
+        self.assertIs(controllers.get("1"), controllers.get("1"))
+        self.assertNotEqual(controllers.get("1").index, controllers.get("2").index)
+
+    def test_state_is_kept_between_requests(self):
+        controllers = registry()
+        self.assertEqual(controllers.get("1").control(0.01), 1.0)
+        self.assertEqual(controllers.get("1").control(0.01), 2.0)
+        self.assertEqual(controllers.get("2").control(0.01), 1.0)
+
+    def test_batch_steps_each_node_once(self):
+        controllers = registry()
+        controllers.get("2").control(0.01)
+        self.assertEqual(controllers.control_batch(["1", "2", "3"], [0.01, 0.02, 0.03]), [1.0, 2.0, 1.0])
+
+    def test_concurrent_first_use_creates_one_controller(self):
+        controllers = registry()
+        threads = [threading.Thread(target=controllers.get, args=("1",)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(controllers.controllers), 1)
+        self.assertEqual(controllers.bank.steps, [0])
+
+class QuietRequestHandler(control_webserver.RequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        self.address = self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class HttpBatchTest(ServerTestCase):
+    def post(self, headers: bytes, body: bytes = b"") -> bytes:
+        """ Send a raw request, returns the status line of the reply """
+        with socket.create_connection(self.address, timeout=5) as sock:
+            sock.sendall(b"POST /batch HTTP/1.1\r\nHost: test\r\n" + headers + b"\r\n" + body)
+            return sock.makefile("rb").readline()
+
+    def test_batch(self):
+        with mock.patch("control_webserver.control_batch", return_value=b"reply") as control_batch:
+            connection = http.client.HTTPConnection(*self.address, timeout=5)
+            body = encode_batch(1, 2, [(1, 0.5)])
+            connection.request("POST", "/batch", body)
+            response = connection.getresponse()
+            self.assertEqual((response.status, response.read()), (200, b"reply"))
+            connection.close()
+        control_batch.assert_called_once_with(body)
+
+    def test_bad_content_length(self):
+        for length in (b"abc", b"-1", b""):
+            self.assertIn(b" 400 ", self.post(b"Content-Length: " + length + b"\r\n"))
+
+    def test_missing_content_length(self):
+        self.assertIn(b" 400 ", self.post(b""))
+
+class KeepAliveTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.controllers = registry()
+        patch = mock.patch("control_webserver.controllers", self.controllers)
+        patch.start()
+        self.addCleanup(patch.stop)
+        # The handler prints every sample
+        stdout = contextlib.redirect_stdout(io.StringIO())
+        stdout.__enter__()
+        self.addCleanup(stdout.__exit__, None, None, None)
+
+    def connect(self) -> http.client.HTTPConnection:
+        connection = http.client.HTTPConnection(*self.address, timeout=5)
+        self.addCleanup(connection.close)
+        return connection
+
+    def get(self, connection: http.client.HTTPConnection, path: str) -> tuple:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        return (response.status, response.read())
+
+    def test_samples_share_a_connection(self):
+        connection = self.connect()
+        self.assertEqual(self.get(connection, "/1/0.01"), (200, struct.pack("f", 1.0)))
+        sock = connection.sock
+        self.assertEqual(self.get(connection, "/1/0.01"), (200, struct.pack("f", 2.0)))
+        self.assertIs(connection.sock, sock)
+
+    def test_node_by_client_ip(self):
+        self.assertEqual(self.get(self.connect(), "/0.01")[0], 200)
+        self.assertEqual(list(self.controllers.controllers), ["127.0.0.1"])
+
+    def test_bad_value(self):
+        self.assertEqual(self.get(self.connect(), "/1/x")[0], 400)
+        self.assertEqual(self.controllers.controllers, {})
+
+    def test_idle_connection_does_not_block_others(self):
+        idle = self.connect()
+        self.get(idle, "/1/0.01")
+        self.assertEqual(self.get(self.connect(), "/2/0.01"), (200, struct.pack("f", 1.0)))
+
+class UdpBatchTest(unittest.TestCase):
+    def setUp(self):
+        patches = [mock.patch("control_webserver.batch_replies", collections.OrderedDict()),
+                   mock.patch("control_webserver.MAX_BATCH_CLIENTS", 2),
+                   mock.patch("control_webserver.control_batch", side_effect=self.control_batch)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.steps = 0
+
+    def control_batch(self, data: bytes) -> bytes:
+        self.steps += 1
+        return bytes([self.steps])
+
+    def send(self, seq: int, address: tuple) -> bytes:
+        sock = mock.Mock()
+        control_webserver.UdpRequestHandler((encode_batch(seq, 0, [(1, 0.5)]), sock), address, None)
+        (reply, to) = sock.sendto.call_args[0]
+        self.assertEqual(to, address)
+        return reply
+
+    def test_retransmitted_batch_gets_the_same_reply(self):
+        self.assertEqual(self.send(1, ("10.0.0.1", 1000)), b"\x01")
+        self.assertEqual(self.send(1, ("10.0.0.1", 1000)), b"\x01")
+        self.assertEqual(self.send(2, ("10.0.0.1", 1000)), b"\x02")
+        self.assertEqual(self.steps, 2)
+
+    def test_least_recent_clients_are_forgotten(self):
+        for port in (1000, 1001):
+            self.send(1, ("10.0.0.1", port))
+        self.send(1, ("10.0.0.1", 1000))
+        self.send(1, ("10.0.0.1", 1002))
+        self.assertEqual(list(control_webserver.batch_replies), [("10.0.0.1", 1000), ("10.0.0.1", 1002)])
+        self.send(1, ("10.0.0.1", 1000))
+        self.assertEqual(self.steps, 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -20,11 +20,68 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 """This module contains a wrapper class for `spidev.SpiDev` in CPython on Linux. Modified for use in PyG"""
+import ctypes
+import struct
+from fcntl import ioctl
+
 try:
-    from typing import Optional
+    from typing import Optional, Sequence, Union
 except ImportError:
     pass  # do not perform type checking on CirPy devices
 
+# struct spi_ioc_transfer of linux/spi/spidev.h
+SPI_IOC_TRANSFER = struct.Struct("QQIIHBBBBBB")
+
+
+def spi_ioc_message(count: int) -> int:
+    """The ``SPI_IOC_MESSAGE(count)`` ioctl request number."""
+    size = count * SPI_IOC_TRANSFER.size
+    if size >= 1 << 14:
+        raise ValueError("too many transfers for one SPI message")
+    return 1 << 30 | size << 16 | ord("k") << 8
+
+
+def xfer_many(
+    spi, out_bufs: Sequence[Union[bytes, bytearray]], speed_hz: int, no_cs: bool = False
+) -> bytearray:
+    """Perform several transfers on a ``SpiDev``, releasing CSN between them.
+    They are sent as one ``SPI_IOC_MESSAGE`` ioctl, so in one system call, when
+    the ``SpiDev`` has a file descriptor; otherwise as one ``xfer2()`` each.
+
+    :returns: The bytes received during the last transfer.
+    """
+    fileno = getattr(spi, "fileno", None)
+    if fileno is not None and not no_cs and 0 < len(out_bufs):
+        try:
+            return _ioc_message(fileno(), out_bufs, speed_hz)
+        except (OSError, ValueError):
+            pass  # not a spidev device, or too many transfers
+    in_buf = bytearray()
+    for out_buf in out_bufs:
+        in_buf = bytearray(spi.xfer2(out_buf, speed_hz))
+    return in_buf
+
+
+def _ioc_message(fd: int, out_bufs: Sequence[Union[bytes, bytearray]], speed_hz: int) -> bytearray:
+    # the buffers must outlive the ioctl
+    tx_bufs = [ctypes.create_string_buffer(bytes(out_buf), len(out_buf)) for out_buf in out_bufs]
+    rx_buf = ctypes.create_string_buffer(len(out_bufs[-1]))
+    message = bytearray()
+    for i, tx_buf in enumerate(tx_bufs):
+        last = i == len(tx_bufs) - 1
+        message += SPI_IOC_TRANSFER.pack(
+            ctypes.addressof(tx_buf),
+            ctypes.addressof(rx_buf) if last else 0,
+            len(tx_buf),
+            speed_hz,
+            0,  # delay_usecs
+            8,  # bits_per_word
+            0 if last else 1,  # cs_change, release CSN between transfers
+            0, 0, 0, 0,
+        )
+    ioctl(fd, spi_ioc_message(len(tx_bufs)), message)
+    return bytearray(rx_buf.raw)
+
 
 class SPIDevCtx:
     """A wrapper class to allow using the spidev module on linux and
@@ -80,3 +137,15 @@ class SPIDevCtx:
         out_end = out_end if out_end is not None else len(out_buf)
         in_end = in_end if in_end is not None else len(in_buf)
         in_buf[:in_end] = bytearray(self._spi.xfer2(out_buf[:out_end], self._baudrate))
+
+    def write_many(self, out_bufs: Sequence[Union[bytes, bytearray]]) -> bytearray:
+        """Perform several transfers, releasing CSN between them, see
+        `xfer_many()`. A ``SpiDev`` wrapper with an ``xfer_many()`` method of
+        its own, e.g. one counting transfers, is given them to perform.
+
+        :returns: The bytes received during the last transfer.
+        """
+        own = getattr(self._spi, "xfer_many", None)
+        if own is not None:
+            return own(out_bufs, self._baudrate, self._no_cs)
+        return xfer_many(self._spi, out_bufs, self._baudrate, self._no_cs)
@@ -0,0 +1,174 @@
+import abc
+import bisect
+import http.server
+import threading
+from typing import Callable, Optional, Sequence
+
+"""
+    Counters and histograms of the link, served in the OpenMetrics text
+    format for Prometheus.
+
+    Every thread updates cells of its own, so recording takes no lock;
+    the cells of all threads are only summed when the endpoint is scraped.
+"""
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+""" Histogram buckets of durations, in s """
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class _Metric(abc.ABC):
+    """ A metric whose values live in one cell per thread """
+    def __init__(self, registry, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock() # Taken once per thread, to add its cell
+        self.cells = []
+        self.local = threading.local()
+        registry.register(self)
+
+    @abc.abstractmethod
+    def new_cell(self) -> list:
+        """ A cell of zeros, the layout is up to the metric """
+
+    def cell(self) -> list:
+        """ The calling thread's cell """
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.new_cell()
+            with self.lock:
+                self.cells.append(cell)
+            self.local.cell = cell
+            return cell
+
+    def sum_cells(self) -> list:
+        """ Element-wise sum of the cells of all threads """
+        with self.lock:
+            cells = list(self.cells)
+        total = self.new_cell()
+        for cell in cells:
+            for i, value in enumerate(cell):
+                total[i] += value
+        return total
+
+class Counter(_Metric):
+    """ Monotonically increasing count """
+    def new_cell(self) -> list:
+        return [0]
+
+    def inc(self, amount=1):
+        self.cell()[0] += amount
+
+    def value(self):
+        return self.sum_cells()[0]
+
+    def expose(self) -> list:
+        return ["# TYPE {} counter".format(self.name),
+                "# HELP {} {}".format(self.name, self.help),
+                "{}_total {}".format(self.name, self.value())]
+
+class Histogram(_Metric):
+    """ Distribution of observed values over fixed buckets """
+    def __init__(self, registry, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(registry, name, help)
+
+    def new_cell(self) -> list:
+        # Count per bucket and one for values above all buckets, then sum
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value: float):
+        cell = self.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def expose(self) -> list:
+        total = self.sum_cells()
+        lines = ["# TYPE {} histogram".format(self.name),
+                 "# HELP {} {}".format(self.name, self.help)]
+        count = 0
+        for (bound, bucket_count) in zip(self.buckets, total):
+            count += bucket_count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, float(bound), count))
+        count += total[-2]
+        lines += ['{}_bucket{{le="+Inf"}} {}'.format(self.name, count),
+                  "{}_count {}".format(self.name, count),
+                  "{}_sum {}".format(self.name, total[-1])]
+        return lines
+
+class Gauge(object):
+    """ Current value, read from a function at scrape time """
+    def __init__(self, registry, name: str, help: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.read = read
+        registry.register(self)
+
+    def expose(self) -> list:
+        return ["# TYPE {} gauge".format(self.name),
+                "# HELP {} {}".format(self.name, self.help),
+                "{} {}".format(self.name, self.read())]
+
+class Registry(object):
+    """ The metrics served by one endpoint """
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def register(self, metric):
+        metric.name = self.prefix + metric.name
+        with self.lock:
+            self.metrics.append(metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return Counter(self, name, help)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return Histogram(self, name, help, buckets)
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return Gauge(self, name, help, read)
+
+    def expose(self) -> bytes:
+        """ All metrics in the OpenMetrics text format """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines += metric.expose()
+        lines.append("# EOF\n")
+        return "\n".join(lines).encode()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves the registry of the server on GET /metrics """
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.expose()
+        self.send_response(200)
+        self.send_header('Content-type', CONTENT_TYPE)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are periodic, don't log them
+        pass
+
+def serve(registry: Registry, port: int, host: str = "127.0.0.1") -> Optional[http.server.HTTPServer]:
+    """ Serve the registry from a daemon thread
+
+    Returns:
+        http.server.HTTPServer: The server, None if the port could not be bound
+    """
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError:
+        return None
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,78 @@
+import threading
+import unittest
+import urllib.request
+
+import metrics
+
+class ExpositionTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry(prefix="longg_")
+
+    def test_counter(self):
+        counter = self.registry.counter("packets", "Packets sent")
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(counter.expose(), ["# TYPE longg_packets counter",
+                                            "# HELP longg_packets Packets sent",
+                                            "longg_packets_total 3"])
+
+    def test_counter_sums_threads(self):
+        counter = self.registry.counter("packets", "Packets sent")
+
+        def count():
+            for _ in range(1000):
+                counter.inc()
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc()
+        self.assertEqual(counter.value(), 4001)
+        self.assertEqual(len(counter.cells), 5)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram("rtt_seconds", "Round trip time", buckets=(0.1, 0.01))
+        for value in (0.005, 0.01, 0.05, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.expose(), ["# TYPE longg_rtt_seconds histogram",
+                                              "# HELP longg_rtt_seconds Round trip time",
+                                              'longg_rtt_seconds_bucket{le="0.01"} 2',
+                                              'longg_rtt_seconds_bucket{le="0.1"} 3',
+                                              'longg_rtt_seconds_bucket{le="+Inf"} 4',
+                                              "longg_rtt_seconds_count 4",
+                                              "longg_rtt_seconds_sum 2.065"])
+
+    def test_gauge_is_read_at_scrape_time(self):
+        queued = [3]
+        self.registry.gauge("queued", "Packets queued", lambda: queued[0])
+        queued[0] = 5
+        self.assertIn(b"\nlongg_queued 5\n", self.registry.expose())
+
+    def test_registry_ends_with_eof(self):
+        self.registry.counter("a", "A")
+        self.registry.counter("b", "B")
+        text = self.registry.expose().decode()
+        self.assertTrue(text.endswith("\n# EOF\n"))
+        self.assertLess(text.index("longg_a_total"), text.index("longg_b_total"))
+        self.assertEqual(metrics.Registry().expose(), b"# EOF\n")
+
+    def test_metric_needs_a_cell_layout(self):
+        self.assertRaises(TypeError, metrics._Metric, self.registry, "x", "X")
+
+class EndpointTest(unittest.TestCase):
+    def test_scrape(self):
+        registry = metrics.Registry()
+        registry.counter("packets", "Packets sent").inc()
+        server = metrics.serve(registry, 0)
+        try:
+            url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(response.headers["Content-Type"], metrics.CONTENT_TYPE)
+                self.assertEqual(response.read(), registry.expose())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,226 @@
+import argparse
+import contextlib
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import time
+import timeit
+import tracemalloc
+from typing import Callable, List
+
+"""
+    Microbenchmarks of the per packet hot paths: fragmentation, reassembly,
+    RF24 register encoding and decoding over SPI, TUN reads and writes and
+    the control protocol structs. Reports time per operation, and the peak
+    of memory allocated during one operation, so that optimizations of
+    these paths can be compared before and after.
+
+    Needs no radio or TUN device:
+        python3 microbenchmark.py
+        python3 microbenchmark.py --filter fragment --output results.json
+"""
+
+""" Number of timing repeats of at least 0.2 s each, the best one is reported """
+REPEAT = 5
+
+""" Packet sizes, a TCP ACK, a small datagram and a full MTU packet """
+PACKET_SIZES = (40, 512, 1500)
+
+def ip_packet(size: int) -> bytes:
+    """ IPv4 packet as read from TUN with IFF_NO_PI, which never starts with the aggregate tag """
+    return b"\x45" + os.urandom(size - 1)
+
+class MockSpiDev(object):
+    """
+    spidev.SpiDev-compatible register file, answers as an idle nRF24L01+
+    without simulating the radio. Keeps the cost of the SPI side out of
+    the RF24 measurements.
+    """
+    def __init__(self):
+        self.no_cs = False
+        self.registers = {reg: [0] * 5 for reg in range(0x1E)}
+        self.payload = [0] * 32
+        self.status = 0x0E # RX FIFO empty
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer2(self, data, speed_hz=0, delay_usecs=0, bits_per_word=8) -> List[int]:
+        command = data[0]
+        length = len(data) - 1
+        if command < 0x20:
+            return [self.status] + self.registers[command][:length]
+        if command < 0x40:
+            self.registers[command & 0x1F][:length] = data[1:]
+        elif command == 0x60:
+            return [self.status, len(self.payload)]
+        elif command == 0x61:
+            return [self.status] + self.payload[:length]
+        return [self.status] + [0] * length
+
+class MockPin(object):
+    """ CE pin that is only a value """
+    def __init__(self):
+        self.value = False
+
+    def switch_to_output(self, value=False):
+        self.value = value
+
+class FragmentSource(object):
+    """ Stands in for the RX radio of receive_fragment(), replaying fragments """
+    def __init__(self, fragments: list, pipe: int = 1):
+        self.fragments = fragments
+        self.index = 0
+        self.pipe = pipe
+
+    def any(self) -> int:
+        return len(self.fragments[self.index])
+
+    def read(self, length: int) -> bytearray:
+        fragment = self.fragments[self.index]
+        self.index = (self.index + 1) % len(self.fragments)
+        return bytearray(fragment)
+
+def measure(name: str, func: Callable, repeat: int) -> dict:
+    """ Time func, then trace the memory one call of it allocates
+
+    Returns:
+        dict: ns per operation of the best repeat, and the peak of memory
+        allocated by one operation in bytes
+    """
+    timer = timeit.Timer(func)
+    (number, _) = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    func() # Warm up caches and interned objects outside the trace
+    tracemalloc.start()
+    (baseline, _) = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    func()
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"name": name, "ns_per_op": best / number * 1e9,
+            "peak_bytes_per_op": max(0, peak - baseline), "ops": number * repeat}
+
+""" Benchmarks, each returns a list of (name, func) """
+
+def fragmentation_benchmarks(application) -> list:
+    benchmarks = []
+    for size in PACKET_SIZES:
+        packet = ip_packet(size)
+        benchmarks.append(("fragment/{}".format(size), lambda packet=packet: application.fragment(packet)))
+    packets = [ip_packet(40) for _ in range(8)]
+    benchmarks.append(("aggregate/8x40", lambda: application.aggregate(packets)))
+    frame = application.aggregate(packets)
+    benchmarks.append(("deaggregate/8x40", lambda: application.deaggregate(frame)))
+    return benchmarks
+
+def reassembly_benchmarks(application) -> list:
+    benchmarks = []
+    for size in PACKET_SIZES:
+        fragments = application.fragment(ip_packet(size))
+        def reassemble(fragments=fragments, size=size):
+            radio = FragmentSource(fragments)
+            buffers = {pipe: [] for pipe in range(6)}
+            for _ in fragments:
+                application.receive_fragment(radio, buffers)
+            try:
+                application.tun_out_queue.get_nowait()
+            except queue.Empty:
+                raise RuntimeError("reassemble/{}: the fragments were not reassembled into a packet".format(size)) from None
+        benchmarks.append(("reassemble/{}".format(size), reassemble))
+    return benchmarks
+
+def rf24_benchmarks() -> list:
+    from rf24 import RF24
+    radio = RF24(MockSpiDev(), MockPin(), MockPin(), 0, 0)
+    address = b"1Node"
+    def set_channel():
+        radio.channel = 76
+    return [
+        ("rf24/update", radio.update),
+        ("rf24/channel.get", lambda: radio.channel),
+        ("rf24/channel.set", set_channel),
+        ("rf24/open_tx_pipe", lambda: radio.open_tx_pipe(address)),
+        ("rf24/any", radio.any),
+        ("rf24/read/32", lambda: radio.read(32)),
+        ("rf24/write/32", lambda: radio.write(b"\x00" * 32)),
+        ("rf24/enter", radio.__enter__),
+    ]
+
+def tun_benchmarks() -> list:
+    """ Tun on one end of a datagram socketpair, which keeps packet boundaries like a TUN device """
+    from tun_interface import Tun
+    (local, remote) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    tun = Tun("bench0")
+    tun.handle = local.detach()
+    # Tun.write() prints every packet
+    devnull = open(os.devnull, "w")
+    benchmarks = []
+    for size in PACKET_SIZES:
+        packet = ip_packet(size)
+        def read(packet=packet):
+            remote.send(packet)
+            tun.read()
+        def write(packet=packet):
+            with contextlib.redirect_stdout(devnull):
+                tun.write(packet)
+            remote.recv(2048)
+        benchmarks += [("tun/read/{}".format(size), read), ("tun/write/{}".format(size), write)]
+    return benchmarks
+
+def control_benchmarks() -> list:
+    import struct
+    import control_protocol as cp
+    message = cp.encode(cp.MSG_SAMPLE, 1, 7, 1000, 0.25)
+    samples = [(node, 0.25) for node in range(1, 9)]
+    batch = cp.encode_batch(7, 1000, samples)
+    control_bytes = struct.pack('f', 0.5)
+    return [
+        ("control/encode", lambda: cp.encode(cp.MSG_SAMPLE, 1, 7, 1000, 0.25)),
+        ("control/decode", lambda: cp.decode(message)),
+        ("control/encode_batch/8", lambda: cp.encode_batch(7, 1000, samples)),
+        ("control/decode_batch/8", lambda: cp.decode_batch(batch)),
+        ("control/http_unpack", lambda: struct.unpack('f', control_bytes)[0]),
+    ]
+
+def collect() -> list:
+    import application
+    return (fragmentation_benchmarks(application) + reassembly_benchmarks(application)
+            + rf24_benchmarks() + tun_benchmarks() + control_benchmarks())
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the LongG packet hot paths")
+    parser.add_argument("--filter", default="", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--output", help="Also write the results as JSON to this file, - for stdout")
+    args = parser.parse_args()
+
+    # The hot paths log at debug level, measure them as deployed
+    logging.basicConfig(level=logging.WARNING)
+    results = []
+    for (name, func) in collect():
+        if args.filter not in name:
+            continue
+        result = measure(name, func, args.repeat)
+        results.append(result)
+        if args.output != "-":
+            print("{:<28} {:>12.0f} ns/op {:>10} B/op".format(
+                name, result["ns_per_op"], result["peak_bytes_per_op"]))
+    if args.output is None:
+        return
+    report = {"version": 1, "timestamp": time.time(), "python": sys.version.split()[0], "results": results}
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(args.output, "w") as out:
+        json.dump(report, out, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 """rf24 module containing the base class RF24"""
+from __future__ import annotations
 import time
 
 try:
@@ -28,9 +29,16 @@ try:
     from typing_extensions import Literal
 except ImportError:
     pass
-from micropython import const
-from digitalio import DigitalInOut  # type: ignore[import]
-import busio  # type: ignore[import]
+try:
+    from micropython import const
+except ImportError:
+    def const(value):
+        return value
+try:
+    from digitalio import DigitalInOut  # type: ignore[import]
+    import busio  # type: ignore[import]
+except ImportError:
+    pass  # only used in type hints, rf24_emulator radios need neither
 from cpy_spidev import SPIDevCtx
 
 CONFIGURE = const(0x00)  # IRQ masking, CRC scheme, PWR control, & RX/TX roles
@@ -53,6 +61,29 @@ def address_repr(
     return delimit.join(["%02X" % buf[byte] for byte in order])
 
 
+class RegisterBatch:
+    """Context manager of `RF24.batch()`."""
+
+    def __init__(self, radio: RF24):
+        self._radio = radio
+        self._outermost = False
+
+    def __enter__(self):
+        self._outermost = self._radio._batch is None
+        if self._outermost:
+            self._radio._batch = []
+        return self._radio
+
+    def __exit__(self, *exc):
+        if self._outermost:
+            # flush also on errors, the shadow copies already hold the writes
+            try:
+                self._radio._flush_batch()
+            finally:
+                self._radio._batch = None
+        return False
+
+
 class RF24:
     """A driver class for the nRF24L01(+) transceiver radios."""
 
@@ -66,6 +97,10 @@ class RF24:
         spi_frequency=10000000,
     ):
         self._in = bytearray(97)  # MISO buffer for full RX FIFO reads + STATUS byte
+        self._profiler = None  # SPI transaction profiler, see rf24_profiler
+        self._batch: Optional[List[bytes]] = None  # register writes queued by batch()
+        self._tx_timeout = 0.25  # seconds send() waits for TX_DS or MAX_RT
+        self._tx_timeouts = 0
         self._out = bytearray(97)  # MOSI buffer length must equal MISO buffer length
         self._ce_pin = ce_pin
         # set CE to false
@@ -125,25 +160,94 @@ class RF24:
     def __enter__(self):
         self._ce_pin.value = False
         self._config |= 2
-        self._reg_write(CONFIGURE, self._config)
         # time.sleep(0.00015)  # let the rest of this function be the delay
-        self._reg_write(RF_PA_RATE, self._rf_setup)
-        self._reg_write(OPEN_PIPES, self._open_pipes)
-        self._reg_write(DYN_PL_LEN, self._dyn_pl)
-        self._reg_write(AUTO_ACK, self._aa)
-        self._reg_write(TX_FEATURE, self._features)
-        self._reg_write(SETUP_RETR, self._retry_setup)
-        for i, addr in enumerate(self._pipes):
-            if i < 2:
-                self._reg_write_bytes(RX_ADDR_P0 + i, addr)
-            else:
-                self._reg_write(RX_ADDR_P0 + i, addr)
-            self.set_payload_length(self._pl_len[i], i)
-        self._reg_write_bytes(TX_ADDRESS, self._tx_address)
-        self._reg_write(0x05, self._channel)
-        self._reg_write(0x03, self._addr_len - 2)
+        self.sync()
         return self
 
+    def sync(self):
+        """Write the shadow copies of all configuration registers to the radio,
+        e.g. after it lost power or `verify()` found a difference."""
+        with self.batch():
+            self._reg_write(CONFIGURE, self._config)
+            self._reg_write(RF_PA_RATE, self._rf_setup)
+            self._reg_write(OPEN_PIPES, self._open_pipes)
+            self._reg_write(DYN_PL_LEN, self._dyn_pl)
+            self._reg_write(AUTO_ACK, self._aa)
+            self._reg_write(TX_FEATURE, self._features)
+            self._reg_write(SETUP_RETR, self._retry_setup)
+            for i, addr in enumerate(self._pipes):
+                if i < 2:
+                    self._reg_write_bytes(RX_ADDR_P0 + i, addr)
+                else:
+                    self._reg_write(RX_ADDR_P0 + i, addr)
+                self.set_payload_length(self._pl_len[i], i)
+            self._reg_write_bytes(TX_ADDRESS, self._tx_address)
+            self._reg_write(0x05, self._channel)
+            self._reg_write(0x03, self._addr_len - 2)
+
+    def batch(self) -> RegisterBatch:
+        """A context manager that queues the register writes made in it, and
+        sends them when it exits, in one system call on a spidev device:
+
+            with nrf.batch():
+                nrf.channel = 100
+                nrf.data_rate = 2
+
+        Reads and commands flush the queue first, so they see the writes
+        before them. The CE pin and delays are not queued, they take effect
+        at once. Batches may be nested, the outermost one sends the writes."""
+        return RegisterBatch(self)
+
+    def _flush_batch(self):
+        transfers, self._batch = (self._batch, [])
+        if not transfers:
+            return
+        if self._profiler is not None:
+            start = time.monotonic_ns()
+        with self._spi as spi:
+            if hasattr(spi, "write_many"):
+                last = spi.write_many(transfers)
+            else:
+                for out_buf in transfers:
+                    last = bytearray(len(out_buf))
+                    spi.write_readinto(out_buf, last)
+        self._in[: len(last)] = last  # keep the STATUS byte current
+        if self._profiler is not None:
+            duration = (time.monotonic_ns() - start) // len(transfers)
+            for out_buf in transfers:
+                self._profiler.record(out_buf[0], len(out_buf) - 1, duration)
+
+    def verify(self) -> List[int]:
+        """Read back all configuration registers, and return the addresses of
+        those that differ from their shadow copies."""
+        expected = {
+            CONFIGURE: self._config,
+            AUTO_ACK: self._aa,
+            OPEN_PIPES: self._open_pipes,
+            0x03: self._addr_len - 2,
+            SETUP_RETR: self._retry_setup,
+            0x05: self._channel,
+            RF_PA_RATE: self._rf_setup,
+            DYN_PL_LEN: self._dyn_pl,
+            TX_FEATURE: self._features,
+        }
+        for i in range(6):
+            expected[RX_PL_LENG + i] = self._pl_len[i]
+            if i > 1:
+                expected[RX_ADDR_P0 + i] = self._pipes[i]
+        # bit 0 of RF_SETUP is obsolete on plus variants
+        rf_setup_mask = 0xFE if self._is_plus_variant else 0xFF
+        differ = []
+        for reg, value in expected.items():
+            mask = rf_setup_mask if reg == RF_PA_RATE else 0xFF
+            if (self._reg_read(reg) ^ value) & mask:
+                differ.append(reg)
+        for reg, addr in ((RX_ADDR_P0, self._pipes[0]), (RX_ADDR_P0 + 1, self._pipes[1]),
+                          (TX_ADDRESS, self._tx_address)):
+            if self._reg_read_bytes(reg, self._addr_len) != addr[: self._addr_len]:
+                differ.append(reg)
+        return sorted(differ)
+
     def __exit__(self, *exc):
         self._ce_pin.value = False
         self._config &= 0x7D  # power off radio
@@ -160,20 +264,40 @@ class RF24:
     def ce_pin(self, val: bool):
         self._ce_pin.value = val
 
-    def _reg_read(self, reg: int) -> int:
-        self._out[0] = reg
+    def _transfer(self, buf_len: int, write: bool = False):
+        if self._batch is not None:
+            if write:
+                self._batch.append(bytes(self._out[:buf_len]))
+                return
+            self._flush_batch()
+        if self._profiler is not None:
+            start = time.monotonic_ns()
         with self._spi as spi:
             # time.sleep(0.000005)
-            spi.write_readinto(self._out, self._in, out_end=2, in_end=2)
+            spi.write_readinto(self._out, self._in, out_end=buf_len, in_end=buf_len)
+        if self._profiler is not None:
+            self._profiler.record(self._out[0], buf_len - 1, time.monotonic_ns() - start)
+
+    @property
+    def profiler(self):
+        """An `rf24_profiler.SPIProfiler` recording every SPI transaction,
+        or `None` to not record them."""
+        return self._profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self._profiler = profiler
+
+    def _reg_read(self, reg: int) -> int:
+        self._out[0] = reg
+        self._transfer(2)
         # print("SPI read 1 byte from", ("%02X" % reg), ("%02X" % self._in[1]))
         return self._in[1]
 
     def _reg_read_bytes(self, reg: int, buf_len: int = 5) -> bytearray:
         self._out[0] = reg
         buf_len += 1
-        with self._spi as spi:
-            # time.sleep(0.000005)
-            spi.write_readinto(self._out, self._in, out_end=buf_len, in_end=buf_len)
+        self._transfer(buf_len)
         # print("SPI read {} bytes from {} {}".format(
         #     buf_len - 1, ("%02X" % reg), address_repr(self._in[1 : buf_len], 0)
         # ))
@@ -183,9 +307,7 @@ class RF24:
         self._out[0] = 0x20 | reg
         buf_len = len(out_buf) + 1
         self._out[1:buf_len] = out_buf
-        with self._spi as spi:
-            # time.sleep(0.000005)
-            spi.write_readinto(self._out, self._in, out_end=buf_len, in_end=buf_len)
+        self._transfer(buf_len, write=True)
         # print("SPI write {} bytes to {} {}".format(
         #     buf_len - 1, ("%02X" % reg), address_repr(self._out[1 : buf_len], 0)
         # ))
@@ -197,9 +319,7 @@ class RF24:
             self._out[0] = (0x20 if reg != 0x50 else 0) | reg
             self._out[1] = value
             buf_len += 1
-        with self._spi as spi:
-            # time.sleep(0.000005)
-            spi.write_readinto(self._out, self._in, out_end=buf_len, in_end=buf_len)
+        self._transfer(buf_len, write=value is not None)
         # if reg != 0xFF:
         #     print(
         #         "SPI write", "command" if value is None else "1 byte to",
@@ -209,7 +329,6 @@ class RF24:
     @property
     def address_length(self) -> int:
         """This `int` is the length (in bytes) used of RX/TX addresses."""
-        self._addr_len = self._reg_read(0x03) + 2
         return self._addr_len
 
     @address_length.setter
@@ -231,7 +350,7 @@ class RF24:
         """Close a specific data pipe from RX transmissions."""
         if pipe_number < 0 or pipe_number > 5:
             raise IndexError("pipe number must be in range [0, 5]")
-        self._open_pipes = self._reg_read(OPEN_PIPES) & ~(1 << pipe_number)
+        self._open_pipes &= ~(1 << pipe_number)
         if not pipe_number:
             self._pipe0_read_addr = None
         self._reg_write(OPEN_PIPES, self._open_pipes)
@@ -251,7 +370,7 @@ class RF24:
         else:
             self._pipes[pipe_number] = address[0]
             self._reg_write(RX_ADDR_P0 + pipe_number, address[0])
-        self._open_pipes = self._reg_read(OPEN_PIPES) | (1 << pipe_number)
+        self._open_pipes |= 1 << pipe_number
         self._reg_write(OPEN_PIPES, self._open_pipes)
 
     @property
@@ -328,13 +447,11 @@ class RF24:
             self.flush_tx()
         if not send_only and self._in[0] >> 1 & 7 < 6:
             self.flush_rx()
-        up_cnt = 0
         assert isinstance(buf, (bytes, bytearray))
         self.write(buf, ask_no_ack)
-        while not self._in[0] & 0x30:
-            up_cnt += self.update()
+        if not self._wait_tx():
+            return False
         result = bool(self._in[0] & 0x20)  # type: ignore[assignment]
-        # print("send did {} updates. flags: {}".format(up_cnt, self._in[0] >> 4))
         while force_retry and not result:
             result = self.resend(send_only)
             force_retry -= 1
@@ -343,6 +460,37 @@ class RF24:
         # self._ce_pin.value = False
         return result  # type: ignore[return-value]
 
+    def _wait_tx(self) -> bool:
+        """Wait for TX_DS or MAX_RT. If neither is flagged within `tx_timeout`,
+        the radio is hung: stop transmitting, flush the TX FIFO and return
+        `False`."""
+        deadline = time.monotonic() + self._tx_timeout
+        while not self._in[0] & 0x30:
+            self.update()
+            if time.monotonic() > deadline:
+                self._ce_pin.value = False
+                self.flush_tx()
+                self._tx_timeouts += 1
+                return False
+        return True
+
+    @property
+    def tx_timeout(self) -> float:
+        """The seconds `send()` and `resend()` wait for a transmission to be
+        flagged as sent or failed, before they give up on a hung radio.
+        Defaults to 0.25, well over the 66 ms of 15 retries with the longest
+        `ard`."""
+        return self._tx_timeout
+
+    @tx_timeout.setter
+    def tx_timeout(self, timeout: float):
+        self._tx_timeout = timeout
+
+    @property
+    def tx_timeouts(self) -> int:
+        """The number of transmissions that timed out. (read-only)"""
+        return self._tx_timeouts
+
     @property
     def tx_full(self) -> bool:
         """An `bool` to represent if the TX FIFO is full. (read-only)"""
@@ -388,49 +536,50 @@ class RF24:
         self, data_recv: bool = True, data_sent: bool = True, data_fail: bool = True
     ):
         """Sets the configuration of the nRF24L01's IRQ pin. (write-only)"""
-        self._config = (self._reg_read(CONFIGURE) & 0x0F) | (not data_recv) << 6
+        self._config = (self._config & 0x0F) | (not data_recv) << 6
         self._config |= (not data_fail) << 4 | (not data_sent) << 5
         self._reg_write(CONFIGURE, self._config)
 
     def print_details(self, dump_pipes: bool = False) -> None:
         """This debugging function outputs all details about the nRF24L01."""
+        # read from the radio, leaving the shadow copies alone
         observer = self._reg_read(8)
         _fifo = self._reg_read(0x17)
-        self._config = self._reg_read(CONFIGURE)
-        self._rf_setup = self._reg_read(RF_PA_RATE)
-        self._retry_setup = self._reg_read(SETUP_RETR)
-        self._channel = self.channel
-        self._addr_len = self._reg_read(0x03) + 2
-        self._features = self._reg_read(TX_FEATURE)
-        self._aa = self._reg_read(AUTO_ACK)
-        self._dyn_pl = self._reg_read(DYN_PL_LEN)
+        config = self._reg_read(CONFIGURE)
+        rf_setup = self._reg_read(RF_PA_RATE)
+        retry_setup = self._reg_read(SETUP_RETR)
+        channel = self._reg_read(5)
+        addr_len = self._reg_read(0x03) + 2
+        features = self._reg_read(TX_FEATURE)
+        aa = self._reg_read(AUTO_ACK)
+        dyn_pl = self._reg_read(DYN_PL_LEN)
         _crc = (
-            (2 if self._config & 4 else 1)
-            if self._aa
-            else max(0, ((self._config & 0x0C) >> 2) - 1)
+            (2 if config & 4 else 1)
+            if aa
+            else max(0, ((config & 0x0C) >> 2) - 1)
         )
-        d_rate = self._rf_setup & 0x28
+        d_rate = rf_setup & 0x28
         d_rate = (2 if d_rate == 8 else 250) if d_rate else 1
-        _pa_level = (3 - ((self._rf_setup & 6) >> 1)) * -6
+        _pa_level = (3 - ((rf_setup & 6) >> 1)) * -6
         dyn_p = (
-            ("_Enabled" if self._dyn_pl else "Disabled")
-            if self._dyn_pl == 0x3F or not self._dyn_pl
-            else "0b" + "0" * (8 - len(bin(self._dyn_pl))) + bin(self._dyn_pl)[2:]
+            ("_Enabled" if dyn_pl else "Disabled")
+            if dyn_pl == 0x3F or not dyn_pl
+            else "0b" + "0" * (8 - len(bin(dyn_pl))) + bin(dyn_pl)[2:]
         )
         auto_a = (
-            ("Enabled" if self._aa else "Disabled")
-            if self._aa == 0x3F or not self._aa
-            else "0b" + "0" * (8 - len(bin(self._aa))) + bin(self._aa)[2:]
+            ("Enabled" if aa else "Disabled")
+            if aa == 0x3F or not aa
+            else "0b" + "0" * (8 - len(bin(aa))) + bin(aa)[2:]
         )
         pwr = (
             ("Standby-II" if self._ce_pin.value else "Standby-I")
-            if self._config & 2
+            if config & 2
             else "Off"
         )
         print("Is a plus variant_________{}".format(self.is_plus_variant))
         print(
-            "Channel___________________{}".format(self._channel),
-            "~ {} GHz".format((self._channel + 2400) / 1000),
+            "Channel___________________{}".format(channel),
+            "~ {} GHz".format((channel + 2400) / 1000),
         )
         print(
             "RF Data Rate______________{}".format(d_rate),
@@ -439,18 +588,18 @@ class RF24:
         print("RF Power Amplifier________{} dbm".format(_pa_level))
         print(
             "RF Low Noise Amplifier____{}abled".format(
-                "En" if bool(self._rf_setup & 1) else "Dis"
+                "En" if bool(rf_setup & 1) else "Dis"
             )
         )
         print("CRC bytes_________________{}".format(_crc))
-        print("Address length____________{} bytes".format(self._addr_len))
+        print("Address length____________{} bytes".format(addr_len))
         print("TX Payload lengths________{} bytes".format(self._pl_len[0]))
         print(
             "Auto retry delay__________{} microseconds".format(
-                ((self._retry_setup & 0xF0) >> 4) * 250 + 250
+                ((retry_setup & 0xF0) >> 4) * 250 + 250
             )
         )
-        print("Auto retry attempts_______{} maximum".format(self._retry_setup & 0x0F))
+        print("Auto retry attempts_______{} maximum".format(retry_setup & 0x0F))
         print("Re-use TX FIFO____________{}".format(bool(_fifo & 64)))
         print(
             "Packets lost on current channel_____________________{}".format(
@@ -463,15 +612,15 @@ class RF24:
             )
         )
         print(
-            "IRQ on Data Ready__{}abled".format("Dis" if self._config & 64 else "_En"),
+            "IRQ on Data Ready__{}abled".format("Dis" if config & 64 else "_En"),
             "   Data Ready___________{}".format(self.irq_dr),
         )
         print(
-            "IRQ on Data Fail___{}abled".format("Dis" if self._config & 16 else "_En"),
+            "IRQ on Data Fail___{}abled".format("Dis" if config & 16 else "_En"),
             "   Data Failed__________{}".format(self.irq_df),
         )
         print(
-            "IRQ on Data Sent___{}abled".format("Dis" if self._config & 32 else "_En"),
+            "IRQ on Data Sent___{}abled".format("Dis" if config & 32 else "_En"),
             "   Data Sent____________{}".format(self.irq_ds),
         )
         print(
@@ -484,13 +633,13 @@ class RF24:
         )
         print(
             "Ask no ACK_________{}ed    Custom ACK Payload___{}abled".format(
-                "_Allow" if self._features & 1 else "Disabl",
-                "En" if self._features & 2 else "Dis",
+                "_Allow" if features & 1 else "Disabl",
+                "En" if features & 2 else "Dis",
             ),
         )
         print("Dynamic Payloads___{}    Auto Acknowledgment__{}".format(dyn_p, auto_a))
         print(
-            "Primary Mode_____________{}X".format("R" if self._config & 1 else "T"),
+            "Primary Mode_____________{}X".format("R" if config & 1 else "T"),
             "   Power Mode___________{}".format(pwr),
         )
         if dump_pipes:
@@ -499,24 +648,26 @@ class RF24:
     def print_pipes(self) -> None:
         """Prints all information specific to pipe's addresses, RX state, & expected
         static payload sizes (if configured to use static payloads)."""
-        self._open_pipes = self._reg_read(OPEN_PIPES)
-        self._tx_address = self._reg_read_bytes(TX_ADDRESS)
+        # read from the radio, leaving the shadow copies alone
+        open_pipes = self._reg_read(OPEN_PIPES)
+        tx_address = self._reg_read_bytes(TX_ADDRESS)
+        pipes, pl_len = ([], [])
         for i in range(6):
             if i < 2:
-                self._pipes[i] = self._reg_read_bytes(RX_ADDR_P0 + i)
+                pipes.append(self._reg_read_bytes(RX_ADDR_P0 + i))
             else:
-                self._pipes[i] = self._reg_read(RX_ADDR_P0 + i)
-            self._pl_len[i] = self._reg_read(RX_PL_LENG + i)
-        print("TX address____________ 0x{}".format(address_repr(self.address())))
+                pipes.append(bytes([self._reg_read(RX_ADDR_P0 + i)]) + pipes[1][1:])
+            pl_len.append(self._reg_read(RX_PL_LENG + i))
+        print("TX address____________ 0x{}".format(address_repr(tx_address)))
         for i in range(6):
-            is_open = self._open_pipes & (1 << i)
+            is_open = open_pipes & (1 << i)
             print(
                 "Pipe {} ({}) bound: 0x{}".format(
-                    i, " open " if is_open else "closed", address_repr(self.address(i))
+                    i, " open " if is_open else "closed", address_repr(pipes[i])
                 ),
             )
             if is_open and not self._dyn_pl & (1 << i):
-                print("\t\texpecting {} byte static payloads".format(self._pl_len[i]))
+                print("\t\texpecting {} byte static payloads".format(pl_len[i]))
 
     @property
     def is_plus_variant(self) -> bool:
@@ -527,18 +678,15 @@ class RF24:
     def dynamic_payloads(self) -> int:
         """This `int` attribute is the dynamic payload length feature for
         any/all pipes."""
-        self._dyn_pl = self._reg_read(DYN_PL_LEN)
         return self._dyn_pl
 
     @dynamic_payloads.setter
     def dynamic_payloads(self, enable: Union[int, bool, Sequence[bool]]):
-        self._features = self._reg_read(TX_FEATURE)
         if isinstance(enable, bool):
             self._dyn_pl = 0x3F if enable else 0
         elif isinstance(enable, int):
             self._dyn_pl = 0x3F & enable
         elif isinstance(enable, (list, tuple)):
-            self._dyn_pl = self._reg_read(DYN_PL_LEN)
             for i, val in enumerate(enable):
                 if i < 6 and val >= 0:  # skip pipe if val is negative
                     self._dyn_pl = (self._dyn_pl & ~(1 << i)) | (bool(val) << i)
@@ -553,7 +701,7 @@ class RF24:
         if pipe_number is None:
             self.dynamic_payloads = bool(enable)
         elif 0 <= pipe_number <= 5:
-            self._dyn_pl = self._reg_read(DYN_PL_LEN) & ~(1 << pipe_number)
+            self._dyn_pl &= ~(1 << pipe_number)
             self.dynamic_payloads = self._dyn_pl | (bool(enable) << pipe_number)
         else:
             raise IndexError("pipe_number must be in range [0, 5]")
@@ -586,19 +734,17 @@ class RF24:
             self.payload_length = length
         else:
             self._pl_len[pipe_number] = max(1, min(32, length))
-            self._reg_write(RX_PL_LENG + pipe_number, length)
+            self._reg_write(RX_PL_LENG + pipe_number, self._pl_len[pipe_number])
 
     def get_payload_length(self, pipe_number: int = 0) -> int:
         """Returns an `int` describing the specified data pipe's static
         payload length."""
-        self._pl_len[pipe_number] = self._reg_read(RX_PL_LENG + pipe_number)
         return self._pl_len[pipe_number]
 
     @property
     def arc(self) -> int:
         """This `int` attribute specifies the number of attempts to
         re-transmit TX payload when ACK packet is not received."""
-        self._retry_setup = self._reg_read(SETUP_RETR)
         return self._retry_setup & 0x0F
 
     @arc.setter
@@ -611,7 +757,6 @@ class RF24:
     def ard(self) -> int:
         """This `int` attribute specifies the delay (in microseconds) between attempts
         to automatically re-transmit the TX payload when no ACK packet is received."""
-        self._retry_setup = self._reg_read(SETUP_RETR)
         return ((self._retry_setup & 0xF0) >> 4) * 250 + 250
 
     @ard.setter
@@ -639,7 +784,6 @@ class RF24:
     def auto_ack(self) -> int:
         """This `int` attribute is the automatic acknowledgment feature for
         any/all pipes."""
-        self._aa = self._reg_read(AUTO_ACK)
         return self._aa
 
     @auto_ack.setter
@@ -649,7 +793,6 @@ class RF24:
         elif isinstance(enable, int):
             self._aa = 0x3F & enable
         elif isinstance(enable, (list, tuple)):
-            self._aa = self._reg_read(AUTO_ACK)
             for i, val in enumerate(enable):
                 if i < 6 and val >= 0:  # skip pipe if val is negative
                     self._aa = (self._aa & ~(1 << i)) | (bool(val) << i)
@@ -662,7 +805,7 @@ class RF24:
         if pipe_number is None:
             self.auto_ack = bool(enable)
         elif 0 <= pipe_number <= 5:
-            self._aa = self._reg_read(AUTO_ACK) & ~(1 << pipe_number)
+            self._aa &= ~(1 << pipe_number)
             self.auto_ack = self._aa | (bool(enable) << pipe_number)
         else:
             raise IndexError("pipe_number must be in range [0, 5]")
@@ -670,16 +813,12 @@ class RF24:
     def get_auto_ack(self, pipe_number: int) -> bool:
         """Returns a `bool` describing the `auto_ack` feature about a data pipe."""
         if 0 <= pipe_number <= 5:
-            self._aa = self._reg_read(AUTO_ACK)
             return bool(self._aa & (1 << pipe_number))
         raise IndexError("pipe_number must be in range [0, 5]")
 
     @property
     def ack(self) -> bool:
         """Represents use of custom payloads as part of the ACK packet."""
-        self._aa = self._reg_read(AUTO_ACK)
-        self._dyn_pl = self._reg_read(DYN_PL_LEN)
-        self._features = self._reg_read(TX_FEATURE)
         return bool((self._features & 6) == 6 and ((self._aa & self._dyn_pl) & 1))
 
     @ack.setter
@@ -708,18 +847,16 @@ class RF24:
     @property
     def allow_ask_no_ack(self) -> bool:
         """Allow or disable ``ask_no_ack`` parameter to `send()` & `write()`."""
-        self._features = self._reg_read(TX_FEATURE)
         return bool(self._features & 1)
 
     @allow_ask_no_ack.setter
     def allow_ask_no_ack(self, enable: bool):
-        self._features = self._reg_read(TX_FEATURE) & 6 | bool(enable)
+        self._features = self._features & 6 | bool(enable)
         self._reg_write(TX_FEATURE, self._features)
 
     @property
     def data_rate(self) -> int:
         """This `int` attribute specifies the RF data rate."""
-        self._rf_setup = self._reg_read(RF_PA_RATE)
         rf_setup = self._rf_setup & 0x28
         return (2 if rf_setup == 8 else 250) if rf_setup else 1
 
@@ -728,13 +865,13 @@ class RF24:
         if speed not in (1, 2, 250):
             raise ValueError("data_rate must be 1 (Mbps), 2 (Mbps), or 250 (kbps)")
         speed = 0 if speed == 1 else (0x20 if speed != 2 else 8)
-        self._rf_setup = self._reg_read(RF_PA_RATE) & 0xD7 | speed
+        self._rf_setup = self._rf_setup & 0xD7 | speed
         self._reg_write(RF_PA_RATE, self._rf_setup)
 
     @property
     def channel(self) -> int:
         """This `int` attribute specifies the nRF24L01's frequency."""
-        return self._reg_read(5)
+        return self._channel
 
     @channel.setter
     def channel(self, channel: int):
@@ -746,8 +883,6 @@ class RF24:
     @property
     def crc(self) -> int:
         """This `int` attribute specifies the CRC checksum length in bytes."""
-        self._config = self._reg_read(CONFIGURE)
-        self._aa = self._reg_read(AUTO_ACK)
         if self._aa:
             return 2 if self._config & 4 else 1
         return max(0, ((self._config & 0x0C) >> 2) - 1)
@@ -762,19 +897,17 @@ class RF24:
     @property
     def power(self) -> bool:
         """This `bool` attribute controls the power state of the nRF24L01."""
-        self._config = self._reg_read(CONFIGURE)
         return bool(self._config & 2)
 
     @power.setter
     def power(self, is_on: bool):
-        self._config = self._reg_read(CONFIGURE) & 0x7D | bool(is_on) << 1
+        self._config = self._config & 0x7D | bool(is_on) << 1
         self._reg_write(CONFIGURE, self._config)
         time.sleep(0.00015)
 
     @property
     def pa_level(self) -> int:
         """This `int` is the power amplifier level (in dBm)."""
-        self._rf_setup = self._reg_read(RF_PA_RATE)
         return (3 - ((self._rf_setup & 6) >> 1)) * -6
 
     @pa_level.setter
@@ -791,7 +924,6 @@ class RF24:
     @property
     def is_lna_enabled(self) -> bool:
         """A read-only `bool` attribute about the LNA gain feature."""
-        self._rf_setup = self._reg_read(RF_PA_RATE)
         return bool(self._rf_setup & 1)
 
     def resend(self, send_only: bool = False):
@@ -803,13 +935,11 @@ class RF24:
             self.flush_rx()
         self.clear_status_flags()
         # self._reg_write(0xE3)
-        up_cnt = 0
         self._ce_pin.value = True
-        while not self._in[0] & 0x30:
-            up_cnt += self.update()
+        if not self._wait_tx():
+            return False
         # self._ce_pin.value = False
         result = bool(self._in[0] & 0x20)
-        # print("resend did {} updates. flags: {}".format(up_cnt, self._in[0] >> 4))
         if result and self._in[0] & 0x40 and not send_only:
             return self.read()
         return result
@@ -0,0 +1,551 @@
+import math
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from typing import List, Optional, Tuple
+
+"""
+    Hardware-free nRF24L01+ emulator. EmulatedRadio models the register
+    map, FIFOs, STATUS bits, auto-ack and auto-retransmit of one radio, and
+    offers a SpiDev-compatible device and a DigitalInOut-compatible CE pin,
+    so RF24 drives it through SPIDevCtx unchanged:
+
+        ether = Ether(loss=0.01, latency=0.0005)
+        radio = EmulatedRadio(ether)
+        nrf = RF24(radio.spi, 0, radio.ce, 0, 0)
+
+    Radios transmit on a shared Ether, which delivers each transmission
+    after its airtime and latency, drops it with a probability and when
+    transmissions on the same channel overlap. Radios in other processes
+    share the air when their Ethers are bound to UDP addresses and list
+    each other as peers. The processes may run on other hosts, so no clock
+    is shared: a transmission is sent with its times relative to the time
+    of sending, and taken as relative to the time the datagram arrived,
+    neglecting the UDP delay. An ACK is sent with its time from the end of
+    the transmission, which the sender knows in its own clock.
+
+    ACK payloads and the non-plus ACTIVATE command are not modelled.
+"""
+
+""" Register addresses """
+CONFIG = 0x00
+EN_AA = 0x01
+EN_RXADDR = 0x02
+SETUP_AW = 0x03
+SETUP_RETR = 0x04
+RF_CH = 0x05
+RF_SETUP = 0x06
+STATUS = 0x07
+OBSERVE_TX = 0x08
+RPD = 0x09
+RX_ADDR_P0 = 0x0A
+RX_ADDR_P1 = 0x0B
+TX_ADDR = 0x10
+RX_PW_P0 = 0x11
+FIFO_STATUS = 0x17
+DYNPD = 0x1C
+FEATURE = 0x1D
+ADDRESS_REGISTERS = (RX_ADDR_P0, RX_ADDR_P1, TX_ADDR)
+
+""" STATUS bits """
+RX_DR = 0x40
+TX_DS = 0x20
+MAX_RT = 0x10
+
+""" Commands """
+R_RX_PL_WID = 0x60
+R_RX_PAYLOAD = 0x61
+W_TX_PAYLOAD = 0xA0
+W_ACK_PAYLOAD = 0xA8
+W_TX_PAYLOAD_NOACK = 0xB0
+FLUSH_TX = 0xE1
+FLUSH_RX = 0xE2
+REUSE_TX_PL = 0xE3
+ACTIVATE = 0x50
+NOP = 0xFF
+
+FIFO_DEPTH = 3
+
+""" Timing """
+TX_SETTLE = 130e-6 # s, PLL settling before every transmission
+ARD_STEP = 250e-6 # s, auto-retransmit delay unit
+DATA_RATES = {0x00: 1e6, 0x08: 2e6, 0x20: 250e3} # RF_SETUP RF_DR bits -> bit/s
+PCF_BITS = 9 # Packet control field of Enhanced ShockBurst
+
+""" Transmissions are kept this long after their end, for collision checks """
+AIR_HISTORY = 0.1 # s
+
+""" 
+    Real time a sender waits past the auto-retransmit delay for the verdict
+    of a radio in another process, which carries the simulated ACK time
+"""
+ACK_GRACE = 0.005 # s
+
+""" Inter-process messages of the Ether, see Ether for their times """
+MSG_TRANSMISSION = 1
+MSG_ACK = 2
+TRANSMISSION = struct.Struct("!BIIBBBIddB")
+ACK = struct.Struct("!BIId")
+NO_ACK = math.nan
+
+""" Linux socket option for kernel receive timestamps, missing from the socket module """
+SO_TIMESTAMPNS = 35
+TIMESPEC = struct.Struct("qq")
+
+def airtime(payload_length: int, address_width: int, crc_length: int, data_rate: float) -> float:
+    """ Time on air of a packet in s """
+    bits = 8 * (1 + address_width + payload_length + crc_length) + PCF_BITS
+    return bits / data_rate
+
+class Transmission(object):
+    """ One attempt of a radio to send a packet """
+    __slots__ = ("origin", "number", "channel", "rate", "address", "payload", "pid",
+                 "no_ack", "start", "end", "sender", "ack_time", "answered", "resolved")
+
+    def __init__(self, origin, number, channel, rate, address, payload, pid, no_ack, start, end, sender=None):
+        self.origin = origin
+        self.number = number
+        self.channel = channel
+        self.rate = rate
+        self.address = address
+        self.payload = payload
+        self.pid = pid
+        self.no_ack = no_ack
+        self.start = start
+        self.end = end
+        self.sender = sender # Sending EmulatedRadio, None for remote transmissions
+        self.ack_time = None # Arrival time of the ACK at the sender
+        self.answered = False # A remote receiver has sent its verdict
+        self.resolved = False
+
+    def overlaps(self, other) -> bool:
+        return (other is not self and other.channel == self.channel
+                and other.start < self.end and self.start < other.end)
+
+class Ether(object):
+    """
+    The air shared by emulated radios
+
+    Args:
+        loss (float): Probability that a packet, or its ACK, is lost
+        latency (float): Propagation and processing delay in s, each way
+        collisions (bool): Drop transmissions that overlap on a channel
+        seed: Seed of the loss process
+        bind (Tuple[str, int]): UDP address for radios in other processes
+        peers (List[Tuple[str, int]]): UDP addresses of the other Ethers
+    """
+    def __init__(self, loss=0.0, latency=0.0, collisions=True, seed=None, bind=None, peers=()):
+        self.loss = loss
+        self.latency = latency
+        self.collisions = collisions
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.radios = []
+        self.air = []
+        self.origin = random.getrandbits(32)
+        self.transmissions = 0
+        self.peers = list(peers)
+        self.sock = None
+        self.thread = None
+        self.running = False
+        if bind is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(bind)
+            self.sock.setblocking(False)
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            # Written to by close(), to wake the delivery thread
+            (self.wake_r, self.wake_w) = os.pipe()
+            self.running = True
+            self.thread = threading.Thread(target=self._deliver, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        """ Stop the delivery thread, then close the socket to the other processes """
+        if self.thread is None:
+            return
+        self.running = False
+        os.write(self.wake_w, b"\0")
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            self.sock.close()
+            self.sock = None
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def attach(self, radio):
+        with self.lock:
+            self.radios.append(radio)
+
+    def lost(self) -> bool:
+        return self.loss > 0 and self.random.random() < self.loss
+
+    def transmit(self, sender, channel, rate, address, payload, pid, no_ack, start, end) -> Transmission:
+        """ Put a transmission on the air """
+        with self.lock:
+            self.transmissions += 1
+            tx = Transmission(self.origin, self.transmissions, channel, rate, address, payload,
+                              pid, no_ack, start, end, sender)
+            self.air.append(tx)
+        if self.sock is not None:
+            now = time.monotonic()
+            message = TRANSMISSION.pack(MSG_TRANSMISSION, tx.origin, tx.number, channel,
+                                        pid, no_ack, int(rate), start - now, end - now, len(address))
+            message += bytes(address) + bytes(payload)
+            for peer in self.peers:
+                self.sock.sendto(message, peer)
+        return tx
+
+    def ack(self, tx: Transmission, ack_time: Optional[float]):
+        """
+        Send the ACK of a received transmission, unless it is lost. A
+        receiver that doesn't ACK passes None, so remote senders stop waiting
+        """
+        if ack_time is not None and self.lost():
+            ack_time = None
+        if tx.sender is not None:
+            tx.ack_time = ack_time
+        elif self.sock is not None:
+            verdict = ACK.pack(MSG_ACK, tx.origin, tx.number,
+                               NO_ACK if ack_time is None else ack_time - tx.end)
+            for peer in self.peers:
+                self.sock.sendto(verdict, peer)
+
+    def poll(self, now: float) -> Optional[float]:
+        """
+        Deliver transmissions that have arrived by now. Returns the arrival
+        time of the next pending transmission, None if there is none
+        """
+        next_arrival = None
+        with self.lock:
+            if self.sock is not None:
+                self._drain()
+            for tx in self.air:
+                if tx.resolved:
+                    continue
+                arrival = tx.end + self.latency
+                if arrival > now:
+                    next_arrival = arrival if next_arrival is None else min(next_arrival, arrival)
+                    continue
+                tx.resolved = True
+                collided = self.collisions and any(tx.overlaps(other) for other in self.air)
+                for radio in self.radios:
+                    if radio is not tx.sender and radio.receive(tx, collided, arrival):
+                        break
+            while self.air and self.air[0].resolved and self.air[0].end + AIR_HISTORY < now:
+                self.air.pop(0)
+        return next_arrival
+
+    def _drain(self):
+        """ Take in transmissions and ACKs of other processes. Called with the lock held """
+        while True:
+            try:
+                (message, ancdata, _, _) = self.sock.recvmsg(128, socket.CMSG_SPACE(TIMESPEC.size))
+            except (BlockingIOError, InterruptedError):
+                return
+            if len(message) < ACK.size:
+                continue # Stray datagram
+            if message[0] == MSG_TRANSMISSION and len(message) >= TRANSMISSION.size:
+                (_, origin, number, channel, pid, no_ack, rate, start, end, width) = TRANSMISSION.unpack_from(message)
+                address = message[TRANSMISSION.size:TRANSMISSION.size + width]
+                payload = message[TRANSMISSION.size + width:]
+                received = self._received(ancdata)
+                self.air.append(Transmission(origin, number, channel, rate, address,
+                                             payload, pid, bool(no_ack), received + start, received + end))
+            elif message[0] == MSG_ACK and len(message) == ACK.size:
+                (_, origin, number, ack_delay) = ACK.unpack(message)
+                for tx in self.air:
+                    if tx.origin == origin and tx.number == number:
+                        tx.answered = True
+                        tx.ack_time = None if math.isnan(ack_delay) else tx.end + ack_delay
+
+    @staticmethod
+    def _received(ancdata) -> float:
+        """
+        Time a datagram arrived, from its kernel timestamp. The radios may
+        poll long after, and a transmission shouldn't be delayed by that
+        """
+        now = time.monotonic()
+        for (level, kind, data) in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= TIMESPEC.size:
+                (seconds, nanoseconds) = TIMESPEC.unpack_from(data)
+                # The timestamp is in wall clock time, only its age is used
+                return now - max(0.0, time.time() - seconds - nanoseconds / 1e9)
+        return now
+
+    def _deliver(self):
+        """ Deliver remote transmissions in time while no local radio polls """
+        timeout = None
+        while True:
+            select.select([self.sock, self.wake_r], [], [], timeout)
+            if not self.running:
+                return
+            next_arrival = self.poll(time.monotonic())
+            timeout = None if next_arrival is None else max(0.00005, next_arrival - time.monotonic())
+
+class EmulatedPin(object):
+    """ DigitalInOut-compatible CE pin of an emulated radio """
+    def __init__(self, radio):
+        self._radio = radio
+        self._value = False
+
+    def switch_to_output(self, value=False):
+        self.value = value
+
+    @property
+    def value(self) -> bool:
+        return self._value
+
+    @value.setter
+    def value(self, val):
+        with self._radio.ether.lock:
+            self._value = bool(val)
+            self._radio.update()
+
+class EmulatedSpiDev(object):
+    """ spidev.SpiDev-compatible SPI device of an emulated radio """
+    def __init__(self, radio):
+        self._radio = radio
+        self.no_cs = False
+        self.max_speed_hz = 10000000
+        self.mode = 0
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer2(self, data, speed_hz=0, delay_usecs=0, bits_per_word=8) -> List[int]:
+        return self._radio.transfer(bytes(data))
+
+class EmulatedRadio(object):
+    """ Register model of one nRF24L01+ on an Ether """
+    def __init__(self, ether: Ether):
+        self.ether = ether
+        self.registers = bytearray(0x1E)
+        self.registers[CONFIG] = 0x08
+        self.registers[EN_AA] = 0x3F
+        self.registers[EN_RXADDR] = 0x03
+        self.registers[SETUP_AW] = 0x03
+        self.registers[SETUP_RETR] = 0x03
+        self.registers[RF_CH] = 0x02
+        self.registers[RF_SETUP] = 0x0E
+        self.addresses = {
+            RX_ADDR_P0: bytearray(b"\xE7" * 5),
+            RX_ADDR_P1: bytearray(b"\xC2" * 5),
+            TX_ADDR: bytearray(b"\xE7" * 5),
+        }
+        for pipe in range(2, 6):
+            self.registers[RX_ADDR_P0 + pipe] = 0xC1 + pipe
+        self.status = 0
+        self.rx_fifo = [] # (pipe, payload)
+        self.tx_fifo = [] # (payload, no_ack)
+        self.reuse = False
+        self.pid = 0
+        self.last_pid = {} # pipe -> (pid, payload) of the last packet, to drop retransmissions
+        self.attempt = None # Transmission in progress
+        self.current = None # TX FIFO entry of the attempts
+        self.retrying = False
+        self.retransmits = 0
+        self.next_start = 0.0
+        self.lost_packets = 0
+        self.spi = EmulatedSpiDev(self)
+        self.ce = EmulatedPin(self)
+        ether.attach(self)
+
+    """ Configuration derived from the registers """
+    def address_width(self) -> int:
+        return (self.registers[SETUP_AW] & 3) + 2
+
+    def crc_length(self) -> int:
+        config = self.registers[CONFIG]
+        return 0 if not config & 0x08 else (2 if config & 0x04 else 1)
+
+    def data_rate(self) -> float:
+        return DATA_RATES.get(self.registers[RF_SETUP] & 0x28, 1e6)
+
+    def powered(self) -> bool:
+        return bool(self.registers[CONFIG] & 0x02)
+
+    def listening(self) -> bool:
+        return self.powered() and bool(self.registers[CONFIG] & 0x01) and self.ce.value
+
+    def pipe_address(self, pipe: int) -> bytes:
+        width = self.address_width()
+        if pipe < 2:
+            return bytes(self.addresses[RX_ADDR_P0 + pipe][:width])
+        return bytes([self.registers[RX_ADDR_P0 + pipe]]) + bytes(self.addresses[RX_ADDR_P1][1:width])
+
+    def status_byte(self) -> int:
+        rx_pipe = self.rx_fifo[0][0] if self.rx_fifo else 7
+        return self.status | rx_pipe << 1 | (len(self.tx_fifo) >= FIFO_DEPTH)
+
+    def fifo_status(self) -> int:
+        return (self.reuse << 6 | (len(self.tx_fifo) >= FIFO_DEPTH) << 5 | (not self.tx_fifo) << 4
+                | (len(self.rx_fifo) >= FIFO_DEPTH) << 1 | (not self.rx_fifo))
+
+    def observe_tx(self) -> int:
+        return min(self.lost_packets, 15) << 4 | self.retransmits
+
+    def transfer(self, data: bytes) -> List[int]:
+        """ One SPI transaction: a command and its data, returns MISO bytes """
+        with self.ether.lock:
+            self.update()
+            command = data[0]
+            response = [self.status_byte()] + [0] * (len(data) - 1)
+            if command < 0x20:
+                response[1:] = self.read_register(command, len(data) - 1)
+            elif command < 0x40:
+                self.write_register(command & 0x1F, data[1:])
+            elif command == R_RX_PL_WID:
+                response[1:2] = [len(self.rx_fifo[0][1]) if self.rx_fifo else 0][:len(data) - 1]
+            elif command == R_RX_PAYLOAD:
+                if self.rx_fifo:
+                    payload = self.rx_fifo.pop(0)[1]
+                    response[1:] = (list(payload) + [0] * len(data))[:len(data) - 1]
+            elif command in (W_TX_PAYLOAD, W_TX_PAYLOAD_NOACK):
+                if len(self.tx_fifo) < FIFO_DEPTH:
+                    self.reuse = False
+                    self.tx_fifo.append((bytes(data[1:33]), command == W_TX_PAYLOAD_NOACK))
+            elif command == FLUSH_TX:
+                self.tx_fifo.clear()
+                self.reuse = False
+            elif command == FLUSH_RX:
+                self.rx_fifo.clear()
+            elif command == REUSE_TX_PL:
+                self.reuse = True
+            # W_ACK_PAYLOAD, ACTIVATE and NOP only return STATUS
+            self.update()
+            return response
+
+    def read_register(self, register: int, length: int) -> List[int]:
+        if register in ADDRESS_REGISTERS:
+            value = list(self.addresses[register])
+        elif register == STATUS:
+            value = [self.status_byte()]
+        elif register == OBSERVE_TX:
+            value = [self.observe_tx()]
+        elif register == FIFO_STATUS:
+            value = [self.fifo_status()]
+        elif register < len(self.registers):
+            value = [self.registers[register]]
+        else:
+            value = [0]
+        return (value + [0] * length)[:length]
+
+    def write_register(self, register: int, value: bytes):
+        if not value:
+            return
+        if register in ADDRESS_REGISTERS:
+            self.addresses[register][:len(value)] = value[:5]
+        elif register == STATUS:
+            # Interrupt flags are cleared by writing 1
+            self.status &= ~(value[0] & (RX_DR | TX_DS | MAX_RT))
+        elif register == RF_CH:
+            self.registers[RF_CH] = value[0] & 0x7F
+            self.lost_packets = 0
+        elif register in (OBSERVE_TX, RPD, FIFO_STATUS):
+            pass
+        elif register < len(self.registers):
+            self.registers[register] = value[0]
+
+    def update(self, now: Optional[float] = None):
+        """ Advance the radio and the air to now. Called with the ether lock held """
+        now = time.monotonic() if now is None else now
+        self.ether.poll(now)
+        if self.attempt is not None:
+            self.finish_attempt(now)
+        if (self.attempt is None and self.tx_fifo and self.ce.value and self.powered()
+                and not self.registers[CONFIG] & 0x01 and not self.status & MAX_RT):
+            self.start_attempt(max(now, self.next_start))
+
+    def ard(self) -> float:
+        return ((self.registers[SETUP_RETR] >> 4) + 1) * ARD_STEP
+
+    def expects_ack(self, no_ack: bool) -> bool:
+        # The ACK is received on pipe 0, which must listen on the TX address
+        return (not no_ack and bool(self.registers[EN_AA] & 1)
+                and self.pipe_address(0) == bytes(self.addresses[TX_ADDR][:self.address_width()]))
+
+    def start_attempt(self, start: float):
+        (payload, no_ack) = self.tx_fifo[0]
+        if self.tx_fifo[0] is not self.current:
+            self.current = self.tx_fifo[0]
+            self.pid = (self.pid + 1) & 3
+        if not self.retrying:
+            self.retransmits = 0
+        self.retrying = False
+        start += TX_SETTLE
+        end = start + airtime(len(payload), self.address_width(), self.crc_length(), self.data_rate())
+        address = bytes(self.addresses[TX_ADDR][:self.address_width()])
+        self.attempt = self.ether.transmit(self, self.registers[RF_CH], self.data_rate(), address,
+                                           payload, self.pid, no_ack, start, end)
+
+    def finish_attempt(self, now: float):
+        tx = self.attempt
+        if not self.expects_ack(tx.no_ack):
+            if now < tx.end:
+                return
+            self.sent()
+            return
+        deadline = tx.end + self.ard()
+        if tx.ack_time is not None and tx.ack_time <= deadline:
+            if now >= tx.ack_time:
+                self.sent()
+            return
+        if now < deadline:
+            return
+        if self.ether.sock is not None and not tx.answered and now < deadline + ACK_GRACE:
+            return
+        self.attempt = None
+        if self.retransmits < self.registers[SETUP_RETR] & 0x0F:
+            self.retransmits += 1
+            self.retrying = True
+            self.next_start = deadline
+            return
+        self.status |= MAX_RT
+        self.lost_packets += 1
+
+    def sent(self):
+        self.attempt = None
+        self.status |= TX_DS
+        if not self.reuse:
+            self.tx_fifo.pop(0)
+
+    def receive(self, tx: Transmission, collided: bool, arrival: float) -> bool:
+        """ Take in a transmission addressed to this radio. Returns True if it was addressed here """
+        if not self.listening() or tx.channel != self.registers[RF_CH]:
+            return False
+        if tx.rate != self.data_rate():
+            return False
+        pipe = next((pipe for pipe in range(6) if self.registers[EN_RXADDR] & (1 << pipe)
+                     and self.pipe_address(pipe) == bytes(tx.address)), None)
+        if pipe is None:
+            return False
+        if collided or self.ether.lost():
+            self.ether.ack(tx, None)
+            return True
+        duplicate = self.last_pid.get(pipe) == (tx.pid, tx.payload)
+        if not duplicate:
+            if len(self.rx_fifo) >= FIFO_DEPTH:
+                # A full RX FIFO drops the packet without ACK
+                self.ether.ack(tx, None)
+                return True
+            payload = tx.payload
+            if not (self.registers[DYNPD] & (1 << pipe) and self.registers[FEATURE] & 0x04):
+                width = self.registers[RX_PW_P0 + pipe]
+                payload = (bytes(payload) + bytes(32))[:width]
+            self.rx_fifo.append((pipe, bytes(payload)))
+            self.last_pid[pipe] = (tx.pid, tx.payload)
+            self.status |= RX_DR
+        if not tx.no_ack and self.registers[EN_AA] & (1 << pipe):
+            ack = airtime(0, self.address_width(), self.crc_length(), self.data_rate())
+            self.ether.ack(tx, arrival + TX_SETTLE + ack + self.ether.latency)
+        else:
+            self.ether.ack(tx, None)
+        return True
@@ -0,0 +1,118 @@
+import socket
+import time
+import unittest
+
+from rf24 import RF24
+from rf24_emulator import ACK, MSG_ACK, MSG_TRANSMISSION, NO_ACK, TRANSMISSION, EmulatedRadio, Ether
+
+ADDRESS = b"1Node"
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def radio(ether: Ether) -> RF24:
+    emulated = EmulatedRadio(ether)
+    nrf = RF24(emulated.spi, 0, emulated.ce, 0, 0)
+    nrf.tx_timeout = 1.0
+    return nrf
+
+class LocalEtherTest(unittest.TestCase):
+    def test_send_and_receive(self):
+        ether = Ether()
+        (tx, rx) = (radio(ether), radio(ether))
+        rx.open_rx_pipe(1, ADDRESS)
+        rx.listen = True
+        tx.open_tx_pipe(ADDRESS)
+        tx.listen = False
+        self.assertTrue(tx.send(b"hello"))
+        self.assertTrue(rx.available())
+        self.assertEqual(rx.pipe, 1)
+        self.assertEqual(bytes(rx.read()), b"hello")
+
+    def test_nobody_listening(self):
+        tx = radio(Ether())
+        tx.open_tx_pipe(ADDRESS)
+        tx.listen = False
+        self.assertFalse(tx.send(b"hello"))
+
+class RemoteEtherTest(unittest.TestCase):
+    def setUp(self):
+        (port_a, port_b) = (free_port(), free_port())
+        self.ether_a = Ether(bind=("127.0.0.1", port_a), peers=[("127.0.0.1", port_b)])
+        self.ether_b = Ether(bind=("127.0.0.1", port_b), peers=[("127.0.0.1", port_a)])
+
+    def tearDown(self):
+        self.ether_a.close()
+        self.ether_b.close()
+
+    def test_send_and_receive(self):
+        (tx, rx) = (radio(self.ether_a), radio(self.ether_b))
+        rx.open_rx_pipe(1, ADDRESS)
+        rx.listen = True
+        tx.open_tx_pipe(ADDRESS)
+        tx.listen = False
+        for payload in (b"one", b"two", b"three"):
+            self.assertTrue(tx.send(payload))
+            deadline = time.monotonic() + 1
+            while not rx.available() and time.monotonic() < deadline:
+                pass
+            self.assertEqual(bytes(rx.read()), payload)
+
+    def remote(self, messages: list, answered: bool) -> list:
+        """ Send messages as an Ether of another process, returns the transmissions it put on the air """
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for message in messages:
+            sender.sendto(message, self.ether_b.sock.getsockname())
+        sender.close()
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline:
+            with self.ether_b.lock:
+                air = [tx for tx in self.ether_b.air if tx.origin == 1]
+            if air and (air[0].answered or not answered):
+                break
+        return air
+
+    def test_times_are_relative_to_arrival(self):
+        # Times far from this host's clock, as sent by an Ether on another host
+        sent = time.monotonic()
+        air = self.remote([TRANSMISSION.pack(MSG_TRANSMISSION, 1, 1, 2, 0, 0, 1000000, 0.001, 0.002, 5)
+                           + ADDRESS + b"x", ACK.pack(MSG_ACK, 1, 1, NO_ACK)], True)
+        self.assertTrue(sent < air[0].start < time.monotonic() + 0.001)
+        self.assertAlmostEqual(air[0].end - air[0].start, 0.001)
+        self.assertIsNone(air[0].ack_time)
+
+    def test_late_drain_keeps_the_arrival_time(self):
+        self.ether_b.close()
+        self.ether_b = Ether(bind=("127.0.0.1", 0))
+        self.ether_b.lock.acquire()
+        sent = time.monotonic()
+        try:
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.sendto(TRANSMISSION.pack(MSG_TRANSMISSION, 1, 1, 2, 0, 0, 1000000, 0.001, 0.002, 5)
+                          + ADDRESS + b"x", self.ether_b.sock.getsockname())
+            sender.close()
+            time.sleep(0.1)
+        finally:
+            self.ether_b.lock.release()
+        air = self.remote([], False)
+        self.assertLess(air[0].start, sent + 0.05)
+
+    def test_stray_datagrams_are_skipped(self):
+        thread = self.ether_b.thread
+        self.remote([b"", b"\x01", ACK.pack(MSG_ACK, 1, 1, NO_ACK)[:-1]], False)
+        air = self.remote([TRANSMISSION.pack(MSG_TRANSMISSION, 1, 1, 2, 0, 0, 1000000, 0.001, 0.002, 5)
+                           + ADDRESS + b"x"], False)
+        self.assertEqual(len(air), 1)
+        self.assertTrue(thread.is_alive())
+
+    def test_close_stops_the_delivery_thread(self):
+        thread = self.ether_b.thread
+        self.ether_b.close()
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.ether_b.sock)
+        self.ether_b.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import sys
+import threading
+from typing import Optional
+
+"""
+    SPI transaction profiler of the RF24 driver. While a profiler is set,
+    every register read or write and every command of the radio is recorded
+    with its length and duration, and attributed to the outermost RF24
+    method or property it was made by:
+
+        profiler = SPIProfiler()
+        nrf.profiler = profiler
+        ...
+        print(profiler.report())
+
+    Attribution walks the Python stack, so profiling is for finding out what
+    the driver costs, not for production.
+"""
+
+""" Names of registers and commands, by SPI command byte """
+REGISTERS = {
+    0x00: "CONFIG", 0x01: "EN_AA", 0x02: "EN_RXADDR", 0x03: "SETUP_AW", 0x04: "SETUP_RETR",
+    0x05: "RF_CH", 0x06: "RF_SETUP", 0x07: "STATUS", 0x08: "OBSERVE_TX", 0x09: "RPD",
+    0x0A: "RX_ADDR_P0", 0x0B: "RX_ADDR_P1", 0x0C: "RX_ADDR_P2", 0x0D: "RX_ADDR_P3",
+    0x0E: "RX_ADDR_P4", 0x0F: "RX_ADDR_P5", 0x10: "TX_ADDR", 0x11: "RX_PW_P0", 0x12: "RX_PW_P1",
+    0x13: "RX_PW_P2", 0x14: "RX_PW_P3", 0x15: "RX_PW_P4", 0x16: "RX_PW_P5", 0x17: "FIFO_STATUS",
+    0x1C: "DYNPD", 0x1D: "FEATURE",
+}
+COMMANDS = {
+    0x50: "ACTIVATE", 0x60: "R_RX_PL_WID", 0x61: "R_RX_PAYLOAD", 0xA0: "W_TX_PAYLOAD",
+    0xB0: "W_TX_PAYLOAD_NOACK", 0xE1: "FLUSH_TX", 0xE2: "FLUSH_RX", 0xE3: "REUSE_TX_PL", 0xFF: "NOP",
+}
+
+def command_name(command: int) -> str:
+    """ Name of an SPI command byte, R_/W_ and the register for register access """
+    if command < 0x20:
+        return "R_" + REGISTERS.get(command, "%02X" % command)
+    if command < 0x40:
+        return "W_" + REGISTERS.get(command & 0x1F, "%02X" % (command & 0x1F))
+    if command & 0xF8 == 0xA8:
+        return "W_ACK_PAYLOAD"
+    return COMMANDS.get(command, "%02X" % command)
+
+class CallStats(object):
+    """ SPI transactions of one RF24 method """
+    __slots__ = ("calls", "transactions", "bytes", "duration", "commands")
+
+    def __init__(self):
+        self.calls = 0
+        self.transactions = 0
+        self.bytes = 0
+        self.duration = 0 # ns
+        self.commands = {}
+
+class SPIProfiler(object):
+    """ Aggregates SPI transactions per RF24 method, may be shared by radios """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.local = threading.local()
+
+    def record(self, command: int, length: int, duration: int):
+        """ Record a transaction, called by the driver
+
+        Args:
+            command (int): SPI command byte
+            length (int): Bytes transferred after the command byte
+            duration (int): Duration of the transaction in ns
+        """
+        # Outermost frame of the driver module that made the transaction
+        frame = sys._getframe(1)
+        driver = frame.f_globals
+        call = frame
+        while frame is not None and frame.f_globals is driver:
+            call = frame
+            frame = frame.f_back
+        # A transaction of another call than the last one of this thread starts a call
+        new_call = getattr(self.local, "call", None) is not call
+        self.local.call = call
+        name = call.f_code.co_name
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = CallStats()
+            stats.calls += new_call
+            stats.transactions += 1
+            stats.bytes += 1 + length
+            stats.duration += duration
+            stats.commands[command] = stats.commands.get(command, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def report(self, commands: Optional[int] = 4) -> str:
+        """ Table of the SPI transactions per call, most time first
+
+        Args:
+            commands (int): Most frequent commands listed per method, None for all
+        """
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1].duration, reverse=True)
+            lines = ["{:<20} {:>9} {:>9} {:>10} {:>10} {:>10}  {}".format(
+                "call", "calls", "SPI/call", "bytes/call", "us/call", "us/SPI", "commands per call")]
+            for (name, call) in stats:
+                top = sorted(call.commands.items(), key=lambda item: item[1], reverse=True)[:commands]
+                lines.append("{:<20} {:>9} {:>9.2f} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(
+                    name, call.calls, call.transactions / call.calls, call.bytes / call.calls,
+                    call.duration / call.calls / 1000, call.duration / call.transactions / 1000,
+                    ", ".join("{} {:.2f}".format(command_name(command), count / call.calls)
+                              for (command, count) in top)))
+        return "\n".join(lines)
@@ -0,0 +1,60 @@
+import unittest
+
+from rf24 import RF24
+from rf24_emulator import EmulatedRadio, Ether
+from rf24_profiler import SPIProfiler, command_name
+
+class CommandNameTest(unittest.TestCase):
+    def test_register_access(self):
+        self.assertEqual(command_name(0x00), "R_CONFIG")
+        self.assertEqual(command_name(0x17), "R_FIFO_STATUS")
+        self.assertEqual(command_name(0x25), "W_RF_CH")
+        self.assertEqual(command_name(0x3D), "W_FEATURE")
+
+    def test_unknown_registers(self):
+        self.assertEqual(command_name(0x18), "R_18")
+        self.assertEqual(command_name(0x3E), "W_1E")
+
+    def test_commands(self):
+        self.assertEqual(command_name(0x61), "R_RX_PAYLOAD")
+        self.assertEqual(command_name(0xB0), "W_TX_PAYLOAD_NOACK")
+        self.assertEqual(command_name(0xFF), "NOP")
+        self.assertEqual(command_name(0x42), "42")
+
+    def test_ack_payload_of_every_pipe(self):
+        for pipe in range(6):
+            self.assertEqual(command_name(0xA8 | pipe), "W_ACK_PAYLOAD")
+
+class SPIProfilerTest(unittest.TestCase):
+    def setUp(self):
+        radio = EmulatedRadio(Ether())
+        self.nrf = RF24(radio.spi, 0, radio.ce, 0, 0)
+        self.profiler = SPIProfiler()
+        self.nrf.profiler = self.profiler
+
+    def test_transactions_are_attributed_to_the_outermost_call(self):
+        for channel in (10, 20, 30):
+            self.nrf.channel = channel
+        stats = self.profiler.stats["channel"]
+        self.assertEqual(stats.calls, 3)
+        self.assertEqual(stats.commands, {0x25: 3})
+        self.assertEqual(stats.bytes, 6)
+        self.assertEqual(list(self.profiler.stats), ["channel"])
+
+    def test_nested_calls_count_once(self):
+        self.nrf.open_tx_pipe(b"1Node")
+        stats = self.profiler.stats["open_tx_pipe"]
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(stats.transactions, 2)
+
+    def test_report(self):
+        self.nrf.update()
+        lines = self.profiler.report().splitlines()
+        self.assertTrue(lines[0].startswith("call"))
+        self.assertTrue(lines[1].startswith("update"))
+        self.assertIn("NOP 1.00", lines[1])
+        self.profiler.reset()
+        self.assertEqual(len(self.profiler.report().splitlines()), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+import time
+import unittest
+
+import rf24_emulator
+from rf24 import RF24
+from rf24_emulator import EmulatedRadio, Ether
+
+"""
+    Tests of the RF24 driver against rf24_emulator radios, whose SPI
+    transactions are counted
+"""
+
+class RadioTestCase(unittest.TestCase):
+    def setUp(self):
+        self.radio = EmulatedRadio(Ether())
+        self.transfers = []
+        xfer2 = self.radio.spi.xfer2
+
+        def counting_xfer2(data, *args):
+            self.transfers.append(bytes(data))
+            return xfer2(data, *args)
+        self.radio.spi.xfer2 = counting_xfer2
+        self.nrf = RF24(self.radio.spi, 0, self.radio.ce, 0, 0)
+        self.transfers.clear()
+
+class ShadowTest(RadioTestCase):
+    def test_getters_make_no_transactions(self):
+        for name in ("channel", "data_rate", "crc", "power", "listen", "address_length", "arc", "ard",
+                     "auto_ack", "dynamic_payloads", "payload_length"):
+            getattr(self.nrf, name)
+        self.assertEqual(self.transfers, [])
+
+    def test_setter_is_one_write(self):
+        self.nrf.channel = 100
+        self.assertEqual(self.transfers, [bytes([0x25, 100])])
+        self.assertEqual(self.nrf.channel, 100)
+        self.assertEqual(self.radio.registers[rf24_emulator.RF_CH], 100)
+
+    def test_open_and_close_pipes(self):
+        self.nrf.open_rx_pipe(2, b"2Node")
+        self.nrf.close_rx_pipe(1)
+        self.assertEqual(self.radio.registers[rf24_emulator.EN_RXADDR], self.nrf._open_pipes)
+        self.assertTrue(self.nrf._open_pipes & 4)
+        self.assertFalse(self.nrf._open_pipes & 2)
+
+class VerifyTest(RadioTestCase):
+    def test_fresh_radio_matches(self):
+        self.assertEqual(self.nrf.verify(), [])
+
+    def test_finds_changed_registers(self):
+        self.radio.registers[rf24_emulator.RF_CH] ^= 1
+        self.radio.registers[rf24_emulator.RF_SETUP] ^= 0x20
+        self.radio.addresses[rf24_emulator.TX_ADDR][0] ^= 0xFF
+        self.assertEqual(self.nrf.verify(), [0x05, 0x06, 0x10])
+
+    def test_ignores_obsolete_rf_setup_bit(self):
+        self.radio.registers[rf24_emulator.RF_SETUP] ^= 1
+        self.assertEqual(self.nrf.verify(), [])
+
+    def test_sync_restores_a_reset_radio(self):
+        self.nrf.channel = 90
+        self.nrf.open_tx_pipe(b"1Node")
+        self.nrf.open_rx_pipe(3, b"3Node")
+        power_on = EmulatedRadio(Ether())
+        self.radio.registers[:] = power_on.registers
+        for (register, address) in power_on.addresses.items():
+            self.radio.addresses[register][:] = address
+        self.assertIn(0x05, self.nrf.verify())
+        self.nrf.sync()
+        self.assertEqual(self.nrf.verify(), [])
+        self.assertEqual(self.radio.registers[rf24_emulator.RF_CH], 90)
+
+class BatchTest(RadioTestCase):
+    def test_writes_wait_for_the_end_of_the_batch(self):
+        channel = self.radio.registers[rf24_emulator.RF_CH]
+        with self.nrf.batch():
+            self.nrf.channel = 100
+            self.nrf.arc = 5
+            self.assertEqual(self.transfers, [])
+            self.assertEqual(self.radio.registers[rf24_emulator.RF_CH], channel)
+        self.assertEqual(self.transfers, [bytes([0x25, 100]), bytes([0x24, self.nrf._retry_setup])])
+        self.assertEqual(self.nrf.verify(), [])
+
+    def test_reads_see_earlier_writes(self):
+        with self.nrf.batch():
+            self.nrf.channel = 100
+            self.assertEqual(self.nrf._reg_read(0x05), 100)
+            self.assertEqual(len(self.transfers), 2)
+            self.nrf.channel = 101
+        self.assertEqual(self.radio.registers[rf24_emulator.RF_CH], 101)
+
+    def test_nested_batches_send_once(self):
+        with self.nrf.batch():
+            with self.nrf.batch():
+                self.nrf.channel = 100
+            self.assertEqual(self.transfers, [])
+        self.assertEqual(len(self.transfers), 1)
+
+    def test_flushed_on_errors(self):
+        with self.assertRaises(ValueError):
+            with self.nrf.batch():
+                self.nrf.channel = 100
+                self.nrf.channel = 200
+        self.assertEqual(self.radio.registers[rf24_emulator.RF_CH], 100)
+        self.assertIsNone(self.nrf._batch)
+
+    def test_status_byte_is_kept_current(self):
+        self.radio.status |= rf24_emulator.TX_DS
+        with self.nrf.batch():
+            self.nrf.channel = 100
+        self.assertTrue(self.nrf.irq_ds)
+
+    def test_sync_is_one_batch(self):
+        batches = []
+        write_many = self.nrf._spi.write_many
+
+        def counting_write_many(out_bufs):
+            batches.append(len(out_bufs))
+            return write_many(out_bufs)
+        self.nrf._spi.write_many = counting_write_many
+        self.nrf.sync()
+        self.assertEqual(batches, [len(self.transfers)])
+        self.assertGreater(len(self.transfers), 20)
+        self.assertTrue(all(transfer[0] & 0xE0 == 0x20 for transfer in self.transfers))
+
+class HungPin(object):
+    """ A CE pin whose line never reaches the radio, so nothing is ever sent """
+    def __init__(self):
+        self.value = False
+
+class TxTimeoutTest(RadioTestCase):
+    def setUp(self):
+        super().setUp()
+        self.nrf.open_tx_pipe(b"1Node")
+        self.nrf.listen = False
+
+    def hang(self):
+        self.nrf.tx_timeout = 0.05
+        self.nrf._ce_pin = HungPin()
+
+    def test_default(self):
+        self.assertEqual(self.nrf.tx_timeout, 0.25)
+        self.nrf.tx_timeout = 0.1
+        self.assertEqual(self.nrf.tx_timeout, 0.1)
+
+    def test_send_gives_up_on_a_hung_radio(self):
+        self.hang()
+        started = time.monotonic()
+        self.assertFalse(self.nrf.send(b"hello"))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.nrf.tx_timeouts, 1)
+        self.assertFalse(self.nrf._ce_pin.value)
+        self.assertEqual(self.radio.tx_fifo, [])
+
+    def test_resend_gives_up_on_a_hung_radio(self):
+        self.hang()
+        self.nrf.write(b"hello")
+        self.assertFalse(self.nrf.resend())
+        self.assertEqual(self.nrf.tx_timeouts, 1)
+        self.assertEqual(self.radio.tx_fifo, [])
+
+    def test_failed_transmission_is_not_a_timeout(self):
+        # Nobody listens, so MAX_RT is flagged
+        self.assertFalse(self.nrf.send(b"hello"))
+        self.assertTrue(self.nrf.irq_df)
+        self.assertEqual(self.nrf.tx_timeouts, 0)
+
+if __name__ == "__main__":
+    unittest.main()
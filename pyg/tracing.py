@@ -0,0 +1,178 @@
+import argparse
+import collections
+import itertools
+import json
+import struct
+import threading
+import time
+from typing import Optional, Tuple
+
+"""
+    Opt-in tracing of packets through the pipeline of a node:
+    TUN read -> queue -> fragments sent -> (air) -> reassembly -> queue -> TUN write.
+
+    Spans are written to a file in the Chrome trace event format, open it
+    in Perfetto or chrome://tracing. Each frame gets a trace id, carried in
+    its fragment headers, that ties the spans of the two nodes together.
+    The nodes estimate the offset of their clocks with link frames, and the
+    mobile writes its spans in the clock of the base, so the traces of both
+    nodes can be merged:
+        python3 tracing.py merge trace_node0.json trace_node1.json -o trace.json
+"""
+
+""" Bytes of the trace id in the fragment header """
+TRACE_ID_SIZE = 2
+
+""" Trace events per write to the trace file """
+FLUSH_EVENTS = 256
+
+""" Packets stamped but never taken (replaced by the ACK filter) are forgotten after this many """
+MAX_PENDING = 1024
+
+""" Thread ids of the pipeline stages in the trace """
+TID_TUN_RX = 1
+TID_RADIO_TX = 2
+TID_RADIO_RX = 3
+TID_TUN_TX = 4
+TID_NAMES = {TID_TUN_RX: "tun_rx", TID_RADIO_TX: "radio_tx", TID_RADIO_RX: "radio_rx", TID_TUN_TX: "tun_tx"}
+
+""" Clock sync payload of link frames: send time and least delay seen from the peer, in us """
+CLOCK_SYNC = struct.Struct("!qq")
+NO_DELAY = -(1 << 63)
+""" Clock sync frames the least delay is taken over, so the estimate follows drift """
+CLOCK_WINDOW = 16
+
+def now() -> int:
+    """ Monotonic time in us """
+    return time.monotonic_ns() // 1000
+
+class ClockSync(object):
+    """
+    Offset of the local clock to the clock of the peer, NTP-style. Both nodes
+    send their time, each keeps the least delay (receive time - send time)
+    of recent frames, and reports it back to the peer. With symmetric one-way
+    delays, half the difference of the two least delays is the offset.
+    """
+    def __init__(self, window: int = CLOCK_WINDOW):
+        self.delays = collections.deque(maxlen=window)
+        self.offset = None # us, local clock - peer clock
+
+    def frame(self) -> bytes:
+        """ Payload of the next clock sync frame """
+        return CLOCK_SYNC.pack(now(), min(self.delays) if self.delays else NO_DELAY)
+
+    def received(self, payload: bytes, arrival: int):
+        """ Update the offset from the payload of a received clock sync frame """
+        if len(payload) < CLOCK_SYNC.size:
+            return
+        (sent, peer_delay) = CLOCK_SYNC.unpack_from(payload)
+        self.delays.append(arrival - sent)
+        if peer_delay != NO_DELAY:
+            self.offset = (min(self.delays) - peer_delay) // 2
+
+class Tracer(object):
+    """
+    Collects the spans of one node and writes them to a trace file.
+    The reference node writes its own time, the others the time of the
+    reference node once the clock offset is known.
+    """
+    def __init__(self, path: str, node: int, name: str, reference: bool):
+        self.lock = threading.Lock()
+        self.node = node
+        self.reference = reference
+        self.ids = itertools.count()
+        self.pending = {}
+        self.rx_start = {}
+        self.clock = ClockSync()
+        self.events = []
+        self.file = open(path, "w")
+        # The array format may be left unterminated, so a killed node leaves a readable trace
+        self.file.write("[\n")
+        self.metadata("process_name", {"name": name})
+        for (tid, thread_name) in TID_NAMES.items():
+            self.metadata("thread_name", {"name": thread_name}, tid)
+
+    def new_id(self) -> int:
+        return next(self.ids) & 0xFFFF
+
+    def time(self, local: int) -> int:
+        """ Trace time of a local timestamp """
+        if self.reference or self.clock.offset is None:
+            return local
+        return local - self.clock.offset
+
+    def stamp(self, packet: bytes, trace_id: Optional[int] = None):
+        """ Remember when a packet was queued, until taken() """
+        with self.lock:
+            self.pending[id(packet)] = (packet, now(), trace_id)
+            if len(self.pending) > MAX_PENDING:
+                del self.pending[next(iter(self.pending))]
+
+    def taken(self, packet: bytes) -> Optional[Tuple[int, Optional[int]]]:
+        """ Time a packet was stamped and its trace id, None if it wasn't """
+        with self.lock:
+            stamp = self.pending.pop(id(packet), None)
+        if stamp is None:
+            return None
+        return stamp[1:]
+
+    def span(self, name: str, tid: int, start: int, end: int, trace_id: Optional[int], **args):
+        args["trace"] = trace_id
+        self.emit({"name": name, "ph": "X", "ts": self.time(start), "dur": end - start,
+                   "pid": self.node, "tid": tid, "args": args})
+
+    def flow(self, start: bool, sender: int, trace_id: int, tid: int, timestamp: int):
+        """ Arrow from the first fragment sent to the reassembly on the peer """
+        event = {"name": "frame", "cat": "link", "ph": "s" if start else "f",
+                 "id": sender << 16 | trace_id, "ts": self.time(timestamp), "pid": self.node, "tid": tid}
+        if not start:
+            event["bp"] = "e"
+        self.emit(event)
+
+    def clock_received(self, payload: bytes, arrival: int):
+        self.clock.received(payload, arrival)
+        if self.clock.offset is not None:
+            self.emit({"name": "clock_offset_us", "ph": "C", "ts": self.time(arrival),
+                       "pid": self.node, "args": {"offset": self.clock.offset}})
+
+    def metadata(self, name: str, args: dict, tid: int = 0):
+        self.emit({"name": name, "ph": "M", "pid": self.node, "tid": tid, "args": args})
+
+    def emit(self, event: dict):
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) < FLUSH_EVENTS:
+                return
+            events, self.events = (self.events, [])
+            self.write(events)
+
+    def write(self, events: list):
+        self.file.write("".join(json.dumps(event) + ",\n" for event in events))
+
+    def close(self):
+        with self.lock:
+            self.write(self.events)
+            self.events = []
+            self.file.close()
+
+def merge(paths: list, output: str):
+    """ Merge the trace files of several nodes into one JSON trace """
+    events = []
+    for path in paths:
+        with open(path) as trace:
+            text = trace.read().rstrip().rstrip(",").rstrip("]")
+        events += json.loads(text + "]")
+    with open(output, "w") as out:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
+
+def main():
+    parser = argparse.ArgumentParser(description="LongG trace files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    merge_parser = subparsers.add_parser("merge", help="Merge the traces of both nodes")
+    merge_parser.add_argument("traces", nargs="+")
+    merge_parser.add_argument("-o", "--output", default="trace.json")
+    args = parser.parse_args()
+    merge(args.traces, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import itertools
+import json
+import os
+import tempfile
+import unittest
+
+import tracing
+from tracing import CLOCK_SYNC, NO_DELAY, ClockSync, Tracer
+
+"""
+    Tests of the clock offset estimate and of the trace files
+"""
+
+def clock_frame(sent: int, peer_delay: int = NO_DELAY) -> bytes:
+    return CLOCK_SYNC.pack(sent, peer_delay)
+
+class ClockSyncTest(unittest.TestCase):
+    def exchange(self, offset: int, delays: list) -> ClockSync:
+        """ Clock sync frames both ways, local clock = peer clock + offset, one-way delays in us """
+        (local, peer) = (ClockSync(), ClockSync())
+        for (t, delay) in enumerate(delays):
+            sent = 1000000 * t
+            # Peer -> local, the peer clock reads sent
+            local.received(clock_frame(sent, min(peer.delays) if peer.delays else NO_DELAY), sent + delay + offset)
+            # Local -> peer, the local clock reads sent + offset
+            peer.received(clock_frame(sent + offset, min(local.delays)), sent + delay)
+        return local
+
+    def test_symmetric_delay(self):
+        self.assertEqual(self.exchange(250000, [3000, 3000]).offset, 250000)
+        self.assertEqual(self.exchange(-7000, [1200, 1200]).offset, -7000)
+
+    def test_least_delay_is_taken(self):
+        # Frames held up in a queue only add to the delay
+        self.assertEqual(self.exchange(5000, [9000, 2000, 40000, 2500]).offset, 5000)
+
+    def test_no_offset_until_the_peer_reports_a_delay(self):
+        clock = ClockSync()
+        clock.received(clock_frame(0), 100)
+        self.assertIsNone(clock.offset)
+        clock.received(clock_frame(1000, 60), 1100)
+        self.assertEqual(clock.offset, (100 - 60) // 2)
+
+    def test_window_forgets_old_delays(self):
+        clock = ClockSync(window=2)
+        for (sent, arrival) in ((0, 10), (100, 150), (200, 250)):
+            clock.received(clock_frame(sent, 30), arrival)
+        self.assertEqual(list(clock.delays), [50, 50])
+        self.assertEqual(clock.offset, (50 - 30) // 2)
+
+    def test_short_payload_is_ignored(self):
+        clock = ClockSync()
+        clock.received(clock_frame(0, 10)[:-1], 100)
+        self.assertEqual(len(clock.delays), 0)
+
+    def test_frame_reports_the_least_delay(self):
+        clock = ClockSync()
+        self.assertEqual(CLOCK_SYNC.unpack(clock.frame())[1], NO_DELAY)
+        clock.received(clock_frame(0), 300)
+        clock.received(clock_frame(1000), 1200)
+        self.assertEqual(CLOCK_SYNC.unpack(clock.frame())[1], 200)
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def tracer(self, node: int, reference: bool) -> Tracer:
+        path = os.path.join(self.directory.name, "trace_node{}.json".format(node))
+        tracer = Tracer(path, node, "node{}".format(node), reference)
+        self.addCleanup(tracer.file.close)
+        return tracer
+
+    def test_ids_wrap_at_the_header_size(self):
+        tracer = self.tracer(0, True)
+        tracer.ids = itertools.count(0xFFFF)
+        self.assertEqual([tracer.new_id(), tracer.new_id()], [0xFFFF, 0])
+
+    def test_time_of_the_reference_node(self):
+        tracer = self.tracer(0, True)
+        tracer.clock.offset = 500
+        self.assertEqual(tracer.time(1000), 1000)
+
+    def test_time_in_the_reference_clock(self):
+        tracer = self.tracer(1, False)
+        self.assertEqual(tracer.time(1000), 1000)
+        tracer.clock.offset = 500
+        self.assertEqual(tracer.time(1000), 500)
+
+    def test_stamp_and_take(self):
+        tracer = self.tracer(0, True)
+        packet = b"\x45" + bytes(19)
+        tracer.stamp(packet, 7)
+        (stamp, trace_id) = tracer.taken(packet)
+        self.assertLessEqual(stamp, tracing.now())
+        self.assertEqual(trace_id, 7)
+        self.assertIsNone(tracer.taken(packet))
+
+    def test_merge(self):
+        (base, mobile) = (self.tracer(0, True), self.tracer(1, False))
+        mobile.clock.offset = 100
+        base.span("send", tracing.TID_RADIO_TX, 1000, 1500, 3, acked=True)
+        mobile.span("reassembly", tracing.TID_RADIO_RX, 1700, 1800, 3)
+        base.close()
+        mobile.close()
+        output = os.path.join(self.directory.name, "trace.json")
+        tracing.merge([base.file.name, mobile.file.name], output)
+        with open(output) as trace:
+            events = [event for event in json.load(trace)["traceEvents"] if event["ph"] == "X"]
+        self.assertEqual([(event["pid"], event["ts"], event["args"]["trace"]) for event in events],
+                         [(0, 1000, 3), (1, 1600, 3)])
+
+if __name__ == "__main__":
+    unittest.main()
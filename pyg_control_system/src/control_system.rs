@@ -1,2 +1,5 @@
 pub mod controller;
-pub mod process;
\ No newline at end of file
+pub mod lookup;
+pub mod process;
+pub mod simulation;
+pub mod tuning;
\ No newline at end of file
@@ -6,7 +6,35 @@
  * Customized for the water tank process, detailed in process.rs
  */
 
+use std::collections::HashMap;
 use pyo3::prelude::*;
+use pyo3::exceptions::{PyIndexError, PyKeyError, PyValueError};
+use numpy::{PyArray1, PyArrayMethods, PyReadonlyArray1, PyReadwriteArray1};
+
+/**
+ * Output of one controller iteration, shared by PID and PIDBank.
+ * Returns the new D-part, the raw and the limited control signal.
+ */
+#[inline]
+#[allow(clippy::too_many_arguments)]
+fn control_law(k: f64, b: f64, ad: f64, bd: f64, u_low: f64, u_high: f64,
+               i: f64, d: f64, y_old: f64, uc: f64, y: f64) -> (f64, f64, f64) {
+    // Calculate proportional part
+    let p: f64 = k*(b*uc - y);
+    // Calculate new derivative part
+    let d: f64 = ad*d - bd*(y - y_old);
+    // Calculate raw control signal output
+    let v: f64 = p + i + d;
+    // Clamp to desired output range
+    let u: f64 = if v < u_low {
+        u_low
+    } else if v > u_high {
+        u_high
+    } else {
+        v
+    };
+    (d, v, u)
+}
 
 struct Signals {
     uc: f64,        // Input: set point
@@ -21,7 +49,7 @@ struct States {
     y_old: f64       // Delayed measured variable
 }
 
-struct Parameters {
+pub(crate) struct Parameters {
     k: f64,         // Proportional gain
     t_i: f64,       // Integral time
     t_d: f64,       // Derivative time
@@ -37,6 +65,105 @@ struct Parameters {
     bd: f64,        // Helper coefficient
     ad: f64         // Helper coefficient
 }
+
+impl Parameters {
+    /**
+     * Parameters tuned for the water tank process
+     */
+    pub(crate) fn default() -> Parameters {
+        let mut params: Parameters = Parameters {
+            k: 4.0,
+            t_i: 0.01,
+            t_d: 0.5,
+            t_t: 1.0,
+            n: 5.0,
+            b: 1.0,
+            u_low: 0.0,
+            u_high: 1.98e-5,
+            h: 5.0,
+            // Set following to 0 when instantiating, change later
+            bi: 0.0,
+            ar: 0.0,
+            bd: 0.0,
+            ad: 0.0
+        };
+        params.update_coefficients();
+        params
+    }
+
+    /**
+     * Default parameters, with the ones named in `overrides` replaced
+     */
+    pub(crate) fn from_map(overrides: Option<&HashMap<String, f64>>) -> PyResult<Parameters> {
+        let mut params: Parameters = Parameters::default();
+        for (name, &value) in overrides.into_iter().flatten() {
+            match name.as_str() {
+                "k" => params.k = value,
+                "t_i" => params.t_i = value,
+                "t_d" => params.t_d = value,
+                "t_t" => params.t_t = value,
+                "n" => params.n = value,
+                "b" => params.b = value,
+                "u_low" => params.u_low = value,
+                "u_high" => params.u_high = value,
+                "h" => params.h = value,
+                _ => return Err(PyKeyError::new_err(format!("unknown PID parameter: {}", name)))
+            }
+        }
+        params.validate()?;
+        params.update_coefficients();
+        Ok(params)
+    }
+
+    /**
+     * Reject parameters that make the helper coefficients infinite or NaN,
+     * or a sampling period that never advances simulated time.
+     * Written as !(x > 0.0) so that NaN is rejected too
+     */
+    fn validate(&self) -> PyResult<()> {
+        if !(self.h > 0.0) {
+            return Err(PyValueError::new_err("PID parameter h must be positive"));
+        }
+        if !(self.t_i > 0.0) {
+            return Err(PyValueError::new_err("PID parameter t_i must be positive"));
+        }
+        if !(self.t_t > 0.0) {
+            return Err(PyValueError::new_err("PID parameter t_t must be positive"));
+        }
+        if !(self.t_d + self.n*self.h > 0.0) {
+            return Err(PyValueError::new_err("PID parameters t_d + n*h must be positive"));
+        }
+        Ok(())
+    }
+
+    /**
+     * Set helper coefficients
+     */
+    fn update_coefficients(&mut self) {
+        self.bi = self.k*self.h / self.t_i;
+        self.ar = self.h / self.t_t;
+        self.ad = self.t_d/(self.t_d + self.n*self.h);
+        self.bd = self.k*self.n*self.ad;
+    }
+
+    /**
+     * Sampling period [s]
+     */
+    pub(crate) fn sampling_period(&self) -> f64 {
+        self.h
+    }
+
+    /**
+     * Control signal of a controller with no I-part and D-part state
+     * for set point uc, measured value y and previous measured value y_old
+     */
+    pub(crate) fn control_signal(&self, uc: f64, y: f64, y_old: f64) -> f64 {
+        let (_, _, u) = control_law(self.k, self.b, self.ad, self.bd, self.u_low, self.u_high,
+                                    0.0, 0.0, y_old, uc, y);
+        u
+    }
+}
+
 #[pyclass]
 pub struct PID {
     signals: Signals,
@@ -44,11 +171,9 @@ pub struct PID {
     params: Parameters
 }
 
-#[pymethods]
 impl PID {
-    #[new]
-    fn new() -> PID {
-        let mut pid: PID = PID {
+    pub(crate) fn with_parameters(params: Parameters) -> PID {
+        PID {
             signals: Signals {
                 uc: 0.0,
                 y: 0.0,
@@ -60,29 +185,25 @@ impl PID {
                 d: 0.0,
                 y_old: 0.0
             },
-            params: Parameters {
-                k: 4.0,
-                t_i: 0.01,
-                t_d: 0.5,
-                t_t: 1.0,
-                n: 5.0,
-                b: 1.0,
-                u_low: 0.0,
-                u_high: 1.98e-5,
-                h: 5.0,
-                // Set following to 0 when instantiating, change later
-                bi: 0.0,
-                ar: 0.0,
-                bd: 0.0,
-                ad: 0.0
-            }
-        };
-        // Set helper coefficients
-        pid.params.bi = pid.params.k*pid.params.h / pid.params.t_i;
-        pid.params.ar = pid.params.h / pid.params.t_t;
-        pid.params.ad = pid.params.t_d/(pid.params.t_d + pid.params.n*pid.params.h);
-        pid.params.bd = pid.params.k*pid.params.n*pid.params.ad;
-        pid
+            params: params
+        }
+    }
+
+    pub(crate) fn sampling_period(&self) -> f64 {
+        self.params.sampling_period()
+    }
+}
+
+#[pymethods]
+impl PID {
+    /**
+     * Parameters not named in `params` (k, t_i, t_d, t_t, n, b, u_low,
+     * u_high, h) keep the defaults tuned for the water tank
+     */
+    #[new]
+    #[pyo3(signature = (params=None))]
+    fn new(params: Option<HashMap<String, f64>>) -> PyResult<PID> {
+        Ok(PID::with_parameters(Parameters::from_map(params.as_ref())?))
     }
 
     /**
@@ -92,23 +213,13 @@ impl PID {
         // Update internal signals
         self.signals.uc = uc;
         self.signals.y = y;
-        // Calculate proportional part
-        let p: f64 = self.params.k*(self.params.b*uc - y);
-        // Calculate new derivative part
-        self.states.d = self.params.ad*self.states.d - 
-            self.params.bd*(y - self.states.y_old);
-        // Calculate raw control signal output
-        self.signals.v = p + self.states.i + self.states.d;
-        // Clamp to desired output range
-        if self.signals.v < self.params.u_low {
-            self.signals.u = self.params.u_low;
-        } else {
-            if self.signals.v > self.params.u_high {
-                self.signals.u = self.params.u_high;
-            } else {
-                self.signals.u = self.signals.v;
-            }
-        }
+        let (d, v, u) = control_law(
+            self.params.k, self.params.b, self.params.ad, self.params.bd,
+            self.params.u_low, self.params.u_high,
+            self.states.i, self.states.d, self.states.y_old, uc, y);
+        self.states.d = d;
+        self.signals.v = v;
+        self.signals.u = u;
         self.signals.u
     }
 
@@ -136,4 +247,234 @@ impl PID {
         self.signals.u
     }
 
-}
\ No newline at end of file
+}
+/**
+ * A bank of PID controllers, stored as structure of arrays so that one
+ * call updates many controllers. Every controller starts with the
+ * parameters of PID::new.
+ */
+#[pyclass]
+pub struct PIDBank {
+    // States
+    i: Vec<f64>,
+    d: Vec<f64>,
+    y_old: Vec<f64>,
+    // Limited controller output
+    u: Vec<f64>,
+    // Parameters
+    k: Vec<f64>,
+    b: Vec<f64>,
+    ad: Vec<f64>,
+    bd: Vec<f64>,
+    u_low: Vec<f64>,
+    u_high: Vec<f64>
+}
+
+impl PIDBank {
+    /**
+     * Run one iteration of controller `index`, returns its control signal
+     */
+    #[inline]
+    fn control_one(&mut self, index: usize, uc: f64, y: f64) -> f64 {
+        let (d, _, u) = control_law(
+            self.k[index], self.b[index], self.ad[index], self.bd[index],
+            self.u_low[index], self.u_high[index],
+            self.i[index], self.d[index], self.y_old[index], uc, y);
+        self.d[index] = d;
+        self.u[index] = u;
+        self.y_old[index] = y;
+        u
+    }
+
+    /**
+     * Run one iteration of every controller, writing the control signals
+     * to `out`. The loop runs without holding the GIL
+     */
+    fn step_slices(&mut self, py: Python<'_>, set_points: &[f64], measurements: &[f64],
+                   out: &mut [f64]) -> PyResult<()> {
+        let n: usize = self.u.len();
+        if set_points.len() != n || measurements.len() != n || out.len() != n {
+            return Err(PyValueError::new_err("one set point, measured value and output per controller expected"));
+        }
+        py.allow_threads(|| {
+            for index in 0..n {
+                out[index] = self.control_one(index, set_points[index], measurements[index]);
+            }
+        });
+        Ok(())
+    }
+}
+
+#[pymethods]
+impl PIDBank {
+    #[new]
+    #[pyo3(signature = (n=0))]
+    fn new(n: usize) -> PIDBank {
+        let mut bank = PIDBank {
+            i: Vec::with_capacity(n),
+            d: Vec::with_capacity(n),
+            y_old: Vec::with_capacity(n),
+            u: Vec::with_capacity(n),
+            k: Vec::with_capacity(n),
+            b: Vec::with_capacity(n),
+            ad: Vec::with_capacity(n),
+            bd: Vec::with_capacity(n),
+            u_low: Vec::with_capacity(n),
+            u_high: Vec::with_capacity(n)
+        };
+        for _ in 0..n {
+            bank.add();
+        }
+        bank
+    }
+
+    fn __len__(&self) -> usize {
+        self.u.len()
+    }
+
+    /**
+     * Add a controller with the parameters of PID::new, returns its index
+     */
+    pub fn add(&mut self) -> usize {
+        let pid: PID = PID::with_parameters(Parameters::default());
+        self.i.push(pid.states.i);
+        self.d.push(pid.states.d);
+        self.y_old.push(pid.states.y_old);
+        self.u.push(pid.signals.u);
+        self.k.push(pid.params.k);
+        self.b.push(pid.params.b);
+        self.ad.push(pid.params.ad);
+        self.bd.push(pid.params.bd);
+        self.u_low.push(pid.params.u_low);
+        self.u_high.push(pid.params.u_high);
+        self.u.len() - 1
+    }
+
+    /**
+     * Run one iteration of every controller. Takes in NumPy arrays with one
+     * set point and one measured value per controller, read in place, and
+     * returns the control signals in a new array
+     */
+    pub fn step<'py>(&mut self, py: Python<'py>, set_points: PyReadonlyArray1<'py, f64>,
+                     measurements: PyReadonlyArray1<'py, f64>) -> PyResult<Bound<'py, PyArray1<f64>>> {
+        let out = PyArray1::<f64>::zeros_bound(py, self.u.len(), false);
+        {
+            let mut out_rw = out.readwrite();
+            self.step_slices(py, set_points.as_slice()?, measurements.as_slice()?, out_rw.as_slice_mut()?)?;
+        }
+        Ok(out)
+    }
+
+    /**
+     * Like step, but writes the control signals to the NumPy array `out`,
+     * so repeated calls allocate nothing
+     */
+    pub fn step_into<'py>(&mut self, py: Python<'py>, set_points: PyReadonlyArray1<'py, f64>,
+                          measurements: PyReadonlyArray1<'py, f64>,
+                          mut out: PyReadwriteArray1<'py, f64>) -> PyResult<()> {
+        self.step_slices(py, set_points.as_slice()?, measurements.as_slice()?, out.as_slice_mut()?)
+    }
+
+    /**
+     * Run one iteration of the controllers at `indices`, and returns
+     * their control signals in the same order
+     */
+    pub fn step_indices(&mut self, indices: Vec<usize>, set_points: Vec<f64>,
+                        measurements: Vec<f64>) -> PyResult<Vec<f64>> {
+        if set_points.len() != indices.len() || measurements.len() != indices.len() {
+            return Err(PyValueError::new_err("one set point and measured value per index expected"));
+        }
+        if indices.iter().any(|&index| index >= self.u.len()) {
+            return Err(PyIndexError::new_err("controller index out of range"));
+        }
+        Ok(indices.iter().enumerate()
+            .map(|(n, &index)| self.control_one(index, set_points[n], measurements[n]))
+            .collect())
+    }
+
+    pub fn get_control_signals<'py>(&self, py: Python<'py>) -> Bound<'py, PyArray1<f64>> {
+        PyArray1::from_slice_bound(py, &self.u)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn overrides(pairs: &[(&str, f64)]) -> HashMap<String, f64> {
+        pairs.iter().map(|&(name, value)| (name.to_string(), value)).collect()
+    }
+
+    #[test]
+    fn defaults_are_valid() {
+        let params: Parameters = Parameters::from_map(None).unwrap();
+        assert_eq!(params.sampling_period(), 5.0);
+        assert!(params.bi.is_finite() && params.ad.is_finite() && params.bd.is_finite());
+    }
+
+    #[test]
+    fn overrides_replace_defaults() {
+        let params: Parameters = Parameters::from_map(Some(&overrides(&[("h", 0.5), ("k", 2.0)]))).unwrap();
+        assert_eq!(params.h, 0.5);
+        assert_eq!(params.k, 2.0);
+        assert_eq!(params.t_i, 0.01);
+        assert_eq!(params.bi, 2.0*0.5/0.01);
+    }
+
+    #[test]
+    fn unknown_parameter_is_rejected() {
+        assert!(Parameters::from_map(Some(&overrides(&[("kp", 1.0)]))).is_err());
+    }
+
+    #[test]
+    fn bad_values_are_rejected() {
+        for bad in [("h", 0.0), ("h", -1.0), ("h", f64::NAN), ("t_i", 0.0), ("t_t", -0.5), ("t_t", f64::NAN)] {
+            assert!(Parameters::from_map(Some(&overrides(&[bad]))).is_err(), "{:?} accepted", bad);
+        }
+        // t_d + n*h = 0
+        assert!(Parameters::from_map(Some(&overrides(&[("t_d", 0.0), ("n", 0.0)]))).is_err());
+        assert!(Parameters::from_map(Some(&overrides(&[("t_d", 0.0), ("n", 1.0)]))).is_ok());
+    }
+
+    #[test]
+    fn bank_matches_pid() {
+        let mut bank: PIDBank = PIDBank::new(3);
+        let mut pids: Vec<PID> = (0..3).map(|_| PID::with_parameters(Parameters::default())).collect();
+        for step in 0..20 {
+            let measurements: Vec<f64> = (0..3).map(|index| 0.001 * (step * (index + 1)) as f64).collect();
+            let signals: Vec<f64> = bank.step_indices(vec![2, 0, 1], vec![0.02; 3],
+                                                      vec![measurements[2], measurements[0], measurements[1]]).unwrap();
+            for (n, &index) in [2, 0, 1].iter().enumerate() {
+                pids[index].control(0.02, measurements[index]);
+                assert_eq!(signals[n], pids[index].get_control_signal());
+                assert_eq!(bank.u[index], pids[index].get_control_signal());
+            }
+        }
+    }
+
+    #[test]
+    fn bank_steps_only_the_given_controllers() {
+        let mut bank: PIDBank = PIDBank::new(0);
+        assert_eq!((bank.add(), bank.add()), (0, 1));
+        bank.step_indices(vec![1], vec![0.02], vec![0.0]).unwrap();
+        assert_eq!(bank.u[0], 0.0);
+        assert_eq!(bank.y_old, vec![0.0, 0.0]);
+        bank.step_indices(vec![1], vec![0.02], vec![0.01]).unwrap();
+        assert_eq!(bank.y_old, vec![0.0, 0.01]);
+    }
+
+    #[test]
+    fn bank_rejects_bad_indices() {
+        let mut bank: PIDBank = PIDBank::new(2);
+        assert!(bank.step_indices(vec![2], vec![0.02], vec![0.0]).is_err());
+        assert!(bank.step_indices(vec![0, 1], vec![0.02], vec![0.0]).is_err());
+        assert_eq!(bank.__len__(), 2);
+    }
+
+    #[test]
+    fn control_signal_is_limited() {
+        let params: Parameters = Parameters::default();
+        assert_eq!(params.control_signal(1.0, 0.0, 0.0), params.u_high);
+        assert_eq!(params.control_signal(0.0, 1.0, 1.0), params.u_low);
+    }
+}
@@ -0,0 +1,262 @@
+/**
+ * Lookup table controller for nodes that control locally when the
+ * control server can't be reached. The control law of PID is tabulated
+ * over a grid of (set point, height, previous height) and stored in a
+ * file, which the controller memory-maps and interpolates in.
+ *
+ * File layout, little endian:
+ *  magic "PGLT", version (u32),
+ *  per axis: number of points (u32), first and last value (f64),
+ *  control signals (f32), previous height varying fastest
+ */
+
+use std::fs::{self, File};
+use std::io::{BufWriter, Write};
+use std::sync::atomic::{AtomicUsize, Ordering};
+use memmap2::Mmap;
+use pyo3::prelude::*;
+use pyo3::exceptions::{PyOSError, PyValueError};
+use crate::control_system::controller::Parameters;
+
+const MAGIC: &[u8; 4] = b"PGLT";
+const VERSION: u32 = 1;
+const AXES: usize = 3;
+const AXIS_SIZE: usize = 4 + 8 + 8;
+const HEADER_SIZE: usize = 4 + 4 + AXES*AXIS_SIZE;
+
+// Numbers the temporary files of concurrent builds in this process
+static BUILDS: AtomicUsize = AtomicUsize::new(0);
+
+/**
+ * Evenly spaced grid points of one table dimension
+ */
+#[derive(Clone, Copy)]
+pub(crate) struct Axis {
+    n: usize,
+    first: f64,
+    last: f64
+}
+
+impl Axis {
+    pub(crate) fn new((first, last, n): (f64, f64, usize)) -> PyResult<Axis> {
+        if n < 2 || !(last > first) {
+            return Err(PyValueError::new_err("an axis needs at least 2 points and last > first"));
+        }
+        Ok(Axis { n: n, first: first, last: last })
+    }
+
+    fn value(&self, index: usize) -> f64 {
+        self.first + (self.last - self.first)*index as f64 / (self.n - 1) as f64
+    }
+
+    /**
+     * Cell index and position within the cell of x, clamped to the grid
+     */
+    #[inline]
+    fn locate(&self, x: f64) -> (usize, f64) {
+        let position: f64 = ((x - self.first) / (self.last - self.first) * (self.n - 1) as f64)
+            .clamp(0.0, (self.n - 1) as f64);
+        let index: usize = (position as usize).min(self.n - 2);
+        (index, position - index as f64)
+    }
+}
+
+/**
+ * Tabulate the control law of `params` and write the table to `path`.
+ * The table is written to a file next to `path` and renamed over it, as
+ * truncating a table in place makes a LookupController that maps it fault
+ */
+pub(crate) fn build(path: &str, params: &Parameters, axes: &[Axis; AXES]) -> std::io::Result<()> {
+    let temp_path: String = format!("{}.{}.{}.tmp", path, std::process::id(),
+                                    BUILDS.fetch_add(1, Ordering::Relaxed));
+    let result: std::io::Result<()> = write_table(&temp_path, params, axes)
+        .and_then(|()| fs::rename(&temp_path, path));
+    if result.is_err() {
+        let _ = fs::remove_file(&temp_path);
+    }
+    result
+}
+
+fn write_table(path: &str, params: &Parameters, axes: &[Axis; AXES]) -> std::io::Result<()> {
+    let mut out: BufWriter<File> = BufWriter::new(File::create(path)?);
+    out.write_all(MAGIC)?;
+    out.write_all(&VERSION.to_le_bytes())?;
+    for axis in axes {
+        out.write_all(&(axis.n as u32).to_le_bytes())?;
+        out.write_all(&axis.first.to_le_bytes())?;
+        out.write_all(&axis.last.to_le_bytes())?;
+    }
+    for i in 0..axes[0].n {
+        for j in 0..axes[1].n {
+            for k in 0..axes[2].n {
+                let u: f64 = params.control_signal(axes[0].value(i), axes[1].value(j), axes[2].value(k));
+                out.write_all(&(u as f32).to_le_bytes())?;
+            }
+        }
+    }
+    out.flush()
+}
+
+#[pyclass]
+pub struct LookupController {
+    table: Mmap,
+    axes: [Axis; AXES],
+    y_old: f64,
+    u: f64
+}
+
+impl LookupController {
+    #[inline]
+    fn entry(&self, i: usize, j: usize, k: usize) -> f64 {
+        let offset: usize = HEADER_SIZE + 4*((i*self.axes[1].n + j)*self.axes[2].n + k);
+        let bytes: [u8; 4] = [self.table[offset], self.table[offset + 1],
+                              self.table[offset + 2], self.table[offset + 3]];
+        f32::from_le_bytes(bytes) as f64
+    }
+}
+
+#[pymethods]
+impl LookupController {
+    #[new]
+    fn new(path: &str) -> PyResult<LookupController> {
+        let file: File = File::open(path).map_err(|e| PyOSError::new_err(e.to_string()))?;
+        // The table file is only ever replaced, never written in place
+        let table: Mmap = unsafe { Mmap::map(&file) }.map_err(|e| PyOSError::new_err(e.to_string()))?;
+        if table.len() < HEADER_SIZE || &table[0..4] != MAGIC
+            || u32::from_le_bytes([table[4], table[5], table[6], table[7]]) != VERSION {
+            return Err(PyValueError::new_err("not a lookup table file"));
+        }
+        let mut axes: [Axis; AXES] = [Axis { n: 0, first: 0.0, last: 0.0 }; AXES];
+        for (index, axis) in axes.iter_mut().enumerate() {
+            let field: &[u8] = &table[8 + index*AXIS_SIZE..8 + (index + 1)*AXIS_SIZE];
+            *axis = Axis::new((f64::from_le_bytes(field[4..12].try_into().unwrap()),
+                               f64::from_le_bytes(field[12..20].try_into().unwrap()),
+                               u32::from_le_bytes(field[0..4].try_into().unwrap()) as usize))?;
+        }
+        if table.len() != HEADER_SIZE + 4*axes.iter().map(|axis| axis.n).product::<usize>() {
+            return Err(PyValueError::new_err("lookup table file is truncated"));
+        }
+        Ok(LookupController { table: table, axes: axes, y_old: 0.0, u: 0.0 })
+    }
+
+    /**
+     * Control signal for set point uc, measured value y and previous
+     * measured value y_old, interpolated trilinearly. Values outside the
+     * table are clamped to its edges
+     */
+    pub fn evaluate(&self, uc: f64, y: f64, y_old: f64) -> f64 {
+        let (i, ti) = self.axes[0].locate(uc);
+        let (j, tj) = self.axes[1].locate(y);
+        let (k, tk) = self.axes[2].locate(y_old);
+        let mut u: f64 = 0.0;
+        for (di, wi) in [(0, 1.0 - ti), (1, ti)] {
+            for (dj, wj) in [(0, 1.0 - tj), (1, tj)] {
+                for (dk, wk) in [(0, 1.0 - tk), (1, tk)] {
+                    u += wi*wj*wk*self.entry(i + di, j + dj, k + dk);
+                }
+            }
+        }
+        u
+    }
+
+    /**
+     * Run one control iteration, as PID.control
+     */
+    pub fn control(&mut self, uc: f64, y: f64) -> () {
+        self.u = self.evaluate(uc, y, self.y_old);
+        self.y_old = y;
+    }
+
+    pub fn get_control_signal(&self) -> f64 {
+        self.u
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn table_path(name: &str) -> String {
+        std::env::temp_dir().join(format!("pglt_test_{}_{}", std::process::id(), name))
+            .to_string_lossy().into_owned()
+    }
+
+    fn axes() -> [Axis; AXES] {
+        [Axis::new((0.0, 0.04, 5)).unwrap(), Axis::new((0.0, 0.1, 11)).unwrap(),
+         Axis::new((0.0, 0.1, 11)).unwrap()]
+    }
+
+    #[test]
+    fn axis_needs_two_increasing_points() {
+        assert!(Axis::new((0.0, 1.0, 1)).is_err());
+        assert!(Axis::new((1.0, 1.0, 2)).is_err());
+        assert!(Axis::new((0.0, f64::NAN, 2)).is_err());
+        let axis: Axis = Axis::new((0.0, 1.0, 5)).unwrap();
+        let (index, t) = axis.locate(0.3);
+        assert_eq!(index, 1);
+        assert!((t - 0.2).abs() < 1e-12);
+        assert_eq!(axis.locate(-1.0), (0, 0.0));
+        assert_eq!(axis.locate(2.0), (3, 1.0));
+    }
+
+    #[test]
+    fn table_matches_the_control_law() {
+        let path: String = table_path("law");
+        let params: Parameters = Parameters::default();
+        build(&path, &params, &axes()).unwrap();
+        let controller: LookupController = LookupController::new(&path).unwrap();
+        fs::remove_file(&path).unwrap();
+        for (uc, y, y_old) in [(0.02, 0.01, 0.01), (0.04, 0.0, 0.1), (0.0, 0.05, 0.04), (0.01, 0.03, 0.02)] {
+            let expected: f64 = params.control_signal(uc, y, y_old) as f32 as f64;
+            assert!((controller.evaluate(uc, y, y_old) - expected).abs() < 1e-9, "{} {} {}", uc, y, y_old);
+        }
+    }
+
+    #[test]
+    fn values_outside_are_clamped() {
+        let path: String = table_path("clamp");
+        build(&path, &Parameters::default(), &axes()).unwrap();
+        let controller: LookupController = LookupController::new(&path).unwrap();
+        fs::remove_file(&path).unwrap();
+        assert_eq!(controller.evaluate(1.0, -1.0, 0.5), controller.evaluate(0.04, 0.0, 0.1));
+    }
+
+    #[test]
+    fn rebuild_replaces_the_file() {
+        let path: String = table_path("rebuild");
+        build(&path, &Parameters::default(), &axes()).unwrap();
+        let old: LookupController = LookupController::new(&path).unwrap();
+        let before: f64 = old.evaluate(0.02, 0.01, 0.0);
+        build(&path, &Parameters::default(), &axes()).unwrap();
+        // The mapping of the replaced table stays valid
+        assert_eq!(old.evaluate(0.02, 0.01, 0.0), before);
+        let parent: std::path::PathBuf = std::path::Path::new(&path).parent().unwrap().to_path_buf();
+        let name: String = std::path::Path::new(&path).file_name().unwrap().to_string_lossy().into_owned();
+        let leftovers: usize = fs::read_dir(parent).unwrap()
+            .filter(|entry| {
+                let entry_name: String = entry.as_ref().unwrap().file_name().to_string_lossy().into_owned();
+                entry_name.starts_with(&name) && entry_name != name
+            })
+            .count();
+        fs::remove_file(&path).unwrap();
+        assert_eq!(leftovers, 0);
+    }
+
+    #[test]
+    fn build_into_missing_directory_fails() {
+        let path: String = table_path("missing_dir/table");
+        assert!(build(&path, &Parameters::default(), &axes()).is_err());
+    }
+
+    #[test]
+    fn truncated_file_is_rejected() {
+        let path: String = table_path("truncated");
+        build(&path, &Parameters::default(), &axes()).unwrap();
+        let data: Vec<u8> = fs::read(&path).unwrap();
+        fs::write(&path, &data[..data.len() - 4]).unwrap();
+        assert!(LookupController::new(&path).is_err());
+        fs::write(&path, b"not a table").unwrap();
+        assert!(LookupController::new(&path).is_err());
+        fs::remove_file(&path).unwrap();
+    }
+}
@@ -4,8 +4,11 @@
  */
 
 
+use std::collections::HashMap;
 use std::f32::consts::PI;
 use pyo3::prelude::*;
+use pyo3::exceptions::{PyKeyError, PyValueError};
+use numpy::{PyArray1, PyArrayMethods, PyReadonlyArray1};
 
 // [m]
 const R1: f32 = 0.087;
@@ -44,6 +47,18 @@ impl WaterTank {
         self.height = self.height + dh; 
     }
 
+    /**
+     * Advance the tank `dt` seconds with inflow q_in, integrated in f64
+     * with `method` (see Integrator)
+     */
+    #[pyo3(signature = (q_in, dt, method="rk4", substep=None))]
+    pub fn integrate(&mut self, q_in: f64, dt: f64, method: &str, substep: Option<f64>) -> PyResult<()> {
+        let integrator: Integrator = Integrator::parse(method, substep)?;
+        integrator.check(dt)?;
+        self.height = integrator.step(self.height as f64, q_in, self.k as f64, self.f as f64, dt) as f32;
+        Ok(())
+    }
+
     pub fn get_water_height(&self) -> f32 {
         self.height
     }
@@ -52,3 +67,347 @@ impl WaterTank {
         self.height*self.f
     }
 }
+
+/**
+ * Rate of change of the water height [m/s] for inflow q_in
+ */
+#[inline]
+pub(crate) fn height_rate(q_in: f64, height: f64, k: f64, f: f64) -> f64 {
+    (q_in - k*height.sqrt()) / f
+}
+
+/**
+ * Rate of change for intermediate integrator stages, which may undershoot
+ * an empty tank
+ */
+#[inline]
+fn stage_rate(q_in: f64, height: f64, k: f64, f: f64) -> f64 {
+    height_rate(q_in, height.max(0.0), k, f)
+}
+
+// Most explicit Euler steps within one step of Integrator::Substep
+const MAX_SUBSTEPS: f64 = 1e6;
+
+// Adaptive RK45 error tolerance [m]
+const RK45_ABS_TOL: f64 = 1e-9;
+const RK45_REL_TOL: f64 = 1e-6;
+
+/**
+ * Integration method of the water height over one time step
+ */
+#[derive(Clone, Copy)]
+pub(crate) enum Integrator {
+    Euler,          // One explicit Euler step
+    Substep(f64),   // Explicit Euler steps of at most the given dt [s]
+    Rk4,            // Classic fourth order Runge-Kutta
+    Rk45            // Adaptive Dormand-Prince 5(4) within the step
+}
+
+impl Integrator {
+    /**
+     * Integrator named "euler", "substep" (with substep dt), "rk4" or "rk45"
+     */
+    pub(crate) fn parse(method: &str, substep: Option<f64>) -> PyResult<Integrator> {
+        match (method, substep) {
+            ("euler", _) => Ok(Integrator::Euler),
+            ("substep", Some(dt)) if dt > 0.0 && dt.is_finite() => Ok(Integrator::Substep(dt)),
+            ("substep", _) => Err(PyValueError::new_err("substep integration needs a positive, finite substep")),
+            ("rk4", _) => Ok(Integrator::Rk4),
+            ("rk45", _) => Ok(Integrator::Rk45),
+            _ => Err(PyValueError::new_err(format!("unknown integrator: {}", method)))
+        }
+    }
+
+    /**
+     * Check a step of `dt` seconds before integrating it, possibly without
+     * the GIL: it must be positive and finite, and take at most
+     * MAX_SUBSTEPS substeps
+     */
+    pub(crate) fn check(&self, dt: f64) -> PyResult<()> {
+        // Also rejects NaN, which would pass dt <= 0.0
+        if !(dt > 0.0 && dt.is_finite()) {
+            return Err(PyValueError::new_err("dt must be positive and finite"));
+        }
+        match *self {
+            Integrator::Substep(max_dt) if dt / max_dt > MAX_SUBSTEPS =>
+                Err(PyValueError::new_err(format!("dt / substep exceeds {} substeps", MAX_SUBSTEPS))),
+            _ => Ok(())
+        }
+    }
+
+    /**
+     * Water height after `dt` seconds of inflow q_in, see check(). The height never
+     * goes below zero, where the outflow stops
+     */
+    pub(crate) fn step(&self, height: f64, q_in: f64, k: f64, f: f64, dt: f64) -> f64 {
+        match *self {
+            Integrator::Euler => (height + dt*height_rate(q_in, height, k, f)).max(0.0),
+            Integrator::Substep(max_dt) => {
+                let n: usize = (dt / max_dt).ceil().max(1.0) as usize;
+                let sub_dt: f64 = dt / n as f64;
+                let mut h: f64 = height;
+                for _ in 0..n {
+                    h = (h + sub_dt*height_rate(q_in, h, k, f)).max(0.0);
+                }
+                h
+            },
+            Integrator::Rk4 => rk4(height, q_in, k, f, dt),
+            Integrator::Rk45 => rk45(height, q_in, k, f, dt)
+        }
+    }
+}
+
+fn rk4(height: f64, q_in: f64, k: f64, f: f64, dt: f64) -> f64 {
+    let k1: f64 = stage_rate(q_in, height, k, f);
+    let k2: f64 = stage_rate(q_in, height + 0.5*dt*k1, k, f);
+    let k3: f64 = stage_rate(q_in, height + 0.5*dt*k2, k, f);
+    let k4: f64 = stage_rate(q_in, height + dt*k3, k, f);
+    (height + dt/6.0*(k1 + 2.0*k2 + 2.0*k3 + k4)).max(0.0)
+}
+
+fn rk45(height: f64, q_in: f64, k: f64, f: f64, dt: f64) -> f64 {
+    let rate = |h: f64| stage_rate(q_in, h, k, f);
+    let mut t: f64 = 0.0;
+    let mut h: f64 = height;
+    let mut step: f64 = dt;
+    // Steps below this are taken regardless of the error, near an empty
+    // tank the error estimate of sqrt doesn't shrink with the step
+    let min_step: f64 = dt * 1e-6;
+    while t < dt {
+        step = step.min(dt - t);
+        let k1: f64 = rate(h);
+        let k2: f64 = rate(h + step*(k1/5.0));
+        let k3: f64 = rate(h + step*(3.0/40.0*k1 + 9.0/40.0*k2));
+        let k4: f64 = rate(h + step*(44.0/45.0*k1 - 56.0/15.0*k2 + 32.0/9.0*k3));
+        let k5: f64 = rate(h + step*(19372.0/6561.0*k1 - 25360.0/2187.0*k2 + 64448.0/6561.0*k3
+                                     - 212.0/729.0*k4));
+        let k6: f64 = rate(h + step*(9017.0/3168.0*k1 - 355.0/33.0*k2 + 46732.0/5247.0*k3
+                                     + 49.0/176.0*k4 - 5103.0/18656.0*k5));
+        let h5: f64 = h + step*(35.0/384.0*k1 + 500.0/1113.0*k3 + 125.0/192.0*k4
+                                - 2187.0/6784.0*k5 + 11.0/84.0*k6);
+        let k7: f64 = rate(h5);
+        let h4: f64 = h + step*(5179.0/57600.0*k1 + 7571.0/16695.0*k3 + 393.0/640.0*k4
+                                - 92097.0/339200.0*k5 + 187.0/2100.0*k6 + 1.0/40.0*k7);
+        let tolerance: f64 = RK45_ABS_TOL + RK45_REL_TOL*h.abs().max(h5.abs());
+        let error: f64 = (h5 - h4).abs() / tolerance;
+        if error <= 1.0 || step <= min_step {
+            t += step;
+            h = h5.max(0.0);
+        }
+        let factor: f64 = if error == 0.0 { 5.0 } else { (0.9*error.powf(-0.2)).clamp(0.2, 5.0) };
+        step = (step*factor).max(min_step);
+    }
+    h
+}
+
+/**
+ * Water tank parameters in f64, for simulation
+ */
+pub(crate) struct TankParameters {
+    pub(crate) f: f64,      // Cross-section area [m^2]
+    pub(crate) k: f64,      // Outflow coefficient [m^2.5 / s]
+    pub(crate) height: f64  // Initial water height [m]
+}
+
+impl TankParameters {
+    /**
+     * The WaterTank geometry, with the parameters named in `overrides`
+     * (ext_radius, int_radius, k, height) replaced
+     */
+    pub(crate) fn from_map(overrides: Option<&HashMap<String, f64>>) -> PyResult<TankParameters> {
+        let (mut ext_radius, mut int_radius): (f64, f64) = (R1 as f64, R2 as f64);
+        let mut params: TankParameters = TankParameters { f: 0.0, k: K as f64, height: 0.0 };
+        for (name, &value) in overrides.into_iter().flatten() {
+            match name.as_str() {
+                "ext_radius" => ext_radius = value,
+                "int_radius" => int_radius = value,
+                "k" => params.k = value,
+                "height" => params.height = value,
+                _ => return Err(PyKeyError::new_err(format!("unknown tank parameter: {}", name)))
+            }
+        }
+        params.f = ext_radius.powi(2)*std::f64::consts::PI + int_radius.powi(2)*std::f64::consts::PI;
+        Ok(params)
+    }
+}
+
+/**
+ * Advance every tank `steps` steps of `dt` seconds, with one inflow per
+ * tank held over all steps
+ */
+fn advance(heights: &mut [f64], q_in: &[f64], steps: usize, dt: f64, integrator: Integrator, k: f64, f: f64) {
+    for (height, &q) in heights.iter_mut().zip(q_in) {
+        let mut h: f64 = *height;
+        for _ in 0..steps {
+            h = integrator.step(h, q, k, f, dt);
+        }
+        *height = h;
+    }
+}
+
+/**
+ * A bank of water tanks with the geometry of WaterTank, simulated in f64
+ * so that many tanks advance many steps in one call
+ */
+#[pyclass]
+pub struct WaterTankBank {
+    height: Vec<f64>,
+    f: f64,
+    k: f64
+}
+
+#[pymethods]
+impl WaterTankBank {
+    #[new]
+    fn new(n: usize) -> WaterTankBank {
+        let params: TankParameters = TankParameters::from_map(None)
+            .expect("default tank parameters are valid");
+        WaterTankBank {
+            height: vec![params.height; n],
+            f: params.f,
+            k: params.k
+        }
+    }
+
+    fn __len__(&self) -> usize {
+        self.height.len()
+    }
+
+    /**
+     * Advance every tank `steps` steps of `dt` seconds, with one inflow per
+     * tank held over all steps, integrated with `method` (see Integrator).
+     * Returns the water heights. Runs without holding the GIL
+     */
+    #[pyo3(signature = (q_in, steps, dt, method="euler", substep=None))]
+    pub fn step_many<'py>(&mut self, py: Python<'py>, q_in: PyReadonlyArray1<'py, f64>,
+                          steps: usize, dt: f64, method: &str, substep: Option<f64>)
+                          -> PyResult<Bound<'py, PyArray1<f64>>> {
+        let q_in: &[f64] = q_in.as_slice()?;
+        if q_in.len() != self.height.len() {
+            return Err(PyValueError::new_err("one inflow per tank expected"));
+        }
+        let integrator: Integrator = Integrator::parse(method, substep)?;
+        integrator.check(dt)?;
+        let (k, f) = (self.k, self.f);
+        let heights: &mut [f64] = &mut self.height;
+        py.allow_threads(|| advance(heights, q_in, steps, dt, integrator, k, f));
+        Ok(PyArray1::from_slice_bound(py, &self.height))
+    }
+
+    pub fn get_water_heights<'py>(&self, py: Python<'py>) -> Bound<'py, PyArray1<f64>> {
+        PyArray1::from_slice_bound(py, &self.height)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /**
+     * Draining tank without inflow: sqrt(height) falls linearly at k/(2f)
+     */
+    fn drained(height: f64, k: f64, f: f64, t: f64) -> f64 {
+        (height.sqrt() - k*t/(2.0*f)).max(0.0).powi(2)
+    }
+
+    fn tank() -> TankParameters {
+        TankParameters::from_map(None).unwrap()
+    }
+
+    #[test]
+    fn parse_methods() {
+        assert!(matches!(Integrator::parse("euler", None), Ok(Integrator::Euler)));
+        assert!(matches!(Integrator::parse("substep", Some(0.1)), Ok(Integrator::Substep(dt)) if dt == 0.1));
+        assert!(matches!(Integrator::parse("rk4", None), Ok(Integrator::Rk4)));
+        assert!(matches!(Integrator::parse("rk45", None), Ok(Integrator::Rk45)));
+        assert!(Integrator::parse("substep", None).is_err());
+        assert!(Integrator::parse("substep", Some(0.0)).is_err());
+        assert!(Integrator::parse("substep", Some(f64::NAN)).is_err());
+        assert!(Integrator::parse("substep", Some(f64::INFINITY)).is_err());
+        assert!(Integrator::parse("midpoint", None).is_err());
+    }
+
+    #[test]
+    fn check_steps() {
+        for integrator in [Integrator::Euler, Integrator::Substep(0.1), Integrator::Rk4, Integrator::Rk45] {
+            assert!(integrator.check(1.0).is_ok());
+            for dt in [0.0, -1.0, f64::NAN, f64::INFINITY] {
+                assert!(integrator.check(dt).is_err());
+            }
+        }
+        assert!(Integrator::Substep(1e-3).check(1e3).is_ok());
+        assert!(Integrator::Substep(1e-3).check(1e4).is_err());
+        assert!(Integrator::Euler.check(1e4).is_ok());
+    }
+
+    #[test]
+    fn equilibrium_is_kept() {
+        let tank: TankParameters = tank();
+        let q_in: f64 = tank.k*0.04_f64.sqrt();
+        for integrator in [Integrator::Euler, Integrator::Substep(0.5), Integrator::Rk4, Integrator::Rk45] {
+            assert!((integrator.step(0.04, q_in, tank.k, tank.f, 10.0) - 0.04).abs() < 1e-12);
+        }
+    }
+
+    #[test]
+    fn draining_matches_the_exact_solution() {
+        let tank: TankParameters = tank();
+        let exact: f64 = drained(0.1, tank.k, tank.f, 100.0);
+        let error = |integrator: Integrator| (integrator.step(0.1, 0.0, tank.k, tank.f, 100.0) - exact).abs();
+        let euler: f64 = error(Integrator::Euler);
+        let substep: f64 = error(Integrator::Substep(1.0));
+        let rk4: f64 = error(Integrator::Rk4);
+        let rk45: f64 = error(Integrator::Rk45);
+        assert!(substep < euler / 10.0);
+        assert!(rk4 < substep);
+        assert!(rk45 < 1e-6);
+    }
+
+    #[test]
+    fn height_never_goes_negative() {
+        let tank: TankParameters = tank();
+        // Long enough to empty the tank within the step
+        for integrator in [Integrator::Euler, Integrator::Substep(1.0), Integrator::Rk4, Integrator::Rk45] {
+            let height: f64 = integrator.step(0.001, 0.0, tank.k, tank.f, 1000.0);
+            assert!(height >= 0.0 && height < 1e-6);
+        }
+    }
+
+    #[test]
+    fn bank_tanks_match_single_steps() {
+        let tank: TankParameters = tank();
+        let mut heights: Vec<f64> = vec![0.1, 0.05, 0.0];
+        let q_in: [f64; 3] = [0.0, tank.k*0.05_f64.sqrt(), 1e-5];
+        advance(&mut heights, &q_in, 50, 2.0, Integrator::Rk4, tank.k, tank.f);
+        for (n, &start) in [0.1, 0.05, 0.0].iter().enumerate() {
+            let mut h: f64 = start;
+            for _ in 0..50 {
+                h = Integrator::Rk4.step(h, q_in[n], tank.k, tank.f, 2.0);
+            }
+            assert_eq!(heights[n], h);
+        }
+        assert!(heights[0] < 0.1);
+        assert!((heights[1] - 0.05).abs() < 1e-12);
+        assert!(heights[2] > 0.0);
+    }
+
+    #[test]
+    fn bank_of_default_tanks() {
+        let bank: WaterTankBank = WaterTankBank::new(4);
+        assert_eq!(bank.__len__(), 4);
+        assert!(bank.height.iter().all(|&h| h == 0.0));
+        let tank: TankParameters = tank();
+        assert_eq!((bank.k, bank.f), (tank.k, tank.f));
+    }
+
+    #[test]
+    fn tank_parameters_overrides() {
+        let overrides: HashMap<String, f64> = [("ext_radius".to_string(), 1.0), ("int_radius".to_string(), 0.0),
+                                               ("height".to_string(), 0.5)].into_iter().collect();
+        let params: TankParameters = TankParameters::from_map(Some(&overrides)).unwrap();
+        assert!((params.f - std::f64::consts::PI).abs() < 1e-12);
+        assert_eq!(params.height, 0.5);
+        let unknown: HashMap<String, f64> = [("radius".to_string(), 1.0)].into_iter().collect();
+        assert!(TankParameters::from_map(Some(&unknown)).is_err());
+    }
+}
@@ -0,0 +1,208 @@
+/**
+ * Closed-loop simulation of the water tank and its PID controller in
+ * simulated time, including the sampling delay and packet loss of the
+ * radio link between the mobile unit and the control server.
+ */
+
+use std::collections::VecDeque;
+use pyo3::prelude::*;
+use pyo3::exceptions::PyValueError;
+use crate::control_system::controller::PID;
+use crate::control_system::process::{Integrator, TankParameters};
+
+// Most steps of a simulation, each keeps four f64 samples
+const MAX_STEPS: f64 = 1e7;
+
+/**
+ * Link between mobile unit and control server
+ */
+pub(crate) struct Link {
+    pub(crate) delay: f64,  // Sample to control signal delay [s]
+    pub(crate) loss: f64,   // Loss probability of a sample, and of a reply
+    pub(crate) seed: u64    // Seed of the loss process
+}
+
+pub(crate) struct Trajectories {
+    pub(crate) time: Vec<f64>,
+    pub(crate) height: Vec<f64>,
+    pub(crate) set_point: Vec<f64>,
+    pub(crate) control: Vec<f64>
+}
+
+/**
+ * xorshift64* generator, enough to draw packet losses reproducibly
+ */
+struct Rng {
+    state: u64
+}
+
+impl Rng {
+    fn new(seed: u64) -> Rng {
+        let state: u64 = seed.wrapping_add(0x9E3779B97F4A7C15);
+        Rng { state: if state == 0 { 1 } else { state } }
+    }
+
+    fn next_f64(&mut self) -> f64 {
+        self.state ^= self.state >> 12;
+        self.state ^= self.state << 25;
+        self.state ^= self.state >> 27;
+        (self.state.wrapping_mul(0x2545F4914F6CDD1D) >> 11) as f64 / (1u64 << 53) as f64
+    }
+
+    fn lost(&mut self, probability: f64) -> bool {
+        probability > 0.0 && self.next_f64() < probability
+    }
+}
+
+/**
+ * Set point at time t of a profile of (start time, set point) steps
+ */
+pub(crate) fn set_point_at(profile: &[(f64, f64)], t: f64) -> f64 {
+    let mut set_point: f64 = profile.first().map_or(0.0, |&(_, uc)| uc);
+    for &(start, uc) in profile {
+        if start > t {
+            break;
+        }
+        set_point = uc;
+    }
+    set_point
+}
+
+/**
+ * Number of steps of `h` seconds in `duration` seconds, checked before a
+ * simulation allocates them: h must be positive and finite, duration
+ * finite and not negative, and there may be at most MAX_STEPS steps
+ */
+pub(crate) fn steps(duration: f64, h: f64) -> PyResult<usize> {
+    // Also rejects NaN, which would pass h <= 0.0
+    if !(h > 0.0 && h.is_finite() && duration >= 0.0 && duration.is_finite()) {
+        return Err(PyValueError::new_err("h must be positive and duration finite and not negative"));
+    }
+    let steps: f64 = (duration / h).ceil();
+    if steps > MAX_STEPS {
+        return Err(PyValueError::new_err(format!("duration / h exceeds {} steps", MAX_STEPS)));
+    }
+    Ok(steps as usize)
+}
+
+/**
+ * Run the closed loop for `duration` seconds, checked with steps(). The tank is updated every
+ * `h` seconds with the control signal in effect, using `integrator`, and sampled every
+ * sampling period of the controller. A control signal takes effect
+ * `link.delay` seconds after its sample. Lost samples don't reach the
+ * controller, lost replies leave the previous control signal in effect.
+ */
+pub(crate) fn run(pid: &mut PID, tank: &TankParameters, profile: &[(f64, f64)],
+                  duration: f64, h: f64, integrator: Integrator, link: &Link) -> Trajectories {
+    let steps: usize = (duration / h).ceil() as usize;
+    let sampling_period: f64 = pid.sampling_period();
+    let mut trajectories: Trajectories = Trajectories {
+        time: Vec::with_capacity(steps),
+        height: Vec::with_capacity(steps),
+        set_point: Vec::with_capacity(steps),
+        control: Vec::with_capacity(steps)
+    };
+    let mut rng: Rng = Rng::new(link.seed);
+    // Control signals on their way back, with the time they take effect
+    let mut replies: VecDeque<(f64, f64)> = VecDeque::new();
+    let mut next_sample: f64 = 0.0;
+    let mut height: f64 = tank.height;
+    let mut u: f64 = 0.0;
+
+    for step in 0..steps {
+        let t: f64 = step as f64 * h;
+        let uc: f64 = set_point_at(profile, t);
+        // Samples due in this step see the current height
+        while next_sample <= t + 1e-9 {
+            if !rng.lost(link.loss) {
+                pid.control(set_point_at(profile, next_sample), height);
+                if !rng.lost(link.loss) {
+                    replies.push_back((next_sample + link.delay, pid.get_control_signal()));
+                }
+            }
+            next_sample += sampling_period;
+        }
+        while replies.front().map_or(false, |&(arrival, _)| arrival <= t + 1e-9) {
+            u = replies.pop_front().map_or(u, |(_, signal)| signal);
+        }
+        trajectories.time.push(t);
+        trajectories.height.push(height);
+        trajectories.set_point.push(uc);
+        trajectories.control.push(u);
+        height = integrator.step(height, u, tank.k, tank.f, h);
+    }
+    trajectories
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use std::collections::HashMap;
+    use crate::control_system::controller::Parameters;
+
+    fn pid(h: f64) -> PID {
+        let overrides: HashMap<String, f64> = [("h".to_string(), h)].into_iter().collect();
+        PID::with_parameters(Parameters::from_map(Some(&overrides)).unwrap())
+    }
+
+    fn tank() -> TankParameters {
+        TankParameters::from_map(None).unwrap()
+    }
+
+    #[test]
+    fn step_count() {
+        assert_eq!(steps(100.0, 1.0).unwrap(), 100);
+        assert_eq!(steps(10.5, 1.0).unwrap(), 11);
+        assert_eq!(steps(0.0, 1.0).unwrap(), 0);
+        for (duration, h) in [(1.0, 0.0), (1.0, -1.0), (1.0, f64::NAN), (1.0, f64::INFINITY),
+                              (-1.0, 1.0), (f64::NAN, 1.0), (f64::INFINITY, 1.0), (3600.0, 1e-9)] {
+            assert!(steps(duration, h).is_err());
+        }
+    }
+
+    #[test]
+    fn set_point_steps() {
+        let profile: [(f64, f64); 2] = [(10.0, 0.02), (20.0, 0.05)];
+        assert_eq!(set_point_at(&profile, 0.0), 0.02);
+        assert_eq!(set_point_at(&profile, 19.9), 0.02);
+        assert_eq!(set_point_at(&profile, 20.0), 0.05);
+        assert_eq!(set_point_at(&[], 5.0), 0.0);
+    }
+
+    #[test]
+    fn one_point_per_step() {
+        let link: Link = Link { delay: 0.0, loss: 0.0, seed: 0 };
+        let trajectories: Trajectories = run(&mut pid(1.0), &tank(), &[(0.0, 0.02)], 10.0, 0.5,
+                                             Integrator::Euler, &link);
+        assert_eq!(trajectories.time.len(), 20);
+        assert_eq!(trajectories.time[19], 9.5);
+        assert_eq!(trajectories.height.len(), 20);
+        assert_eq!(trajectories.control.len(), 20);
+    }
+
+    #[test]
+    fn control_signal_arrives_after_the_delay() {
+        let link: Link = Link { delay: 3.0, loss: 0.0, seed: 0 };
+        let trajectories: Trajectories = run(&mut pid(1.0), &tank(), &[(0.0, 0.02)], 10.0, 1.0,
+                                             Integrator::Euler, &link);
+        assert!(trajectories.control[..3].iter().all(|&u| u == 0.0));
+        assert!(trajectories.control[3] > 0.0);
+    }
+
+    #[test]
+    fn tank_fills_towards_the_set_point() {
+        let link: Link = Link { delay: 0.0, loss: 0.0, seed: 0 };
+        let trajectories: Trajectories = run(&mut pid(1.0), &tank(), &[(0.0, 0.02)], 600.0, 1.0,
+                                             Integrator::Rk4, &link);
+        assert!(*trajectories.height.last().unwrap() > 0.0);
+        assert!(trajectories.height.iter().all(|height| height.is_finite()));
+    }
+
+    #[test]
+    fn losses_are_reproducible() {
+        let link: Link = Link { delay: 0.0, loss: 0.3, seed: 7 };
+        let first: Trajectories = run(&mut pid(1.0), &tank(), &[(0.0, 0.02)], 100.0, 1.0, Integrator::Euler, &link);
+        let second: Trajectories = run(&mut pid(1.0), &tank(), &[(0.0, 0.02)], 100.0, 1.0, Integrator::Euler, &link);
+        assert_eq!(first.control, second.control);
+    }
+}
@@ -0,0 +1,157 @@
+/**
+ * Tuning of PID parameters by a grid search over closed-loop simulations.
+ * Candidates are simulated in parallel on all cores.
+ */
+
+use std::collections::HashMap;
+use rayon::prelude::*;
+use crate::control_system::controller::{Parameters, PID};
+use crate::control_system::process::{Integrator, TankParameters};
+use crate::control_system::simulation::{self, Link, Trajectories};
+
+/**
+ * Performance of one simulated run
+ */
+#[derive(Clone, Copy)]
+pub(crate) struct Score {
+    pub(crate) ise: f64,        // Integral of squared error [m^2 s]
+    pub(crate) iae: f64,        // Integral of absolute error [m s]
+    pub(crate) overshoot: f64   // Largest height above the set point [m]
+}
+
+impl Score {
+    pub(crate) fn of(trajectories: &Trajectories, h: f64) -> Score {
+        let mut score: Score = Score { ise: 0.0, iae: 0.0, overshoot: 0.0 };
+        for (&height, &set_point) in trajectories.height.iter().zip(&trajectories.set_point) {
+            let e: f64 = set_point - height;
+            score.ise += e*e*h;
+            score.iae += e.abs()*h;
+            score.overshoot = score.overshoot.max(-e);
+        }
+        score
+    }
+
+    pub(crate) fn get(&self, objective: &str) -> Option<f64> {
+        match objective {
+            "ise" => Some(self.ise),
+            "iae" => Some(self.iae),
+            "overshoot" => Some(self.overshoot),
+            _ => None
+        }
+    }
+}
+
+/**
+ * Every combination of the values in `grid`, each on top of `base`
+ */
+pub(crate) fn candidates(base: &HashMap<String, f64>,
+                         grid: &HashMap<String, Vec<f64>>) -> Vec<HashMap<String, f64>> {
+    let mut names: Vec<&String> = grid.keys().collect();
+    names.sort();
+    let mut candidates: Vec<HashMap<String, f64>> = vec![base.clone()];
+    for name in names {
+        candidates = candidates.iter()
+            .flat_map(|candidate| grid[name].iter().map(move |&value| {
+                let mut candidate: HashMap<String, f64> = candidate.clone();
+                candidate.insert(name.clone(), value);
+                candidate
+            }))
+            .collect();
+    }
+    candidates
+}
+
+/**
+ * Sort runs best `objective` first. A run that diverged scores inf or NaN,
+ * and ranks as infinity, after every run with a finite score
+ */
+pub(crate) fn rank<T>(results: &mut [(T, Score)], objective: &str) {
+    let key = |score: &Score| -> f64 {
+        let value: f64 = score.get(objective).unwrap_or(f64::INFINITY);
+        if value.is_finite() { value } else { f64::INFINITY }
+    };
+    results.sort_by(|(_, a), (_, b)| key(a).total_cmp(&key(b)));
+}
+
+/**
+ * Simulate the closed loop with every set of parameters, in parallel
+ */
+pub(crate) fn evaluate(parameters: Vec<Parameters>, tank: &TankParameters, profile: &[(f64, f64)],
+                       duration: f64, h: f64, integrator: Integrator, link: &Link) -> Vec<Score> {
+    parameters.into_par_iter()
+        .map(|params| {
+            let mut pid: PID = PID::with_parameters(params);
+            let trajectories: Trajectories = simulation::run(&mut pid, tank, profile, duration, h,
+                                                               integrator, link);
+            Score::of(&trajectories, h)
+        })
+        .collect()
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn score(ise: f64) -> Score {
+        Score { ise: ise, iae: 0.0, overshoot: 0.0 }
+    }
+
+    #[test]
+    fn candidates_cover_the_grid() {
+        let base: HashMap<String, f64> = [("k".to_string(), 2.0)].into_iter().collect();
+        let grid: HashMap<String, Vec<f64>> = [("t_i".to_string(), vec![0.1, 0.2, 0.3]),
+                                               ("t_d".to_string(), vec![0.5, 1.0])].into_iter().collect();
+        let candidates: Vec<HashMap<String, f64>> = candidates(&base, &grid);
+        assert_eq!(candidates.len(), 6);
+        assert!(candidates.iter().all(|candidate| candidate["k"] == 2.0 && candidate.len() == 3));
+        for t_i in [0.1, 0.2, 0.3] {
+            for t_d in [0.5, 1.0] {
+                assert!(candidates.iter().any(|candidate| candidate["t_i"] == t_i && candidate["t_d"] == t_d));
+            }
+        }
+    }
+
+    #[test]
+    fn empty_grid_is_the_base() {
+        let base: HashMap<String, f64> = [("k".to_string(), 2.0)].into_iter().collect();
+        assert_eq!(candidates(&base, &HashMap::new()), vec![base.clone()]);
+    }
+
+    #[test]
+    fn score_of_trajectories() {
+        let trajectories: Trajectories = Trajectories {
+            time: vec![0.0, 2.0, 4.0],
+            height: vec![0.0, 0.03, 0.02],
+            set_point: vec![0.02, 0.02, 0.02],
+            control: vec![0.0, 0.0, 0.0]
+        };
+        let score: Score = Score::of(&trajectories, 2.0);
+        assert!((score.ise - (0.0004 + 0.0001)*2.0).abs() < 1e-12);
+        assert!((score.iae - (0.02 + 0.01)*2.0).abs() < 1e-12);
+        assert!((score.overshoot - 0.01).abs() < 1e-12);
+        assert_eq!(score.get("iae"), Some(score.iae));
+        assert_eq!(score.get("itae"), None);
+    }
+
+    #[test]
+    fn diverged_runs_rank_last() {
+        let mut results: Vec<(usize, Score)> = vec![(0, score(f64::NAN)), (1, score(2.0)), (2, score(-f64::NAN)),
+                                                    (3, score(f64::INFINITY)), (4, score(1.0))];
+        rank(&mut results, "ise");
+        let order: Vec<usize> = results.iter().map(|&(index, _)| index).collect();
+        assert_eq!(&order[..2], &[4, 1]);
+    }
+
+    #[test]
+    fn evaluate_scores_in_order() {
+        let overrides: HashMap<String, f64> = [("h".to_string(), 1.0)].into_iter().collect();
+        let parameters: Vec<Parameters> = vec![Parameters::from_map(Some(&overrides)).unwrap(),
+                                               Parameters::from_map(Some(&overrides)).unwrap()];
+        let tank: TankParameters = TankParameters::from_map(None).unwrap();
+        let link: Link = Link { delay: 0.0, loss: 0.0, seed: 0 };
+        let scores: Vec<Score> = evaluate(parameters, &tank, &[(0.0, 0.02)], 60.0, 1.0, Integrator::Euler, &link);
+        assert_eq!(scores.len(), 2);
+        assert_eq!(scores[0].ise, scores[1].ise);
+        assert!(scores[0].ise > 0.0);
+    }
+}
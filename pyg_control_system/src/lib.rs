@@ -1,8 +1,14 @@
 mod control_system;
 
+use std::collections::HashMap;
 use pyo3::prelude::*;
-use crate::control_system::controller::PID;
-use crate::control_system::process::WaterTank;
+use pyo3::exceptions::{PyOSError, PyValueError};
+use numpy::PyArray1;
+use crate::control_system::controller::{Parameters, PID, PIDBank};
+use crate::control_system::lookup::{self, Axis, LookupController};
+use crate::control_system::process::{Integrator, TankParameters, WaterTank, WaterTankBank};
+use crate::control_system::simulation::{self, Link, Trajectories};
+use crate::control_system::tuning::{self, Score};
 
 #[pyfunction]
 fn control_it(pid: &mut PID, set_point: f64, measured_value: f64) -> PyResult<()> {
@@ -29,15 +35,111 @@ fn get_water_volume(water_tank: &WaterTank) -> PyResult<f32> {
     Ok(water_tank.get_water_volume())
 }
 
+/**
+ * Tabulate the PID control law for LookupController. Each axis is
+ * (first, last, number of points); the previous height axis defaults to
+ * the height axis. Parameters not given in pid_params keep the PID defaults
+ */
+#[pyfunction]
+#[pyo3(signature = (path, set_points, heights, previous_heights=None, pid_params=None))]
+fn build_lookup_table(py: Python<'_>, path: &str, set_points: (f64, f64, usize),
+                      heights: (f64, f64, usize), previous_heights: Option<(f64, f64, usize)>,
+                      pid_params: Option<HashMap<String, f64>>) -> PyResult<()> {
+    let params: Parameters = Parameters::from_map(pid_params.as_ref())?;
+    let axes: [Axis; 3] = [Axis::new(set_points)?, Axis::new(heights)?,
+                           Axis::new(previous_heights.unwrap_or(heights))?];
+    py.allow_threads(|| lookup::build(path, &params, &axes))
+        .map_err(|e| PyOSError::new_err(e.to_string()))
+}
+
+/**
+ * Simulate the closed loop in simulated time. Parameters not given in
+ * pid_params or tank_params keep the defaults of PID and WaterTank.
+ * The set point profile is a list of (start time, set point) steps.
+ * The tank is integrated with `method` ("euler", "substep" with
+ * `substep` dt, "rk4" or "rk45") over each step h.
+ * Returns time, water height, set point and control signal arrays
+ */
+#[pyfunction]
+#[pyo3(signature = (pid_params=None, tank_params=None, set_point_profile=None, duration=3600.0, h=1.0, delay=0.0, loss=0.0, seed=0, method="euler", substep=None))]
+#[allow(clippy::too_many_arguments, clippy::type_complexity)]
+fn simulate<'py>(py: Python<'py>, pid_params: Option<HashMap<String, f64>>,
+                 tank_params: Option<HashMap<String, f64>>,
+                 set_point_profile: Option<Vec<(f64, f64)>>, duration: f64, h: f64,
+                 delay: f64, loss: f64, seed: u64, method: &str, substep: Option<f64>)
+                 -> PyResult<(Bound<'py, PyArray1<f64>>, Bound<'py, PyArray1<f64>>,
+                              Bound<'py, PyArray1<f64>>, Bound<'py, PyArray1<f64>>)> {
+    simulation::steps(duration, h)?;
+    let integrator: Integrator = Integrator::parse(method, substep)?;
+    integrator.check(h)?;
+    let mut pid: PID = PID::with_parameters(Parameters::from_map(pid_params.as_ref())?);
+    let tank: TankParameters = TankParameters::from_map(tank_params.as_ref())?;
+    let profile: Vec<(f64, f64)> = set_point_profile.unwrap_or_else(|| vec![(0.0, 0.02)]);
+    let link: Link = Link { delay: delay, loss: loss, seed: seed };
+    let trajectories: Trajectories = py.allow_threads(|| {
+        simulation::run(&mut pid, &tank, &profile, duration, h, integrator, &link)
+    });
+    Ok((PyArray1::from_vec_bound(py, trajectories.time),
+        PyArray1::from_vec_bound(py, trajectories.height),
+        PyArray1::from_vec_bound(py, trajectories.set_point),
+        PyArray1::from_vec_bound(py, trajectories.control)))
+}
+
+/**
+ * Grid search over PID parameters. Every combination of the values in
+ * `grid` (parameter name to list of values), on top of pid_params, is
+ * simulated as in `simulate`, in parallel on all cores.
+ * Returns (parameters, ISE, IAE, overshoot) per combination, best
+ * `objective` ("ise", "iae" or "overshoot") first
+ */
+#[pyfunction]
+#[pyo3(signature = (grid, pid_params=None, tank_params=None, set_point_profile=None, duration=3600.0, h=1.0, delay=0.0, loss=0.0, seed=0, objective="ise", method="euler", substep=None))]
+#[allow(clippy::too_many_arguments)]
+fn tune(py: Python<'_>, grid: HashMap<String, Vec<f64>>, pid_params: Option<HashMap<String, f64>>,
+        tank_params: Option<HashMap<String, f64>>, set_point_profile: Option<Vec<(f64, f64)>>,
+        duration: f64, h: f64, delay: f64, loss: f64, seed: u64, objective: &str,
+        method: &str, substep: Option<f64>)
+        -> PyResult<Vec<(HashMap<String, f64>, f64, f64, f64)>> {
+    simulation::steps(duration, h)?;
+    let integrator: Integrator = Integrator::parse(method, substep)?;
+    integrator.check(h)?;
+    let no_score: Score = Score { ise: 0.0, iae: 0.0, overshoot: 0.0 };
+    if no_score.get(objective).is_none() {
+        return Err(PyValueError::new_err(format!("unknown objective: {}", objective)));
+    }
+    let candidates: Vec<HashMap<String, f64>> = tuning::candidates(&pid_params.unwrap_or_default(), &grid);
+    // Every grid point is validated here, a bad one fails before any simulation runs
+    let parameters: Vec<Parameters> = candidates.iter()
+        .map(|candidate| Parameters::from_map(Some(candidate)))
+        .collect::<PyResult<Vec<Parameters>>>()?;
+    let tank: TankParameters = TankParameters::from_map(tank_params.as_ref())?;
+    let profile: Vec<(f64, f64)> = set_point_profile.unwrap_or_else(|| vec![(0.0, 0.02)]);
+    let link: Link = Link { delay: delay, loss: loss, seed: seed };
+    let scores: Vec<Score> = py.allow_threads(|| {
+        tuning::evaluate(parameters, &tank, &profile, duration, h, integrator, &link)
+    });
+    let mut results: Vec<(HashMap<String, f64>, Score)> = candidates.into_iter().zip(scores).collect();
+    tuning::rank(&mut results, objective);
+    Ok(results.into_iter()
+        .map(|(candidate, score)| (candidate, score.ise, score.iae, score.overshoot))
+        .collect())
+}
+
 #[pymodule]
 fn pyg_control_system(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<PID>()?;
     m.add_function(wrap_pyfunction!(control_it, m)?)?;
     m.add_function(wrap_pyfunction!(get_control_signal, m)?)?;
+    m.add_class::<PIDBank>()?;
+    m.add_class::<LookupController>()?;
+    m.add_function(wrap_pyfunction!(build_lookup_table, m)?)?;
     m.add_class::<WaterTank>()?;
     m.add_function(wrap_pyfunction!(update_process, m)?)?;
     m.add_function(wrap_pyfunction!(get_water_height, m)?)?;
     m.add_function(wrap_pyfunction!(get_water_volume, m)?)?;
+    m.add_class::<WaterTankBank>()?;
+    m.add_function(wrap_pyfunction!(simulate, m)?)?;
+    m.add_function(wrap_pyfunction!(tune, m)?)?;
     Ok(())
 }
 